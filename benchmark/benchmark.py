@@ -0,0 +1,304 @@
+import argparse
+import asyncio
+import contextlib
+import importlib.util
+import json
+import os
+import pathlib
+import platform
+import sys
+import time
+from types import ModuleType
+from typing import Callable, Dict, List, Optional, Tuple
+
+ROOT = pathlib.Path(__file__).resolve().parents[1]
+
+# make the shared lte_ryz package importable when running the script from its own directory
+sys.path.append(str(ROOT))
+from lte_ryz import ATEngine, ATResponse, HTTPClient, MQTTClient, RESPONSE_ERROR, open_serial_port  # noqa: E402
+from lte_ryz.mqtt import MQTT_RCV_MESSAGE_CMD_HEADER  # noqa: E402
+from lte_ryz.trace import Tracer  # noqa: E402
+
+
+FLOWS = ['http_get',
+         'http_post',
+         'mqtt_pub',
+         'mqtt_sub',
+         'tcp_echo'
+         ]
+
+# The echo client dials this address. The simulated remote end echoes whatever it receives
+ECHO_SERVER_IP = "127.0.0.1"
+ECHO_SERVER_PORT = 7
+
+PERCENTILES = (50, 95, 99)
+
+
+def load_script(path: pathlib.Path) -> ModuleType:
+    # The example scripts are not part of a package, so they are loaded from their file
+    spec = importlib.util.spec_from_file_location(path.stem, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class RecordingEngine(ATEngine):
+    # Records every command issued by the scripts, so errors and URC to fetch times can be measured
+    # without changing the scripts
+
+    def __init__(self, port, *args, **kwargs):
+        super().__init__(port, *args, **kwargs)
+        # the simulator behind a ryzsim:// port, None when a capture is replayed
+        self.modem = getattr(port, "modem", None)
+        self.records: List[Tuple[str, float, RESPONSE_ERROR]] = []
+        self.recorded = asyncio.Event()
+
+    async def command(self, command: str, *args, **kwargs) -> Tuple[ATResponse, RESPONSE_ERROR]:
+        response, error = await super().command(command, *args, **kwargs)
+        self._record(command, error)
+        return response, error
+
+    async def command_batch(self, commands, *args, **kwargs) -> List[Tuple[ATResponse, RESPONSE_ERROR]]:
+        results = await super().command_batch(commands, *args, **kwargs)
+        for command, (response, error) in zip(commands, results):
+            self._record(command, error)
+        return results
+
+    def _record(self, command: str, error: RESPONSE_ERROR):
+        self.records.append((command, time.perf_counter(), error))
+        self.recorded.set()
+
+    @property
+    def errors(self) -> int:
+        return sum(1 for command, end, error in self.records if error != RESPONSE_ERROR.OK)
+
+
+class ScriptedSession:
+    # Stands in for the PromptSession of the interactive scripts. Answers each prompt with the next
+    # message, then "exit". The time between two prompts is the time taken by one message
+
+    def __init__(self, messages: List[str]):
+        self._messages = list(messages) + ["exit"]
+        self.prompt_times: List[float] = []
+
+    async def prompt_async(self, *args, **kwargs) -> str:
+        self.prompt_times.append(time.perf_counter())
+        return self._messages.pop(0) if self._messages else "exit"
+
+    @property
+    def latencies(self) -> List[float]:
+        return [end - start for start, end in zip(self.prompt_times, self.prompt_times[1:])]
+
+
+def percentile(samples: List[float], percent: float) -> float:
+    # nearest rank
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    rank = max(1, round(percent / 100 * len(ordered)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+async def bench_http_get(engine: RecordingEngine, iterations: int, payload: str) -> List[float]:
+    lte_http = load_script(ROOT / "http" / "httpbin" / "lte_http.py")
+    client = HTTPClient(engine)
+    latencies = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        await lte_http.http_get(client)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+async def bench_http_post(engine: RecordingEngine, iterations: int, payload: str) -> List[float]:
+    lte_http = load_script(ROOT / "http" / "httpbin" / "lte_http.py")
+    client = HTTPClient(engine)
+    latencies = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        await lte_http.http_post(client, payload)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+async def bench_mqtt_pub(engine: RecordingEngine, iterations: int, payload: str) -> List[float]:
+    lte_mqtt = load_script(ROOT / "mqtt" / "lte_mqtt.py")
+    session = ScriptedSession([payload] * iterations)
+    lte_mqtt.session = session
+    client = MQTTClient(engine, lte_mqtt.MQTT_CONFIG)
+    await lte_mqtt.mqtt_pub(client)
+    await client.disconnect()
+    return session.latencies[:iterations]
+
+
+async def bench_mqtt_sub(engine: RecordingEngine, iterations: int, payload: str) -> List[float]:
+    # Messages are injected at the simulated broker one at a time. The latency runs from the injection
+    # until the script has fetched the message with AT+SQNSMQTTRCVMESSAGE
+    lte_mqtt = load_script(ROOT / "mqtt" / "lte_mqtt.py")
+    topic = lte_mqtt.MQTT_TOPIC
+    modem = engine.modem
+    client = MQTTClient(engine, lte_mqtt.MQTT_CONFIG)
+
+    subscribed = asyncio.Event()
+    engine.subscribe('+SQNSMQTTONSUBSCRIBE', lambda frame: subscribed.set())
+    subscriber = asyncio.create_task(lte_mqtt.mqtt_sub(client, 3600))
+    await subscribed.wait()
+
+    def fetched() -> int:
+        return sum(1 for command, end, error in engine.records if command.startswith(MQTT_RCV_MESSAGE_CMD_HEADER))
+
+    latencies = []
+    for _ in range(iterations):
+        count = fetched()
+        start = time.perf_counter()
+        # A replayed capture delivers the messages by itself
+        if modem is not None:
+            modem.inject_mqtt_message(topic, payload.encode())
+        while fetched() == count and not subscriber.done():
+            engine.recorded.clear()
+            await engine.recorded.wait()
+        if subscriber.done():
+            break
+        latencies.append(time.perf_counter() - start)
+
+    subscriber.cancel()
+    with contextlib.suppress(asyncio.CancelledError):
+        await subscriber
+    await client.disconnect()
+    return latencies
+
+
+async def bench_tcp_echo(engine: RecordingEngine, iterations: int, payload: str) -> List[float]:
+    tcp_echo_client = load_script(ROOT / "socket" / "tcp" / "tcp_echo_client.py")
+    session = ScriptedSession([payload] * iterations)
+    tcp_echo_client.session = session
+    await tcp_echo_client.run_echo_client(engine, ECHO_SERVER_IP, ECHO_SERVER_PORT)
+    return session.latencies[:iterations]
+
+
+BENCHMARKS: Dict[str, Callable] = {
+    'http_get': bench_http_get,
+    'http_post': bench_http_post,
+    'mqtt_pub': bench_mqtt_pub,
+    'mqtt_sub': bench_mqtt_sub,
+    'tcp_echo': bench_tcp_echo,
+}
+
+
+async def run_flow(flow: str, url: str, iterations: int, payload: str, capture: Optional[str] = None) -> dict:
+    port = open_serial_port(url, False, capture)
+    # No UART trace, and the output of the scripts themselves would swamp the results
+    engine = RecordingEngine(port, tracer=Tracer())
+    await engine.start()
+    # The simulator, or the replayed capture, counts the traffic. Both count from the modem side
+    modem = getattr(port, "replay", None) or port.modem
+
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        cpu_start = time.process_time()
+        start = time.perf_counter()
+        latencies = await BENCHMARKS[flow](engine, iterations, payload)
+        duration = time.perf_counter() - start
+        cpu_time = time.process_time() - cpu_start
+
+    await engine.stop()
+    port.close()
+
+    transactions = len(latencies)
+    return {
+        "transactions": transactions,
+        "errors": engine.errors,
+        "duration_s": duration,
+        "latency_ms": {
+            **{f"p{percent}": percentile(latencies, percent) * 1000 for percent in PERCENTILES},
+            "mean": sum(latencies) / transactions * 1000 if transactions else 0.0,
+            "max": max(latencies, default=0.0) * 1000,
+        },
+        "commands": modem.commands_received,
+        "commands_per_second": modem.commands_received / duration,
+        "bytes": modem.bytes_received + modem.bytes_sent,
+        "bytes_per_second": (modem.bytes_received + modem.bytes_sent) / duration,
+        # Includes the simulator, which runs in this process
+        "cpu_ms_per_transaction": cpu_time / transactions * 1000 if transactions else 0.0,
+        "diverged": getattr(modem, "diverged", None),
+    }
+
+
+def print_results(results: Dict[str, dict]):
+    print(f"{'flow':<10} {'txns':>6} {'errors':>6} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} "
+          f"{'cmds/s':>8} {'bytes/s':>9} {'cpu ms':>7}")
+    for flow, result in results.items():
+        latency = result["latency_ms"]
+        print(f"{flow:<10} {result['transactions']:>6} {result['errors']:>6} {latency['p50']:>8.2f} "
+              f"{latency['p95']:>8.2f} {latency['p99']:>8.2f} {result['commands_per_second']:>8.1f} "
+              f"{result['bytes_per_second']:>9.0f} {result['cpu_ms_per_transaction']:>7.2f}")
+
+
+async def main(flows: List[str], url: str, iterations: int, payload_size: int, output: Optional[str],
+               capture_dir: Optional[str] = None, replay_dir: Optional[str] = None, speed: str = "max"):
+
+    payload = "x" * payload_size
+    results = {}
+    for flow in flows:
+        print(f"Running {flow} ({iterations} transactions)...")
+        capture = None
+        flow_url = url
+        if capture_dir:
+            os.makedirs(capture_dir, exist_ok=True)
+            capture = os.path.join(capture_dir, f"{flow}.cap")
+        if replay_dir:
+            flow_url = f"replay://{pathlib.Path(replay_dir, f'{flow}.cap').as_posix()}?speed={speed}"
+        results[flow] = await run_flow(flow, flow_url, iterations, payload, capture)
+        if replay_dir and results[flow]["diverged"] is not None:
+            print(f"Warning: {flow} stopped writing what was captured at byte {results[flow]['diverged']}")
+
+    print_results(results)
+
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "port": f"replay://{replay_dir}" if replay_dir else url,
+        "iterations": iterations,
+        "payload_size": payload_size,
+        "results": results,
+    }
+    if output:
+        with open(output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='LTE benchmark',
+                                     description='Runs the HTTP, MQTT and TCP example flows against the modem simulator')
+
+    parser.add_argument("flows", type=str, nargs="*", help=f'Flows to run: {", ".join(FLOWS)} (default: all)')
+    parser.add_argument("--iterations", type=int, default=50, help='Transactions per flow')
+    parser.add_argument("--payload_size", type=int, default=64, help='Bytes sent per POST, publish and echo')
+    parser.add_argument("--baudrate", type=int, default=115200, help='Simulated UART speed, 0 to disable throttling')
+    parser.add_argument("--latency", type=float, default=0.0, help='Seconds before a command is answered')
+    parser.add_argument("--network_latency", type=float, default=0.05,
+                        help='Seconds before network results are reported')
+    parser.add_argument("--error_rate", type=float, default=0.0, help='Probability that a command fails')
+    parser.add_argument("--seed", type=int, default=1, help='Seed for the error injection')
+    parser.add_argument("--output", type=str, default=None, help='Write the results to this JSON file')
+    parser.add_argument("--capture", type=str, default=None,
+                        help='Record the UART traffic of each flow to <flow>.cap in this directory')
+    parser.add_argument("--replay", type=str, default=None,
+                        help='Play back the captures in this directory instead of running the simulator')
+    parser.add_argument("--speed", type=str, default="max",
+                        help='Replay speed: 1 for the captured timing, 10 for ten times faster, max (default)')
+
+    args = parser.parse_args()
+    for flow in args.flows:
+        if flow not in FLOWS:
+            parser.error(f"unknown flow: {flow}")
+
+    url = (f"ryzsim://?baudrate={args.baudrate}&latency={args.latency}"
+           f"&network_latency={args.network_latency}&error_rate={args.error_rate}&seed={args.seed}")
+
+    try:
+        asyncio.run(main(args.flows or FLOWS, url, args.iterations, args.payload_size, args.output, args.capture,
+                         args.replay, args.speed))
+    except KeyboardInterrupt:
+        pass
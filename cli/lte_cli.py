@@ -1,68 +1,78 @@
 import argparse
+import pathlib
 import serial
+import sys
 import threading
 import time
+from typing import Optional
 from prompt_toolkit import PromptSession
 from prompt_toolkit.patch_stdout import patch_stdout
 
+# make the shared lte_ryz package importable when running the script from its own directory
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[1]))
+from lte_ryz.capture import CaptureSerial  # noqa: E402
+from lte_ryz.trace import Tracer, add_trace_arguments  # noqa: E402
 
-def open_serial_port(com_port: str, flow_cntrl: bool) -> serial.Serial:
+
+def open_serial_port(com_port: str, flow_cntrl: bool, capture: Optional[str] = None) -> serial.Serial:
     ser = serial.Serial()
     ser.port = com_port
     ser.baudrate = 115200
     ser.rtscts = flow_cntrl
     ser.timeout = 1
     ser.open()
+    if capture:
+        return CaptureSerial(ser, capture)
     return ser
 
 
-def get_lte_response(ser: serial.Serial):
+def get_lte_response(ser: serial.Serial, tracer: Tracer):
+    # The responses are shown by the tracer's own thread, so a slow terminal never holds up the reads
     while True:
         received = ser.readline()
-        # uncomment below to see raw data received
-        # print(f"\t<-- Rx: {received}")
-        received = received.strip(b'\r\n')
-        if not received:
-            continue
-        print(f"\t<-- Rx: {received.decode()}")
+        if received:
+            tracer.rx_line(received)
 
 
-def get_user_input(ser: serial.Serial):
+def get_user_input(ser: serial.Serial, tracer: Tracer):
     session = PromptSession()
     while True:
         with patch_stdout():
             try:
                 input_str: str = session.prompt('>>> ')
                 if input_str:
-                    print(f"\t--> Tx: {input_str}")
+                    command = input_str
                     if input_str != "+++":
                         input_str += "\r"
-                    # uncomment below to see raw data transmitted
-                    # print(f"\t--> Tx:{input_str.encode()}")
+                    tracer.tx_commands([command], input_str.encode())
                     ser.write(input_str.encode())
             except KeyboardInterrupt:
                 pass
                 return
 
 
-def main(com_port: str, flow_cntrl: bool):
+def main(com_port: str, flow_cntrl: bool, tracer: Tracer, capture: Optional[str] = None):
 
-    ser = open_serial_port(com_port, flow_cntrl)
+    ser = open_serial_port(com_port, flow_cntrl, capture)
+    tracer.start()
 
-    cli_task = threading.Thread(target=get_user_input, args=[ser])
+    cli_task = threading.Thread(target=get_user_input, args=[ser, tracer])
     cli_task.daemon = True
     cli_task.start()
 
-    lte_task = threading.Thread(target=get_lte_response, args=[ser])
+    lte_task = threading.Thread(target=get_lte_response, args=[ser, tracer])
     lte_task.daemon = True
     lte_task.start()
 
-    while True:
-        # If one of the tasks exits, exit the application
-        if cli_task.is_alive() and lte_task.is_alive():
-            time.sleep(1)
-        else:
-            return
+    try:
+        while True:
+            # If one of the tasks exits, exit the application
+            if cli_task.is_alive() and lte_task.is_alive():
+                time.sleep(1)
+            else:
+                return
+    finally:
+        tracer.stop()
 
 
 if __name__ == "__main__":
@@ -71,10 +81,13 @@ if __name__ == "__main__":
 
     parser.add_argument("com_port", type=str, help='COM port for your development kit')
     parser.add_argument("--flow_cntrl", action="store_true", help='Enable serial flow control')
+    add_trace_arguments(parser)
+    parser.add_argument("--capture", type=str, default=None,
+                        help='Record the UART traffic to this file, played back with replay://<file> as the COM port')
 
     args = parser.parse_args()
 
     try:
-        main(args.com_port, args.flow_cntrl)
+        main(args.com_port, args.flow_cntrl, Tracer.from_args(args), args.capture)
     except KeyboardInterrupt:
         pass
@@ -1,88 +1,52 @@
 import argparse
-from enum import Enum, IntEnum
+import asyncio
 import json
-import queue
-import serial
-import threading
-import time
-from typing import Tuple
+import pathlib
+import sys
+from typing import Optional
 from prompt_toolkit import PromptSession
 from prompt_toolkit.completion import WordCompleter
 from prompt_toolkit.patch_stdout import patch_stdout
 
+# make the shared lte_ryz package importable when running the script from its own directory
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[2]))
+from lte_ryz import (ATEngine, HTTP_SND_COMMAND, HTTPBody, HTTPClient, HTTPConfig, HTTPResponse, Journal,  # noqa: E402
+                     CircuitBreaker, NetworkMonitor, RESPONSE_ERROR, RetryPolicy, StoreAndForward, open_serial_port)
+from lte_ryz.trace import Tracer, add_trace_arguments  # noqa: E402
 
-serial_port = serial.Serial()
-serial_rx_q = queue.Queue()
-user_command_q = queue.Queue()
 
-
-PROFILE_ID = "1"
-# HTTP configure command. This command sets the parameters needed to establish the HTTP connection
-HTTP_CFG_CMD_HEADER = "AT+SQNHTTPCFG="
-HTTP_URL = "\"httpbin.org\""
-# Footer details
+# HTTP configuration applied to the modem HTTP profile
 #   Port 80
 #   no authentication
 #   empty user name
 #   empty password
-#   no SSL, 30 second txsfer timeout ( maximum time in seconds allowed for the HTTP(S) connection establishment/completion (if needed) and the data transfer)
+#   no SSL, 120 second txsfer timeout ( maximum time in seconds allowed for the HTTP(S) connection establishment/completion (if needed) and the data transfer)
 #   1 second receive timeout (Maximum time in seconds to wait for the HTTP server response)
-HTTP_CFG_CMD_FOOTER = "80,0,\"\",\"\",0,120,1"
-
-# This command performs HTTP GET, HEAD or DELETE requests to the server
-HTTP_QRY_CMD_HEADER = "AT+SQNHTTPQRY="
-HTTP_BIN_GET_URL = "\"/get\""
-HTTP_BIN_DELETE_URL = "\"/delete\""
-HTTP_BIN_STREAM_URL = "\"/stream"
-
-# This command reads the HTTP response content data received with the last HTTP response (the HTTP
-# response reception advertised by the +SQNHTTPRING notification)
-HTTP_RCV_CMD_HEADER = "AT+SQNHTTPRCV="
-HTTP_STATUS_OK = "200"
-
-# This command performs a POST or PUT request to a HTTP server and sends it the data.
-HTTP_SND_CMD_HEADER = "AT+SQNHTTPSND="
-HTTP_BIN_POST_URL = "\"/post\""
-
-HTTP_BIN_PUT_URL = "\"/put\""
+# The configuration is only sent to the modem when it differs from the one last applied to the profile
+HTTP_CONFIG = HTTPConfig(host="httpbin.org", port=80, timeout=120, rcv_timeout=1)
 
+HTTP_BIN_GET_URL = "/get"
+HTTP_BIN_DELETE_URL = "/delete"
+HTTP_BIN_STREAM_URL = "/stream"
+HTTP_BIN_POST_URL = "/post"
+HTTP_BIN_PUT_URL = "/put"
 
-class HTTP_QRY_COMMNAND(str, Enum):
-    GET = "0"
-    HEAD = "1"
-    DELETE = "2"
+HTTP_STATUS_OK = 200
 
+# POST and PUT requests that fail are kept here and sent once the modem is registered to the network again,
+# including by a later run of the script
+JOURNAL_DIR = pathlib.Path(__file__).resolve().parent / "journal"
 
-class HTTP_SND_COMMNAND(str, Enum):
-    POST = "0"
-    PUT = "1"
-
-
-class RESPONSE_ERROR(IntEnum):
-    OK = 0
-    ERROR = 1
-    TIMEOUT = 2
-
-
-def get_lte_response():
-    while True:
-        received = serial_port.readline()
-        # uncomment below to see raw data received
-        # print(f"\t<-- Rx: {received}")
-        received = received.strip(b'\r\n')
-        if not received:
-            continue
-        print(f"\t<-- Rx: {received.decode()}")
-        serial_rx_q.put_nowait(received.decode())
 
-
-def get_user_input():
+async def get_user_input(user_command_q: asyncio.Queue):
     # Accepted commands
     commands = ['HTTP_DELETE',
                 'HTTP_GET',
                 'HTTP_POST',
+                'HTTP_POST_FILE',
                 'HTTP_PUT',
                 'HTTP_STREAM',
+                'STATS',
                 'EXIT'
                 ]
     commands.sort()
@@ -92,7 +56,7 @@ def get_user_input():
     while True:
         with patch_stdout():
             try:
-                input_str: str = session.prompt('>>> ')
+                input_str: str = await session.prompt_async('>>> ')
                 if input_str:
                     args = input_str.split()
                     # Ensure we have a valid command
@@ -104,23 +68,32 @@ def get_user_input():
                 return
 
 
-def handle_command():
+async def handle_command(client: HTTPClient, user_command_q: asyncio.Queue, forwarder: Optional[StoreAndForward] = None):
+    # Each request runs in its own task on one of the client's HTTP profiles, so requests entered while
+    # others are still in flight overlap on the link
+    requests = set()
     while True:
-        command: str = user_command_q.get()
+        command: str = await user_command_q.get()
         args = command.split(' ', maxsplit=1)
         match args[0]:
             case 'HTTP_DELETE':
-                http_delete()
+                request = http_delete(client)
 
             case 'HTTP_GET':
-                http_get()
+                request = http_get(client)
 
             case 'HTTP_POST':
                 if len(args) == 1:
                     message = "default POST message"
                 else:
                     message = args[1]
-                http_post(message)
+                request = http_post(client, message, forwarder)
+
+            case 'HTTP_POST_FILE':
+                if len(args) == 1:
+                    print("Usage: HTTP_POST_FILE <path>")
+                    continue
+                request = http_post_file(client, args[1])
 
             case 'HTTP_PUT':
                 if len(args) == 1:
@@ -128,7 +101,7 @@ def handle_command():
                 else:
                     message = args[1]
                     print(f"Using: {message}")
-                http_put(message)
+                request = http_put(client, message, forwarder)
 
             case 'HTTP_STREAM':
                 if len(args) == 1:
@@ -136,197 +109,150 @@ def handle_command():
                 else:
                     num_responses = int(args[1])
 
-                http_stream(num_responses)
+                request = http_stream(client, num_responses)
+
+            case 'STATS':
+                # STATS prints the AT command latencies, STATS <path> writes them as JSON, or in the
+                # Prometheus text format for a .prom path
+                print_stats(client.engine, args[1] if len(args) > 1 else None)
+                continue
 
             case 'EXIT':
+                if requests:
+                    await asyncio.wait(requests)
                 return
 
+        task = asyncio.create_task(request)
+        requests.add(task)
+        task.add_done_callback(requests.discard)
+
 
-def http_delete():
+async def http_delete(client: HTTPClient):
 
-    print(f"Sending HTTP DELETE request to {HTTP_URL}")
-    # HTTP configure command. This command sets the parameters needed to establish the HTTP connection
-    cmd = HTTP_CFG_CMD_HEADER + PROFILE_ID + "," + HTTP_URL + "," + HTTP_CFG_CMD_FOOTER
-    send_command(cmd)
-    response, error = wait_for_response('OK')
+    print(f"Sending HTTP DELETE request to {HTTP_CONFIG.host}")
+    response, error = await client.delete(HTTP_CONFIG, HTTP_BIN_DELETE_URL)
 
     if error != RESPONSE_ERROR.OK:
-        print(f"Error: {error.name}. Failed at {cmd}")
+        print(f"Error: {error.name}. Failed at DELETE {HTTP_BIN_DELETE_URL}")
         return
 
-    # HTTP Query. This command performs HTTP GET, HEAD or DELETE requests to the server
-    cmd = HTTP_QRY_CMD_HEADER + PROFILE_ID + "," + HTTP_QRY_COMMNAND.DELETE + "," + HTTP_BIN_DELETE_URL
-    send_command(cmd)
-    response, error = wait_for_response('+SQNHTTPRING')
+    if response.status != HTTP_STATUS_OK:
+        print(f"HTTP Error: {response.status}")
+
+    print_json_response(response)
 
-    if error != RESPONSE_ERROR.OK:
-        print(f"Error: {error.name}. Failed at {cmd}")
-        return 
 
-    http_status_code = http_response_to_status_code(response)
-    if http_status_code != HTTP_STATUS_OK:
-        print(f"HTTP Error: {http_status_code}")
+async def http_get(client: HTTPClient):
 
-    # This command reads the HTTP response content data received with the last HTTP response (the HTTP
-    # response reception advertised by the +SQNHTTPRING notification)
-    cmd = HTTP_RCV_CMD_HEADER + PROFILE_ID
-    send_command(cmd)
-    response, error = wait_for_response('OK')
+    print(f"Sending HTTP GET request to {HTTP_CONFIG.host}")
+    response, error = await client.get(HTTP_CONFIG, HTTP_BIN_GET_URL)
 
     if error != RESPONSE_ERROR.OK:
-        print(f"Error: {error.name}. Failed at {cmd}")
+        print(f"Error: {error.name}. Failed at GET {HTTP_BIN_GET_URL}")
         return
 
-    response = response[:-2]  # remove trailing "OK"
-    response = response.strip("<<<")  # remove leading "<<<"
-    json_dict = json.loads(response)  # load data into dictionary
+    if response.status != HTTP_STATUS_OK:
+        print(f"HTTP Error: {response.status}")
 
-    print("\nReceived response:")
-    print("=================JSON RESPONSE=====================")
-    print(json.dumps(json_dict, sort_keys=False, indent=4))
-    print("===================================================")
+    print_json_response(response)
 
 
-def http_get():
+async def http_post(client: HTTPClient, message: str, forwarder: Optional[StoreAndForward] = None):
 
-    print(f"Sending HTTP GET request to {HTTP_URL}")
-    # HTTP configure command. This command sets the parameters needed to establish the HTTP connection
-    cmd = HTTP_CFG_CMD_HEADER + PROFILE_ID + "," + HTTP_URL + "," + HTTP_CFG_CMD_FOOTER
-    send_command(cmd)
-    response, error = wait_for_response('OK')
+    print(f"Sending HTTP POST request to {HTTP_CONFIG.host}")
+    body = HTTPBody(message)
+    response, error = await client.post(HTTP_CONFIG, HTTP_BIN_POST_URL, body)
 
     if error != RESPONSE_ERROR.OK:
-        print(f"Error: {error.name}. Failed at {cmd}")
+        print(f"Error: {error.name}. Failed at POST {HTTP_BIN_POST_URL}")
+        if forwarder is not None:
+            queue_request(forwarder, HTTP_SND_COMMAND.POST, HTTP_BIN_POST_URL, message)
         return
 
-    # HTTP Query. This command performs HTTP GET, HEAD or DELETE requests to the server
-    cmd = HTTP_QRY_CMD_HEADER + PROFILE_ID + "," + HTTP_QRY_COMMNAND.GET + "," + HTTP_BIN_GET_URL
-    send_command(cmd)
-    response, error = wait_for_response('+SQNHTTPRING')
+    if response.status != HTTP_STATUS_OK:
+        print(f"HTTP Error: {response.status}")
+        return
 
-    if error != RESPONSE_ERROR.OK:
-        print(f"Error: {error.name}. Failed at {cmd}")
-        return 
+    print_upload(body)
+    print_json_response(response)
 
-    http_status_code = http_response_to_status_code(response)
-    if http_status_code != HTTP_STATUS_OK:
-        print(f"HTTP Error: {http_status_code}")
 
-    # This command reads the HTTP response content data received with the last HTTP response (the HTTP
-    # response reception advertised by the +SQNHTTPRING notification)
-    cmd = HTTP_RCV_CMD_HEADER + PROFILE_ID
-    send_command(cmd)
-    response, error = wait_for_response('OK')
+async def http_post_file(client: HTTPClient, path: str):
 
-    if error != RESPONSE_ERROR.OK:
-        print(f"Error: {error.name}. Failed at {cmd}")
+    try:
+        file = open(path, "rb")
+    except OSError as e:
+        print(f"Error: cannot open {path}: {e}")
         return
 
-    response = response[:-2]  # remove trailing "OK"
-    response = response.strip("<<<")  # remove leading "<<<"
-    json_dict = json.loads(response)  # load data into dictionary
+    # The file is read in chunks while it is written to the modem, so it is never held in memory
+    with file:
+        body = HTTPBody(file)
+        print(f"Sending HTTP POST request with {body.length} bytes from {path} to {HTTP_CONFIG.host}")
+        response, error = await client.post(HTTP_CONFIG, HTTP_BIN_POST_URL, body)
 
-    print("\nReceived response:")
-    print("=================JSON RESPONSE=====================")
-    print(json.dumps(json_dict, sort_keys=False, indent=4))
-    print("===================================================")
+    if error != RESPONSE_ERROR.OK:
+        # Not journaled: the file is streamed, and the journal would have to hold all of it
+        print(f"Error: {error.name}. Failed at POST {HTTP_BIN_POST_URL}")
+        return
 
+    if response.status != HTTP_STATUS_OK:
+        print(f"HTTP Error: {response.status}")
+        return
 
-def http_post(message: str):
+    print_upload(body)
+    print(f"Received {response.length} byte response")
 
-    print(f"Sending HTTP POST request to {HTTP_URL}")
 
-    # HTTP configure command. This command sets the parameters needed to establish the HTTP connection
-    cmd = HTTP_CFG_CMD_HEADER + PROFILE_ID + "," + HTTP_URL + "," + HTTP_CFG_CMD_FOOTER
-    send_command(cmd)
-    response, error = wait_for_response('OK')
+async def http_put(client: HTTPClient, message: str, forwarder: Optional[StoreAndForward] = None):
 
-    if error != RESPONSE_ERROR.OK:
-        print(f"Error: {error.name}. Failed at {cmd}")
-        return
+    print(f"Sending HTTP PUT request to {HTTP_CONFIG.host}")
+    body = HTTPBody(message)
+    response, error = await client.put(HTTP_CONFIG, HTTP_BIN_PUT_URL, body)
 
-    # POST request to a HTTP server and sends it the data.
-    cmd = HTTP_SND_CMD_HEADER + PROFILE_ID + "," + HTTP_SND_COMMNAND.POST + "," + HTTP_BIN_POST_URL + "," + str(len(message))
-    send_command(cmd)
-    response, error = wait_for_response('>')
     if error != RESPONSE_ERROR.OK:
-        print(f"Error: {error.name}. Failed at {cmd}")
+        print(f"Error: {error.name}. Failed at PUT {HTTP_BIN_PUT_URL}")
+        if forwarder is not None:
+            queue_request(forwarder, HTTP_SND_COMMAND.PUT, HTTP_BIN_PUT_URL, message)
         return
 
-    send_command(message, False)
-    response, error = wait_for_response('+SQNHTTPRING')
-
-    if error != RESPONSE_ERROR.OK:
-        print(f"Error: {error.name}. Failed at {cmd}")
+    if response.status != HTTP_STATUS_OK:
+        print(f"HTTP Error: {response.status}")
         return
 
-    http_status_code = http_response_to_status_code(response)
-    if http_status_code != HTTP_STATUS_OK:
-        print(f"HTTP Error: {http_status_code}")
-        return
+    print_upload(body)
+    print_json_response(response)
 
-    # This command reads the HTTP response content data received with the last HTTP response (the HTTP
-    # response reception advertised by the +SQNHTTPRING notification)
-    cmd = HTTP_RCV_CMD_HEADER + PROFILE_ID
-    send_command(cmd)
-    response, error = wait_for_response('OK')
-    if error != RESPONSE_ERROR.OK:
-        print(f"Error: {error.name}. Failed at {cmd}")
 
-    response = response[:-2]  # remove trailing "OK"
-    response = response.strip("<<<")  # remove leading "<<<"
-    json_dict = json.loads(response)  # load data into dictionary
+def queue_request(forwarder: StoreAndForward, method: HTTP_SND_COMMAND, path: str, message: str):
 
-    print("\nReceived response:")
-    print("=================JSON RESPONSE=====================")
-    print(json.dumps(json_dict, sort_keys=False, indent=4))
-    print("===================================================")
+    if forwarder.queue_http(HTTP_CONFIG, method, path, message) is None:
+        print("Journal full, request dropped")
+        return
+    print(f"Request queued, {forwarder.pending} waiting for the network")
 
 
-def http_put(message: str):
+def print_upload(body: HTTPBody):
 
-    print(f"Sending HTTP PUT request to {HTTP_URL}")
+    print(f"Uploaded {body.bytes_sent} bytes in {body.elapsed:.2f} s ({body.bytes_per_second:.0f} bytes/s)")
 
-    # HTTP configure command. This command sets the parameters needed to establish the HTTP connection
-    cmd = HTTP_CFG_CMD_HEADER + PROFILE_ID + "," + HTTP_URL + "," + HTTP_CFG_CMD_FOOTER
-    send_command(cmd)
-    response, error = wait_for_response('OK')
 
-    if error != RESPONSE_ERROR.OK:
-        print(f"Error: {error.name}. Failed at {cmd}")
-        return
+def print_stats(engine: ATEngine, path: Optional[str]):
 
-    # PUT request to a HTTP server and sends it the data.
-    cmd = HTTP_SND_CMD_HEADER + PROFILE_ID + "," + HTTP_SND_COMMNAND.PUT + "," + HTTP_BIN_PUT_URL + "," + str(len(message))
-    send_command(cmd)
-    response, error = wait_for_response('>')
-    if error != RESPONSE_ERROR.OK:
-        print(f"Error: {error.name}. Failed at {cmd}")
+    if path is None:
+        engine.stats.print()
         return
-
-    send_command(message, False)
-    response, error = wait_for_response('+SQNHTTPRING')
-
-    if error != RESPONSE_ERROR.OK:
-        print(f"Error: {error.name}. Failed at {cmd}")
+    try:
+        engine.stats.write(path)
+    except OSError as e:
+        print(f"Error: cannot write {path}: {e}")
         return
+    print(f"Statistics written to {path}")
 
-    http_status_code = http_response_to_status_code(response)
-    if http_status_code != HTTP_STATUS_OK:
-        print(f"HTTP Error: {http_status_code}")
-        return
 
-    # This command reads the HTTP response content data received with the last HTTP response (the HTTP
-    # response reception advertised by the +SQNHTTPRING notification)
-    cmd = HTTP_RCV_CMD_HEADER + PROFILE_ID
-    send_command(cmd)
-    response, error = wait_for_response('OK')
-    if error != RESPONSE_ERROR.OK:
-        print(f"Error: {error.name}. Failed at {cmd}")
+def print_json_response(response: HTTPResponse):
 
-    response = response[:-2]  # remove trailing "OK"
-    response = response.strip("<<<")  # remove leading "<<<"
-    json_dict = json.loads(response)  # load data into dictionary
+    json_dict = json.loads(str(response.body, "utf-8"))  # load data into dictionary
 
     print("\nReceived response:")
     print("=================JSON RESPONSE=====================")
@@ -334,113 +260,57 @@ def http_put(message: str):
     print("===================================================")
 
 
-def http_response_to_status_code(http_response: str):
-
-    response_split = http_response.split(",")
-    status_code = response_split[1]
-    return status_code
+async def http_stream(client: HTTPClient, num_responses: int):
 
+    print(f"Sending HTTP STREAM test to {HTTP_CONFIG.host}, streaming {num_responses} chunks")
+    url = HTTP_BIN_STREAM_URL + "/" + str(num_responses)
+    async with client.stream(HTTP_CONFIG, url) as stream:
 
-def http_stream(num_responses: int):
-
-    print(f"Sending HTTP STREAM test to {HTTP_URL}, streaming {num_responses} chunks")
-    # HTTP configure command. This command sets the parameters needed to establish the HTTP connection
-    cmd = HTTP_CFG_CMD_HEADER + PROFILE_ID + "," + HTTP_URL + "," + HTTP_CFG_CMD_FOOTER
-    send_command(cmd)
-    response, error = wait_for_response('OK')
-
-    if error != RESPONSE_ERROR.OK:
-        print(f"Error: {error.name}. Failed at {cmd}")
-        return
-
-    # HTTP Query. This command performs HTTP GET, HEAD or DELETE requests to the server
-    cmd = HTTP_QRY_CMD_HEADER + PROFILE_ID + "," + HTTP_QRY_COMMNAND.GET + "," + HTTP_BIN_STREAM_URL + "/" + str(num_responses) + "\""
-    send_command(cmd)
-    response, error = wait_for_response('+SQNHTTPRING')
-
-    if error != RESPONSE_ERROR.OK:
-        print(f"Error: {error.name}. Failed at {cmd}")
-        return 
-
-    http_status_code = http_response_to_status_code(response)
-    if http_status_code != HTTP_STATUS_OK:
-        print(f"HTTP Error: {http_status_code}")
-
-    # This command reads the HTTP response content data received with the last HTTP response (the HTTP
-    # response reception advertised by the +SQNHTTPRING notification)
-    cmd = HTTP_RCV_CMD_HEADER + PROFILE_ID
-    send_command(cmd)
-    response, error = wait_for_response('OK')
-
-    if error != RESPONSE_ERROR.OK:
-        print(f"Error: {error.name}. Failed at {cmd}")
-        return
-
-    print("Stream test successful")
-
-
-def main(com_port: str, flow_cntrl: bool):
-
-    global serial_port
-    serial_port = open_serial_port(com_port, flow_cntrl)
-
-    cli_task = threading.Thread(target=get_user_input)
-    cli_task.daemon = True
-    cli_task.start()
+        if stream.error != RESPONSE_ERROR.OK:
+            print(f"Error: {stream.error.name}. Failed at GET {url}")
+            return
 
-    lte_rx_task = threading.Thread(target=get_lte_response)
-    lte_rx_task.daemon = True
-    lte_rx_task.start()
+        if stream.response.status != HTTP_STATUS_OK:
+            print(f"HTTP Error: {stream.response.status}")
 
-    command_handle_task = threading.Thread(target=handle_command)
-    command_handle_task.daemon = True
-    command_handle_task.start()
+        # httpbin sends one JSON document per line
+        async for record in stream.records():
+            print(f"Record {stream.records_received}: {len(json.loads(record))} fields")
 
-    while True:
-        # If one of the tasks exits, exit the application
-        if cli_task.is_alive() and lte_rx_task.is_alive() and command_handle_task.is_alive():
-            time.sleep(1)
-        else:
+        if stream.error != RESPONSE_ERROR.OK:
+            print(f"Error: {stream.error.name}. Failed at GET {url} after {stream.bytes_received} bytes")
             return
 
-
-def open_serial_port(com_port: str, flow_cntrl: bool) -> serial.Serial:
-    ser = serial.Serial()
-    ser.port = com_port
-    ser.baudrate = 115200
-    ser.rtscts = flow_cntrl
-    ser.timeout = 1
-    ser.open()
-    return ser
+    print(f"Stream test successful, received {stream.bytes_received} bytes, {stream.records_received} records "
+          f"in {stream.elapsed:.2f} s ({stream.bytes_per_second:.0f} bytes/s, "
+          f"{stream.records_per_second:.1f} records/s)")
 
 
-def send_command(command: str, add_terminator: bool = True):
-    print(f"\t--> Tx: {command}")
-    if add_terminator:
-        command += "\r"
-    # uncomment below to see raw data transmitted
-    # print(f"\t--> Tx:{command.encode()}")
-    serial_port.write(command.encode())
+async def main(com_port: str, flow_cntrl: bool, tracer: Tracer, capture: Optional[str] = None):
 
+    engine = ATEngine(open_serial_port(com_port, flow_cntrl, capture), tracer=tracer)
+    await engine.start()
 
-def wait_for_response(expected: str) -> Tuple[str, RESPONSE_ERROR]:
-    response = str()
-    response_buffer = str()
-    while True:
-        try:
-            response_buffer = serial_rx_q.get(timeout=30)
-        except queue.Empty:
-            return str(), RESPONSE_ERROR.TIMEOUT
+    client = HTTPClient(engine)
+    monitor = NetworkMonitor(engine)
+    error = await monitor.start()
+    if error != RESPONSE_ERROR.OK:
+        print(f"Error: {error.name}. Failed to read the network registration status")
+    # Failed commands are retried while the modem is registered, and fail at once while it is not
+    engine.retry = RetryPolicy(CircuitBreaker(monitor))
+    forwarder = StoreAndForward(monitor, Journal(JOURNAL_DIR), http_client=client)
+    await forwarder.start()
 
-        if expected in response_buffer:
-            response += response_buffer
-            return response, RESPONSE_ERROR.OK
-        elif "ERROR" in response_buffer:
-            return response, RESPONSE_ERROR.ERROR
-        elif "+CEREG" in response_buffer:
-            continue
+    user_command_q = asyncio.Queue()
+    cli_task = asyncio.create_task(get_user_input(user_command_q))
+    command_handle_task = asyncio.create_task(handle_command(client, user_command_q, forwarder))
 
-        response += response_buffer
+    # If one of the tasks exits, exit the application
+    done, pending = await asyncio.wait((cli_task, command_handle_task), return_when=asyncio.FIRST_COMPLETED)
+    for task in pending:
+        task.cancel()
+    await forwarder.stop()
+    await engine.stop()
 
 
 if __name__ == "__main__":
@@ -449,11 +319,14 @@ if __name__ == "__main__":
 
     parser.add_argument("com_port", type=str, help='COM port for your development kit')
     parser.add_argument("--flow_cntrl", action="store_true", help='Enable serial flow control')
+    add_trace_arguments(parser)
+    parser.add_argument("--capture", type=str, default=None,
+                        help='Record the UART traffic to this file, played back with replay://<file> as the COM port')
 
     args = parser.parse_args()
 
     try:
-        main(args.com_port, args.flow_cntrl)
+        asyncio.run(main(args.com_port, args.flow_cntrl, Tracer.from_args(args), args.capture))
     except KeyboardInterrupt:
         pass
 
@@ -1,14 +1,14 @@
 import argparse
-from enum import IntEnum
+import asyncio
 import json
-import queue
-import serial
-import threading
-from typing import Tuple
+import pathlib
+import sys
+from typing import Optional
 
-
-serial_port = serial.Serial()
-serial_rx_q = queue.Queue()
+# make the shared lte_ryz package importable when running the script from its own directory
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[2]))
+from lte_ryz import ATEngine, HTTPClient, HTTPConfig, RESPONSE_ERROR, open_serial_port  # noqa: E402
+from lte_ryz.trace import Tracer, add_trace_arguments  # noqa: E402
 
 
 '''
@@ -19,69 +19,26 @@ Please note that API requests by city name, zip-codes and city id have been depr
 Built-in API request by city name
 '''
 OPEN_WEATHER_API_KEY = ""  # Fill in your www.openweathermap.org API key here
-HTTP_GET_WEATHER_HEADER = "AT+SQNHTTPCFG=1,\"api.openweathermap.org/data/2.5/weather?appid=" + OPEN_WEATHER_API_KEY
-HTTP_GET = "AT+SQNHTTPQRY=1,0,\"/get\""
-HTTP_RCV = "AT+SQNHTTPRCV=1"
-HTTP_STATUS_OK = "200"
-
-
-class RESPONSE_ERROR(IntEnum):
-    OK = 0
-    ERROR = 1
-    TIMEOUT = 2
-
-
-def http_response_parse_status_code(http_response: str):
-
-    response_split = http_response.split(",")
-    status_code = response_split[1]
-    return status_code
+HTTP_WEATHER_HOST = "api.openweathermap.org/data/2.5/weather?appid=" + OPEN_WEATHER_API_KEY
+HTTP_GET_URL = "/get"
+HTTP_STATUS_OK = 200
 
 
-def get_lte_response():
-    while True:
-        received = serial_port.readline()
-        # uncomment below to see raw data received
-        # print(f"\t<-- Rx: {received}")
-        received = received.strip(b'\r\n')
-        if not received:
-            continue
-        print(f"\t<-- Rx: {received.decode()}")
-        serial_rx_q.put_nowait(received.decode())
-
-
-def get_weather(location: str, print_json: bool):
+async def get_weather(client: HTTPClient, location: str, print_json: bool):
     print(f"Requesting weather for {location} from openweathermap.org...\n")
 
-    cmd = HTTP_GET_WEATHER_HEADER + "&q=" + location + "\""
-    send_command(cmd)
-    response, error = wait_for_response("OK")
+    # The profile is only reconfigured when the location differs from the previous request
+    config = HTTPConfig(host=HTTP_WEATHER_HOST + "&q=" + location)
+    response, error = await client.get(config, HTTP_GET_URL)
     if error != RESPONSE_ERROR.OK:
-        print(f"Error: {error.name}. Failed at {cmd}")
+        print(f"Error: {error.name}. Failed at GET {config.host}")
         return
 
-    cmd = HTTP_GET
-    send_command(cmd)
-    response, error = wait_for_response("+SQNHTTPRING")
-    if error != RESPONSE_ERROR.OK:
-        print(f"Error: {error.name}. Failed at {cmd}")
+    if response.status != HTTP_STATUS_OK:
+        print(f"HTTP Error: {response.status}")
         return
 
-    http_status_code = http_response_parse_status_code(response)
-    if http_status_code != HTTP_STATUS_OK:
-        print(f"HTTP Error: {http_status_code}")
-        return
-
-    cmd = HTTP_RCV
-    send_command(cmd)
-    response, error = wait_for_response("OK")
-    if error != RESPONSE_ERROR.OK:
-        print(f"Error: {error.name}. Failed at {cmd}")
-        return
-
-    response = response[:-2]  # remove trailing "OK"
-    response = response.strip("<<<")  # remove leading "<<<"
-    json_dict = json.loads(response)  # load data into dictionary
+    json_dict = json.loads(str(response.body, "utf-8"))  # load data into dictionary
 
     if print_json:
         print("\nReceived weather data:")
@@ -100,57 +57,15 @@ def kelvin_to_fahrenheit(kelvin: int):
     return (9.0 / 5.0) * (kelvin - 273.15) + 32.0
 
 
-def main(com_port: str, location: str, flow_cntrl: bool, print_json: bool):
-
-    global serial_port
-    serial_port = open_serial_port(com_port, flow_cntrl)
-
-    lte_task = threading.Thread(target=get_lte_response)
-    lte_task.daemon = True
-    lte_task.start()
-
-    get_weather(location, print_json)
-
-
-def open_serial_port(com_port: str, flow_cntrl: bool) -> serial.Serial:
-    ser = serial.Serial()
-    ser.port = com_port
-    ser.baudrate = 115200
-    ser.rtscts = flow_cntrl
-    ser.timeout = 1
-    ser.open()
-    return ser
-
-
-def send_command(command: str):
-    print(f"\t--> Tx: {command}")
-    if command != "+++":
-        command += "\r"
-    # uncomment below to see raw data transmitted
-    # print(f"\t--> Tx:{command.encode()}")
-    serial_port.write(command.encode())
-
-
-def wait_for_response(expected: str) -> Tuple[str, RESPONSE_ERROR]:
-    response = str()
-    response_buffer = str()
-    while True:
-        try:
-            response_buffer = serial_rx_q.get(timeout=30)
-        except queue.Empty:
-            return str(), RESPONSE_ERROR.TIMEOUT
+async def main(com_port: str, location: str, flow_cntrl: bool, print_json: bool, tracer: Tracer,
+               capture: Optional[str] = None):
 
-        if expected in response_buffer:
+    engine = ATEngine(open_serial_port(com_port, flow_cntrl, capture), tracer=tracer)
+    await engine.start()
 
-            response += response_buffer
-            return response, RESPONSE_ERROR.OK
-        elif "ERROR" in response_buffer:
-            # print(f"ERROR in reponse")
-            return response, RESPONSE_ERROR.ERROR
-        elif "+CEREG" in response_buffer:
-            continue
+    await get_weather(HTTPClient(engine), location, print_json)
 
-        response += response_buffer
+    await engine.stop()
 
 
 if __name__ == "__main__":
@@ -160,12 +75,16 @@ if __name__ == "__main__":
     parser.add_argument("com_port", type=str, help='COM port for your development kit')
     parser.add_argument("location", type=str, nargs='+', help='Location to get weather from. Example: New York,NY,US')
     parser.add_argument("--flow_cntrl", action="store_true", help='Enable serial flow control')
+    add_trace_arguments(parser)
+    parser.add_argument("--capture", type=str, default=None,
+                        help='Record the UART traffic to this file, played back with replay://<file> as the COM port')
     parser.add_argument("--print_json", action="store_true", help='Print the raw JSON response from openweathermap.org')
 
     args = parser.parse_args()
 
     try:
         location = ' '.join(args.location)
-        main(args.com_port, location, args.flow_cntrl, args.print_json)
+        asyncio.run(main(args.com_port, location, args.flow_cntrl, args.print_json, Tracer.from_args(args),
+                         args.capture))
     except KeyboardInterrupt:
         pass
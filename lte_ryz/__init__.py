@@ -0,0 +1,19 @@
+from .capture import CaptureSerial, ReplaySession, read_capture
+from .engine import ALL_URCS, ATEngine, ATResponse, PayloadError, RESPONSE_ERROR, RxBlock, URC_PREFIXES
+from .forward import StoreAndForward
+from .framer import FRAME_TYPE, Frame, Framer
+from .http import (HTTP_QRY_COMMAND, HTTP_SND_COMMAND, HTTPBody, HTTPClient, HTTPConfig, HTTPResponse,
+                   HTTPRing, HTTPStream, http_receive, parse_http_ring)
+from .journal import JOURNAL_EVICTION, Journal
+from .mqtt import (QOS, MQTTClient, MQTTConfig, MQTTMessage, MQTTOnConnect, MQTTOnMessage, MQTTOnPublish,
+                   MQTTOnSubscribe, MQTTOnUnsubscribe, MQTTPublisher, MQTTPublishResult, MQTTSubscriber, TopicTrie)
+from .network import REGISTRATION_STATUS, CEREGNotification, CEREGStatus, NetworkMonitor
+from .port import open_serial_port
+from .records import RECORDS, Field, Record, parse_record
+from .retry import BREAKER_STATE, FAILURE, CircuitBreaker, RetryPolicy, classify
+from .simulator import ModemSimulator, SimulatorConfig
+from .sockets import (SOCKET_STATE, TRANSMISSION_PROTOCOL, ModemSocket, OnlineSocket, SocketManager, SocketStatus,
+                      UDPBatcher, UDPSocket, pack_messages, parse_socket_status, socket_receive, unpack_messages)
+from .stats import CommandStats, LatencyHistogram
+from .timeouts import TIMEOUT_PHASE, TimeoutPolicy
+from .trace import TRACE_LEVEL, BinaryLogSink, ConsoleSink, Tracer, read_trace
@@ -0,0 +1,184 @@
+import struct
+import threading
+import time
+from typing import Iterator, List, Optional, Tuple
+
+from .trace import TRACE_DIRECTION
+
+
+# Capture file: CAPTURE_MAGIC, then a CAPTURE_RECORD header and the data for every write to and read from
+# the port. The header holds the microseconds since the previous record, the direction and the data length
+CAPTURE_MAGIC = b"RYZCAP\x01\n"
+CAPTURE_RECORD = struct.Struct("<IBI")
+CAPTURE_MAX_GAP = 0xFFFFFFFF
+
+# Replay speed that releases the captured data as soon as the host has written what preceded it
+REPLAY_MAX_SPEED = 0.0
+
+
+class CaptureSerial:
+    # Wraps the port returned by open_serial_port() and appends every byte written to and read from it to a
+    # capture file, which a replay:// port plays back. Everything else is passed to the wrapped port.
+    # The reader and writer threads both record, under a lock. Records are flushed as they are written,
+    # since the scripts never close their port
+
+    def __init__(self, port, path: str):
+        self.port = port
+        self.path = path
+        self.records = 0
+        self.bytes_captured = 0
+        self._lock = threading.Lock()
+        self._file = open(path, "wb")
+        self._file.write(CAPTURE_MAGIC)
+        self._last = time.monotonic()
+
+    def __getattr__(self, name: str):
+        return getattr(self.port, name)
+
+    def read(self, size: int = 1) -> bytes:
+        data = self.port.read(size)
+        self._capture(TRACE_DIRECTION.RX, data)
+        return data
+
+    def readinto(self, buffer) -> int:
+        received = self.port.readinto(buffer)
+        if received:
+            self._capture(TRACE_DIRECTION.RX, bytes(buffer[:received]))
+        return received
+
+    def readline(self, *args, **kwargs) -> bytes:
+        data = self.port.readline(*args, **kwargs)
+        self._capture(TRACE_DIRECTION.RX, data)
+        return data
+
+    def write(self, data) -> int:
+        # Recorded before the write, so the response can never be captured ahead of the command
+        self._capture(TRACE_DIRECTION.TX, bytes(data))
+        return self.port.write(data)
+
+    def close(self):
+        self.port.close()
+        with self._lock:
+            self._file.close()
+
+    def _capture(self, direction: TRACE_DIRECTION, data: bytes):
+        if not data:
+            return
+        with self._lock:
+            if self._file.closed:
+                return
+            now = time.monotonic()
+            gap = min(round((now - self._last) * 1000000), CAPTURE_MAX_GAP)
+            self._last = now
+            self._file.write(CAPTURE_RECORD.pack(gap, direction, len(data)) + data)
+            self._file.flush()
+            self.records += 1
+            self.bytes_captured += len(data)
+
+
+def read_capture(path: str) -> Iterator[Tuple[float, TRACE_DIRECTION, bytes]]:
+    # Yields (seconds since the start of the capture, direction, data)
+    with open(path, "rb") as f:
+        if f.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise ValueError(f"{path} is not a capture file")
+        elapsed = 0.0
+        while True:
+            header = f.read(CAPTURE_RECORD.size)
+            if len(header) < CAPTURE_RECORD.size:
+                return
+            gap, direction, length = CAPTURE_RECORD.unpack(header)
+            elapsed += gap / 1000000
+            yield elapsed, TRACE_DIRECTION(direction), f.read(length)
+
+
+class ReplaySession:
+    # Plays the received side of a capture back to the host. A block the modem sent is released once the
+    # host has written as many bytes as it had when the block was captured, and once the time between the
+    # block and the record before it has passed, divided by speed. REPLAY_MAX_SPEED releases it as soon as
+    # the writes allow. Replaying the script that made the capture therefore always sees the responses in
+    # the same order, however fast it runs. Counters use the names of the simulator's
+    # (see ModemSimulator), seen from the modem side
+
+    def __init__(self, path: str, speed: float = 1.0):
+        self.path = path
+        self.speed = speed
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self.commands_received = 0
+        # Offset of the first written byte that differs from the capture, None while the host writes what
+        # was captured
+        self.diverged: Optional[int] = None
+        # (seconds after the previous record, bytes written before it, data)
+        self._blocks: List[Tuple[float, int, bytes]] = []
+        self._expected = bytearray()
+        previous = 0.0
+        for elapsed, direction, data in read_capture(path):
+            if direction == TRACE_DIRECTION.TX:
+                self._expected += data
+            else:
+                self._blocks.append((elapsed - previous, len(self._expected), data))
+            previous = elapsed
+        self._next = 0
+        self._pending = bytearray()
+        self._last_event = time.monotonic()
+        self._condition = threading.Condition()
+
+    @property
+    def finished(self) -> bool:
+        with self._condition:
+            return self._next == len(self._blocks) and not self._pending
+
+    @property
+    def in_waiting(self) -> int:
+        with self._condition:
+            self._release()
+            return len(self._pending)
+
+    def read(self, size: int, timeout: Optional[float]) -> bytes:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while not self._pending:
+                wait = self._release()
+                if self._pending:
+                    break
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return b""
+                    wait = remaining if wait is None else min(wait, remaining)
+                self._condition.wait(wait)
+            data = bytes(self._pending[:size])
+            del self._pending[:size]
+            self.bytes_sent += len(data)
+            return data
+
+    def write(self, data: bytes) -> int:
+        with self._condition:
+            offset = self.bytes_received
+            if self.diverged is None and self._expected[offset:offset + len(data)] != data:
+                self.diverged = offset
+            self.bytes_received += len(data)
+            self.commands_received += data.count(b"\r")
+            self._last_event = time.monotonic()
+            self._condition.notify_all()
+        return len(data)
+
+    def reset_input_buffer(self):
+        with self._condition:
+            self._pending.clear()
+
+    def _release(self) -> Optional[float]:
+        # Moves the blocks that are due to the pending data. Returns the seconds until the next block is due,
+        # or None when it waits for the host to write or the capture is over
+        now = time.monotonic()
+        while self._next < len(self._blocks):
+            gap, written, data = self._blocks[self._next]
+            if self.bytes_received < written:
+                return None
+            due = self._last_event + gap / self.speed if self.speed > REPLAY_MAX_SPEED else now
+            if due > now:
+                return due - now
+            self._pending += data
+            self._last_event = due
+            self._next += 1
+        return None
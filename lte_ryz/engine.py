@@ -0,0 +1,603 @@
+import asyncio
+import collections
+import concurrent.futures
+from dataclasses import dataclass, field
+from enum import IntEnum
+import itertools
+import threading
+import time
+from typing import TYPE_CHECKING, Callable, Deque, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import serial
+
+from .framer import FINAL_RESULT_CONNECT, FINAL_RESULT_NO_CARRIER, FINAL_RESULT_OK, FRAME_TYPE, Frame, Framer
+from .stats import LINE_OVERHEAD, CommandStats
+from .timeouts import TIMEOUT_PHASE, TimeoutPolicy
+from .trace import Tracer
+
+if TYPE_CHECKING:
+    # retry builds on the engine and the network monitor
+    from .retry import RetryPolicy
+
+
+class RESPONSE_ERROR(IntEnum):
+    OK = 0
+    ERROR = 1
+    TIMEOUT = 2
+
+
+class PayloadError(ValueError):
+    # Raised by the data of a command when it ends before the length given in the command
+
+    def __init__(self, written: int, length: int):
+        super().__init__(f"Data ended after {written} of {length} bytes")
+        self.written = written
+        self.length = length
+
+
+# Unsolicited result codes. These are routed to subscribers instead of the command in flight,
+# unless the command in flight is the one that reports them (e.g. AT+CEREG? answers with +CEREG)
+URC_PREFIXES = ("+CEREG",
+                "+SQNHTTPRING",
+                "+SQNHTTPSH",
+                "+SQNSRING",
+                "+SQNSH",
+                "+SQNSMQTTONCONNECT",
+                "+SQNSMQTTONDISCONNECT",
+                "+SQNSMQTTONPUBLISH",
+                "+SQNSMQTTONMESSAGE",
+                "+SQNSMQTTONSUBSCRIBE",
+                "+SQNSMQTTONUNSUBSCRIBE",
+                "+SYSSTART"
+                )
+
+# Subscribe with this prefix to receive every URC
+ALL_URCS = "*"
+
+DEFAULT_TIMEOUT = 30
+
+# Number of commands command_batch() writes ahead of the one whose result it is waiting for
+PIPELINE_WINDOW = 4
+
+# Largest single write to the UART. With RTS/CTS enabled each write blocks the writer thread while the
+# modem holds CTS, so long payloads are paced by the modem rather than buffered by the OS
+TX_CHUNK_SIZE = 1024
+
+# Silence the modem requires before and after the +++ escape sequence (S12 register, 1 s by default)
+ESCAPE_GUARD_TIME = 1.0
+ESCAPE_SEQUENCE = b"+++"
+
+UrcCallback = Callable[[Frame], None]
+# Receives the bytes that arrive in online mode, then None if the connection is closed (NO CARRIER)
+StreamSink = Callable[[Optional[bytes]], None]
+UrcMatch = Callable[[Frame], bool]
+
+
+@dataclass
+class ATResponse:
+    command: str
+    lines: List[Frame] = field(default_factory=list)
+    final: Optional[Frame] = None
+    # URC that completed the transaction, for commands whose result is reported asynchronously
+    urc: Optional[Frame] = None
+    # Binary block returned by the command, e.g. the payload of AT+SQNSRECV
+    data: Optional[memoryview] = None
+
+    @property
+    def text(self) -> str:
+        return "\n".join(line.text for line in self.lines)
+
+
+@dataclass
+class RxBlock:
+    # Binary block expected in the response of a command. See Framer.expect_block
+    length: Optional[int] = None
+    header: Optional[bytes] = None
+    marker: Optional[bytes] = None
+    into: Optional[memoryview] = None
+    length_field: int = -1
+
+
+class _PendingCommand:
+
+    def __init__(self, command: str, loop: asyncio.AbstractEventLoop, expect_prompt: bool):
+        self.command = command
+        self.echo = command.encode()
+        self.verb = command_verb(command).encode()
+        self.response = ATResponse(command)
+        self.expect_prompt = expect_prompt
+        self.prompt = loop.create_future()
+        self.done = loop.create_future()
+        # time.monotonic() when the command was written, its first response frame was read and its final
+        # result was read, and the bytes it moved across the UART
+        self.sent: Optional[float] = None
+        self.first: Optional[float] = None
+        self.finished: Optional[float] = None
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.echoed = False
+
+    def received(self, frame: Frame, received: float, overhead: int = LINE_OVERHEAD):
+        if self.first is None:
+            self.first = received
+        self.bytes_in += len(frame.data) + overhead
+
+
+class _UrcWaiter:
+
+    def __init__(self, prefix: bytes, match: Optional[UrcMatch], future: asyncio.Future):
+        self.prefix = prefix
+        self.match = match
+        self.future = future
+
+
+def command_verb(command: str) -> str:
+    # "AT+SQNHTTPCFG=1,..." -> "+SQNHTTPCFG", "AT+CEREG?" -> "+CEREG"
+    verb = command[2:] if command[:2].upper() == "AT" else command
+    for separator in "=?":
+        verb = verb.split(separator, 1)[0]
+    return verb
+
+
+class ATEngine:
+
+    def __init__(self, port: serial.Serial,
+                 urc_prefixes: Tuple[str, ...] = URC_PREFIXES,
+                 window: int = PIPELINE_WINDOW,
+                 tracer: Optional[Tracer] = None,
+                 stats: Optional[CommandStats] = None,
+                 timeouts: Optional[TimeoutPolicy] = None,
+                 retry: Optional["RetryPolicy"] = None):
+        # UART traffic is traced to the console unless another tracer is given
+        self.tracer = tracer if tracer is not None else Tracer.console()
+        # Latency and throughput of every transaction, per command verb
+        self.stats = stats if stats is not None else CommandStats()
+        # How long each phase of a transaction is waited for, learned per command verb
+        self.timeouts = timeouts if timeouts is not None else TimeoutPolicy()
+        # Failed transactions are retried when a policy is set. None fails them at once
+        self.retry = retry
+        self._port = port
+        self._window = window
+        # Whether the modem echoes commands (ATE1, its default), learned from the last response. None until known
+        self._echo: Optional[bool] = None
+        self._framer = Framer(urc_prefixes)
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._reader: Optional[threading.Thread] = None
+        self._running = threading.Event()
+        # A single writer thread keeps the UART writes ordered without blocking the event loop
+        self._tx = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="at-tx")
+        self._command_lock = asyncio.Lock()
+        # Commands written to the modem and not yet terminated by a final result code, oldest first. The
+        # modem answers in order, so every response line belongs to the head of the queue
+        self._in_flight: Deque[_PendingCommand] = collections.deque()
+        self._subscribers: Dict[bytes, List[UrcCallback]] = {}
+        self._waiters: List[_UrcWaiter] = []
+        # Set while the modem is in online mode. No commands can be issued until it is escaped
+        self._stream_sink: Optional[StreamSink] = None
+
+    @property
+    def online(self) -> bool:
+        return self._stream_sink is not None
+
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._running.set()
+        self.tracer.start()
+        self._reader = threading.Thread(target=self._read_loop, daemon=True)
+        self._reader.start()
+
+    async def stop(self):
+        self._running.clear()
+        if self._reader is not None:
+            await self._loop.run_in_executor(None, self._reader.join)
+        self._tx.shutdown(wait=True)
+        # Flushes the trace still in memory
+        self.tracer.stop()
+
+    def subscribe(self, prefix: str, callback: UrcCallback):
+        self._subscribers.setdefault(prefix.encode(), []).append(callback)
+
+    def unsubscribe(self, prefix: str, callback: UrcCallback):
+        callbacks = self._subscribers.get(prefix.encode(), [])
+        if callback in callbacks:
+            callbacks.remove(callback)
+
+    def expect_urc(self, prefix: str, match: Optional[UrcMatch] = None) -> asyncio.Future:
+        # Register interest in a URC before issuing the command that triggers it, so a URC arriving
+        # right behind the final result code cannot be missed
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append(_UrcWaiter(prefix.encode(), match, future))
+        return future
+
+    async def wait_urc(self, urc: str | asyncio.Future,
+                       timeout: float = DEFAULT_TIMEOUT,
+                       match: Optional[UrcMatch] = None,
+                       verb: Optional[str] = None) -> Tuple[Optional[Frame], RESPONSE_ERROR]:
+        # verb is the command whose transaction the URC completes, called right after the command. The wait
+        # is then also bounded by the URC timeout learned for it, and its latency is recorded
+        future = self.expect_urc(urc, match) if isinstance(urc, str) else urc
+        start = time.monotonic()
+        if verb is not None:
+            timeout = self.timeouts.timeout(verb, TIMEOUT_PHASE.URC, timeout)
+        try:
+            frame = await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            self.cancel_urc(future)
+            if verb is not None:
+                self.timeouts.expired(verb, TIMEOUT_PHASE.URC)
+            return None, RESPONSE_ERROR.TIMEOUT
+        if verb is not None:
+            # The network part of the transaction, e.g. AT+SQNHTTPQRY OK -> +SQNHTTPRING
+            self.stats.record_urc(verb, time.monotonic() - start)
+            self.timeouts.observe(verb, TIMEOUT_PHASE.URC, time.monotonic() - start)
+        return frame, RESPONSE_ERROR.OK
+
+    async def command(self, command: str,
+                      timeout: float = DEFAULT_TIMEOUT,
+                      data: Optional[bytes | Iterable[bytes]] = None,
+                      urc: Optional[str] = None,
+                      urc_match: Optional[UrcMatch] = None,
+                      block: Optional[RxBlock] = None) -> Tuple[ATResponse, RESPONSE_ERROR]:
+        # Issue a command and wait for its final result code.
+        # If data is given, it is written once the modem shows the '>' prompt. data can also be an iterable
+        # of chunks, which is consumed on the writer thread so a file can be sent without reading it into
+        # memory first.
+        # If urc is given, the transaction also waits for that URC.
+        # If block is given, the binary block in the response is returned in ATResponse.data.
+        # timeout is the deadline of the whole transaction, counted once the command has the UART; each
+        # phase is also bounded by the timeout learned for the verb (see TimeoutPolicy). With a retry
+        # policy, the transaction is repeated within the same deadline when it failed for a reason that
+        # can go away
+        if self.retry is None:
+            pending, error = await self._transaction(command, timeout, data, urc, urc_match, block)
+            return pending.response, error
+
+        # A payload that was written can only be written again if it is not an iterator
+        replayable = data is None or isinstance(data, (bytes, bytearray, memoryview))
+        verb = command_verb(command)
+        deadline: Optional[float] = None
+        for attempt in itertools.count():
+            if not self.retry.allow(verb):
+                return ATResponse(command), RESPONSE_ERROR.ERROR
+            attempt_timeout = timeout if deadline is None else max(0.0, deadline - self._loop.time())
+            pending, error = await self._transaction(command, attempt_timeout, data, urc, urc_match, block)
+            if deadline is None:
+                # Counted from the first attempt getting the UART, as without retries
+                deadline = (pending.sent or self._loop.time()) + timeout
+            payload_written = pending.prompt.done()
+            if (not self.retry.retryable(verb, pending.response, error, attempt, payload_written)
+                    or (payload_written and not replayable)
+                    or not await self.retry.backoff(attempt, deadline - self._loop.time())):
+                return pending.response, error
+            self.stats.record_retry(verb)
+
+    async def _transaction(self, command: str,
+                           timeout: float,
+                           data: Optional[bytes | Iterable[bytes]],
+                           urc: Optional[str],
+                           urc_match: Optional[UrcMatch],
+                           block: Optional[RxBlock]) -> Tuple[_PendingCommand, RESPONSE_ERROR]:
+        if self.online:
+            return _PendingCommand(command, self._loop, False), RESPONSE_ERROR.ERROR
+        urc_future = self.expect_urc(urc, urc_match) if urc else None
+
+        async with self._command_lock:
+            deadline = self._loop.time() + timeout
+            pending = _PendingCommand(command, self._loop, data is not None)
+            self._in_flight.append(pending)
+            if data is not None:
+                self._framer.expect_prompt()
+            if block is not None:
+                # A block without header or marker is anchored on the echo, unless the modem is known not to echo
+                self._framer.expect_block(block.length, block.header, block.marker, block.into, block.length_field,
+                                          echo=pending.echo if self._echo is not False else None)
+            try:
+                await self._write_commands([pending])
+                error = RESPONSE_ERROR.OK
+                if data is not None:
+                    error = await self._wait_prompt(pending, self._response_timeout(pending, deadline))
+                    if error == RESPONSE_ERROR.OK:
+                        chunks = [data] if isinstance(data, (bytes, bytearray, memoryview)) else data
+                        try:
+                            pending.bytes_out += await self.write_chunks(chunks)
+                        except PayloadError as e:
+                            # The data is padded to the announced length so the modem leaves the prompt and
+                            # answers. The command is reported failed, though the modem may act on the padding
+                            padding = e.length - e.written
+                            pending.bytes_out += e.written + await self.write_chunks([bytes(padding)])
+                            await self._wait_done(pending, self._response_timeout(pending, deadline))
+                            error = RESPONSE_ERROR.ERROR
+                if error == RESPONSE_ERROR.OK:
+                    error = await self._wait_done(pending, self._response_timeout(pending, deadline))
+            finally:
+                self._in_flight.clear()
+                self._framer.cancel()
+            self._record_stats(pending, error)
+
+        if urc_future is None:
+            return pending, error
+        if error != RESPONSE_ERROR.OK:
+            self.cancel_urc(urc_future)
+            return pending, error
+
+        pending.response.urc, error = await self.wait_urc(urc_future, max(0.0, deadline - self._loop.time()),
+                                                          verb=pending.verb.decode())
+        return pending, error
+
+    async def command_batch(self, commands: Sequence[str],
+                            timeout: float = DEFAULT_TIMEOUT,
+                            window: Optional[int] = None,
+                            dependent: bool = False) -> List[Tuple[ATResponse, RESPONSE_ERROR]]:
+        # Issue independent commands back to back, keeping up to `window` of them in flight, so the UART
+        # round trip is paid once per batch rather than once per command. Results are returned in
+        # command order. Commands that need a prompt, a binary block or a URC go through command(). timeout
+        # is the deadline of the whole batch.
+        # With dependent, each command relies on the ones before it having succeeded (a configuration and
+        # the command using it). They are written one at a time under the same lock, so no other command
+        # runs between them, and the commands after the first failed one are returned as ERROR without
+        # being sent.
+        # With a retry policy, the batch is issued again from its first failed command when that failure
+        # can go away and every command from there on is idempotent
+        if self.retry is None:
+            results, started = await self._command_batch(commands, timeout, window, dependent)
+            return results
+
+        verbs = [command_verb(command) for command in commands]
+        deadline: Optional[float] = None
+        results: List[Tuple[ATResponse, RESPONSE_ERROR]] = []
+        for attempt in itertools.count():
+            remaining = commands[len(results):]
+            if not all(self.retry.allow(verb) for verb in verbs[len(results):]):
+                return results + [(ATResponse(command), RESPONSE_ERROR.ERROR) for command in remaining]
+            attempt_timeout = timeout if deadline is None else max(0.0, deadline - self._loop.time())
+            batch, started = await self._command_batch(remaining, attempt_timeout, window, dependent)
+            if deadline is None:
+                deadline = started + timeout
+            failed = next((index for index, (response, error) in enumerate(batch) if error != RESPONSE_ERROR.OK),
+                          None)
+            # The commands a dependent batch did not send tell nothing about the modem
+            sent = batch[:failed + 1] if dependent and failed is not None else batch
+            retryable = [self.retry.retryable(verb, response, error, attempt)
+                         for verb, (response, error) in zip(verbs[len(results):], sent)]
+            if (failed is None or not retryable[failed]
+                    or not self.retry.idempotent_verbs.issuperset(verbs[len(results) + failed + 1:])
+                    or not await self.retry.backoff(attempt, deadline - self._loop.time())):
+                return results + batch
+            self.stats.record_retry(verbs[len(results) + failed])
+            results += batch[:failed]
+
+    async def _command_batch(self, commands: Sequence[str],
+                             timeout: float,
+                             window: Optional[int],
+                             dependent: bool) -> Tuple[List[Tuple[ATResponse, RESPONSE_ERROR]], float]:
+        # Also returns the loop time the batch got the UART, from which its deadline runs
+        if self.online:
+            return [(ATResponse(command), RESPONSE_ERROR.ERROR) for command in commands], self._loop.time()
+        window = 1 if dependent else window or self._window
+        pending_commands = [_PendingCommand(command, self._loop, False) for command in commands]
+        results: List[Tuple[ATResponse, RESPONSE_ERROR]] = []
+        # Result of the commands left when the batch stops early. A dependent batch has not written them
+        unanswered = RESPONSE_ERROR.ERROR if dependent else RESPONSE_ERROR.TIMEOUT
+
+        async with self._command_lock:
+            deadline = self._loop.time() + timeout
+            written = 0
+            try:
+                for pending in pending_commands:
+                    burst = pending_commands[written:len(results) + window]
+                    if burst:
+                        self._in_flight.extend(burst)
+                        await self._write_commands(burst)
+                        written += len(burst)
+
+                    error = await self._wait_done(pending, self._response_timeout(pending, deadline))
+                    self._record_stats(pending, error)
+                    results.append((pending.response, error))
+                    if error == RESPONSE_ERROR.TIMEOUT:
+                        # Responses can no longer be matched to commands
+                        break
+                    if error != RESPONSE_ERROR.OK and dependent:
+                        break
+            finally:
+                self._in_flight.clear()
+
+        for pending in pending_commands[len(results):]:
+            results.append((pending.response, unanswered))
+        return results, deadline - timeout
+
+    async def enter_online_mode(self, command: str, sink: StreamSink,
+                                timeout: float = DEFAULT_TIMEOUT) -> Tuple[ATResponse, RESPONSE_ERROR]:
+        # Issue a command answered with CONNECT (AT+SQNSD in online mode, AT+SQNSO). From then on the UART
+        # carries the socket data: received bytes go to sink, write() sends to the remote end
+        if self.online:
+            return ATResponse(command), RESPONSE_ERROR.ERROR
+        async with self._command_lock:
+            deadline = self._loop.time() + timeout
+            pending = _PendingCommand(command, self._loop, False)
+            self._in_flight.append(pending)
+            self._stream_sink = sink
+            self._framer.expect_connect()
+            try:
+                await self._write_commands([pending])
+                error = await self._wait_done(pending, self._response_timeout(pending, deadline))
+            finally:
+                self._in_flight.clear()
+                self._framer.cancel()
+            self._record_stats(pending, error)
+            if error != RESPONSE_ERROR.OK or pending.response.final.data != FINAL_RESULT_CONNECT:
+                self._stream_sink = None
+                if error == RESPONSE_ERROR.OK:
+                    error = RESPONSE_ERROR.ERROR
+        return pending.response, error
+
+    async def escape_online_mode(self, guard_time: float = ESCAPE_GUARD_TIME,
+                                 timeout: float = DEFAULT_TIMEOUT) -> RESPONSE_ERROR:
+        # Return to command mode with the +++ escape sequence. The connection stays open and can be resumed
+        # (AT+SQNSO). Data that arrives before the modem acknowledges the escape still goes to the sink
+        if not self.online:
+            return RESPONSE_ERROR.OK
+        async with self._command_lock:
+            pending = _PendingCommand(ESCAPE_SEQUENCE.decode(), self._loop, False)
+            await asyncio.sleep(guard_time)
+            self._in_flight.append(pending)
+            self._framer.expect_escape()
+            try:
+                self.tracer.tx_commands([pending.command], ESCAPE_SEQUENCE)
+                pending.sent = time.monotonic()
+                pending.bytes_out = len(ESCAPE_SEQUENCE)
+                await self.write(ESCAPE_SEQUENCE)
+                # The guard time after the escape is part of the response time learned for it
+                deadline = self._loop.time() + guard_time + timeout
+                error = await self._wait_done(pending, self._response_timeout(pending, deadline))
+            finally:
+                self._in_flight.clear()
+            self._record_stats(pending, error)
+            if not self._framer.online:
+                self._stream_sink = None
+        return error
+
+    async def write(self, data: bytes):
+        await self._loop.run_in_executor(self._tx, self._port.write, data)
+
+    async def write_chunks(self, chunks: Iterable[bytes]) -> int:
+        # Returns the number of bytes written
+        return await self._loop.run_in_executor(self._tx, self._write_chunks, chunks)
+
+    def _write_chunks(self, chunks: Iterable[bytes]) -> int:
+        written = 0
+        for chunk in chunks:
+            self.tracer.tx_payload(chunk)
+            chunk = memoryview(chunk)
+            for offset in range(0, len(chunk), TX_CHUNK_SIZE):
+                self._port.write(chunk[offset:offset + TX_CHUNK_SIZE])
+            written += len(chunk)
+        return written
+
+    async def _write_commands(self, pending_commands: Sequence[_PendingCommand]):
+        commands = [pending.command for pending in pending_commands]
+        data = "".join(command + "\r" for command in commands).encode()
+        self.tracer.tx_commands(commands, data)
+        sent = time.monotonic()
+        for pending in pending_commands:
+            pending.sent = sent
+            pending.bytes_out += len(pending.command) + 1
+        await self.write(data)
+
+    def _record_stats(self, pending: _PendingCommand, error: RESPONSE_ERROR):
+        if pending.finished is None:
+            pending.finished = time.monotonic()
+        verb = pending.verb.decode()
+        self.stats.record(verb, pending.sent, pending.first, pending.finished,
+                          pending.bytes_out, pending.bytes_in, error)
+        if error == RESPONSE_ERROR.TIMEOUT:
+            self.timeouts.expired(verb, TIMEOUT_PHASE.RESPONSE)
+        elif pending.sent is not None:
+            self.timeouts.observe(verb, TIMEOUT_PHASE.RESPONSE, pending.finished - pending.sent)
+
+    def _response_timeout(self, pending: _PendingCommand, deadline: float) -> float:
+        return self.timeouts.timeout(pending.verb.decode(), TIMEOUT_PHASE.RESPONSE,
+                                     max(0.0, deadline - self._loop.time()))
+
+    async def _wait_prompt(self, pending: _PendingCommand, timeout: float) -> RESPONSE_ERROR:
+        # Either the prompt shows up or the command is rejected with a final result code
+        done, _ = await asyncio.wait((pending.prompt, pending.done), timeout=timeout,
+                                     return_when=asyncio.FIRST_COMPLETED)
+        if pending.prompt in done:
+            return RESPONSE_ERROR.OK
+        if pending.done in done:
+            return RESPONSE_ERROR.ERROR
+        return RESPONSE_ERROR.TIMEOUT
+
+    async def _wait_done(self, pending: _PendingCommand, timeout: float) -> RESPONSE_ERROR:
+        try:
+            return await asyncio.wait_for(asyncio.shield(pending.done), timeout)
+        except asyncio.TimeoutError:
+            return RESPONSE_ERROR.TIMEOUT
+
+    def cancel_urc(self, future: asyncio.Future):
+        self._waiters = [waiter for waiter in self._waiters if waiter.future is not future]
+        future.cancel()
+
+    def _read_loop(self):
+        while self._running.is_set():
+            try:
+                frames = self._framer.read_from(self._port)
+            except serial.SerialException as e:
+                print(f"Serial port error: {e}")
+                return
+            if frames:
+                # Frames are timed when read, not when the event loop gets to them
+                received = time.monotonic()
+                self.tracer.rx_frames(frames)
+                self._loop.call_soon_threadsafe(self._on_frames, frames, received)
+
+    def _on_frames(self, frames: List[Frame], received: float):
+        for frame in frames:
+            self._on_frame(frame, received)
+
+    def _on_frame(self, frame: Frame, received: float):
+        pending = self._in_flight[0] if self._in_flight else None
+
+        match frame.type:
+            case FRAME_TYPE.PROMPT:
+                if pending is not None and not pending.prompt.done():
+                    pending.received(frame, received, overhead=1)
+                    pending.prompt.set_result(frame)
+
+            case FRAME_TYPE.DATA:
+                if pending is not None:
+                    pending.received(frame, received, overhead=0)
+                    pending.response.data = frame.data
+
+            case FRAME_TYPE.STREAM:
+                if self._stream_sink is not None:
+                    self._stream_sink(frame.data)
+
+            case FRAME_TYPE.RESULT:
+                if (self._stream_sink is not None and frame.data == FINAL_RESULT_NO_CARRIER
+                        and (pending is None or pending.echo == ESCAPE_SEQUENCE)):
+                    # The connection was closed and the modem is back in command mode
+                    sink = self._stream_sink
+                    self._stream_sink = None
+                    sink(None)
+                if pending is not None:
+                    self._in_flight.popleft()
+                    pending.received(frame, received)
+                    pending.finished = received
+                    pending.response.final = frame
+                    self._echo = pending.echoed
+                    ok = frame.data in (FINAL_RESULT_OK, FINAL_RESULT_CONNECT)
+                    pending.done.set_result(RESPONSE_ERROR.OK if ok else RESPONSE_ERROR.ERROR)
+
+            case FRAME_TYPE.URC:
+                prefix = frame.prefix
+                if pending is not None and prefix == pending.verb:
+                    # e.g. AT+CEREG? answers with +CEREG
+                    pending.received(frame, received)
+                    pending.response.lines.append(frame)
+                else:
+                    self.stats.urc_received(prefix.decode(), received)
+                    self._dispatch_urc(prefix, frame)
+
+            case FRAME_TYPE.LINE:
+                if pending is None:
+                    self._dispatch_urc(frame.prefix, frame)
+                else:
+                    pending.received(frame, received)
+                    if frame.data == pending.echo:
+                        pending.echoed = True
+                    else:
+                        pending.response.lines.append(frame)
+
+    def _dispatch_urc(self, prefix: bytes, frame: Frame):
+        for callback in self._subscribers.get(prefix, []) + self._subscribers.get(ALL_URCS.encode(), []):
+            callback(frame)
+
+        # A URC completes at most one waiter, the oldest one it matches
+        for waiter in self._waiters:
+            if waiter.future.done():
+                continue
+            if waiter.prefix == prefix and (waiter.match is None or waiter.match(frame)):
+                waiter.future.set_result(frame)
+                break
+        self._waiters = [waiter for waiter in self._waiters if not waiter.future.done()]
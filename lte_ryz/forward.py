@@ -0,0 +1,203 @@
+import asyncio
+import dataclasses
+import json
+from typing import Dict, Optional, Tuple, Union
+
+from .engine import DEFAULT_TIMEOUT, RESPONSE_ERROR
+from .http import HTTP_SND_COMMAND, HTTPClient, HTTPConfig
+from .journal import Journal
+from .mqtt import QOS, MQTTClient
+from .network import REGISTRATION_STATUS, NetworkMonitor
+from .retry import FAILURE
+
+
+# Journaled messages sent before the journal is acknowledged up to the last of them
+FORWARD_BATCH_SIZE = 16
+
+# Seconds before a failed batch is retried while the modem stays registered
+FORWARD_RETRY_DELAY = 10
+
+# Failed attempts, not counting those made while the network was unavailable, after which an entry is
+# moved to the dead letter journal, or dropped if there is none
+FORWARD_MAX_ATTEMPTS = 5
+
+# HTTP responses from this status on are failures of the request
+HTTP_STATUS_ERROR = 400
+
+# Journal entry kinds
+FORWARD_HTTP = "http"
+FORWARD_MQTT = "mqtt"
+
+
+def encode_entry(header: dict, payload: bytes) -> bytes:
+    # A JSON header line followed by the payload as is
+    return json.dumps(header, separators=(",", ":")).encode() + b"\n" + payload
+
+
+def decode_entry(data: bytes) -> Tuple[dict, bytes]:
+    header, payload = data.split(b"\n", 1)
+    return json.loads(header), payload
+
+
+class StoreAndForward:
+    # Keeps HTTP requests and MQTT publishes that could not be sent in a disk journal, and sends them in
+    # the order they were queued once +CEREG reports the modem registered again. Entries are only removed
+    # from the journal after the modem has accepted them, so a message may be sent twice if the script
+    # stops in the middle of a batch. An entry the modem or the server keeps rejecting is taken out of the
+    # journal after `max_attempts` failures, so it does not hold back the entries queued after it
+
+    def __init__(self, monitor: NetworkMonitor,
+                 journal: Journal,
+                 http_client: Optional[HTTPClient] = None,
+                 mqtt_client: Optional[MQTTClient] = None,
+                 batch_size: int = FORWARD_BATCH_SIZE,
+                 retry_delay: float = FORWARD_RETRY_DELAY,
+                 timeout: float = DEFAULT_TIMEOUT,
+                 max_attempts: int = FORWARD_MAX_ATTEMPTS,
+                 dead_letter: Optional[Journal] = None):
+        self._monitor = monitor
+        self._journal = journal
+        self._dead_letter = dead_letter
+        self._max_attempts = max_attempts
+        # Failed attempts of the entries at the head of the journal, by sequence number
+        self._attempts: Dict[int, int] = {}
+        self._http_client = http_client
+        self._mqtt_client = mqtt_client
+        self._batch_size = batch_size
+        self._retry_delay = retry_delay
+        self._timeout = timeout
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+        self.forwarded = 0
+        self.failed = 0
+        self.dropped = 0
+        monitor.on_change(self._on_registration)
+
+    @property
+    def pending(self) -> int:
+        return len(self._journal)
+
+    @property
+    def evicted(self) -> int:
+        return self._journal.evicted
+
+    async def start(self):
+        # Entries left in the journal by a previous run are sent too
+        self._task = asyncio.create_task(self._run())
+        self._wakeup.set()
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self._journal.close()
+        if self._dead_letter is not None:
+            self._dead_letter.close()
+
+    def queue_http(self, config: HTTPConfig, method: HTTP_SND_COMMAND, path: str, body: Union[bytes, str]) -> Optional[int]:
+        # Returns the journal sequence number, or None if the journal is full
+        if isinstance(body, str):
+            body = body.encode()
+        header = {"kind": FORWARD_HTTP, "config": dataclasses.asdict(config), "method": method.value, "path": path}
+        return self._append(encode_entry(header, body))
+
+    def queue_mqtt(self, topic: str, payload: bytes, qos: QOS = QOS.AT_LEAST_ONCE) -> Optional[int]:
+        header = {"kind": FORWARD_MQTT, "topic": topic, "qos": qos.value}
+        return self._append(encode_entry(header, payload))
+
+    def _append(self, entry: bytes) -> Optional[int]:
+        sequence = self._journal.append(entry)
+        self._wakeup.set()
+        return sequence
+
+    def _on_registration(self, status: REGISTRATION_STATUS):
+        if self._monitor.registered:
+            self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+
+            while len(self._journal) and self._monitor.registered:
+                if not await self._send_batch():
+                    # Retry later, or as soon as the registration comes back
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), self._retry_delay)
+                    except asyncio.TimeoutError:
+                        pass
+                    self._wakeup.clear()
+
+    async def _send_batch(self) -> bool:
+        # Sends the oldest entries in order and stops at the first failure, so nothing overtakes a failed
+        # entry. The journal is acknowledged up to the last entry the modem accepted or that was given up on
+        sent = None
+        ok = True
+        for sequence, data in self._journal.peek(self._batch_size):
+            failure = await self._send(data)
+            if failure is not None:
+                self.failed += 1
+                if failure == FAILURE.PERMANENT:
+                    attempts = self._attempts.pop(sequence, 0) + 1
+                    if attempts >= self._max_attempts:
+                        self._give_up(sequence, data, attempts)
+                        sent = sequence
+                        continue
+                    self._attempts[sequence] = attempts
+                ok = False
+                break
+            self._attempts.pop(sequence, None)
+            self.forwarded += 1
+            sent = sequence
+
+        if sent is not None:
+            self._journal.ack(sent)
+        return ok
+
+    async def _send(self, data: bytes) -> Optional[FAILURE]:
+        # None once the message is accepted. Only PERMANENT failures count against the entry
+        header, payload = decode_entry(data)
+        if header["kind"] == FORWARD_HTTP and self._http_client is not None:
+            response, error = await self._http_client.send(HTTPConfig(**header["config"]),
+                                                           HTTP_SND_COMMAND(header["method"]),
+                                                           header["path"],
+                                                           payload,
+                                                           self._timeout)
+            if error == RESPONSE_ERROR.OK:
+                return FAILURE.PERMANENT if response.status >= HTTP_STATUS_ERROR else None
+            return self._failure(error)
+        if header["kind"] == FORWARD_MQTT and self._mqtt_client is not None:
+            # Entries left by a previous run may be sent before the script has connected. The entry is not
+            # to blame if the broker cannot be reached
+            error = await self._mqtt_client.connect(self._timeout)
+            if error != RESPONSE_ERROR.OK:
+                return FAILURE.TRANSIENT
+            mid, error = await self._mqtt_client.publish(header["topic"], payload, QOS(header["qos"]), self._timeout)
+            return None if error == RESPONSE_ERROR.OK else self._failure(error)
+        # No client for this kind of entry in this script: leave it for one that has
+        return FAILURE.TRANSIENT
+
+    def _failure(self, error: RESPONSE_ERROR) -> FAILURE:
+        # An error the modem returned while registered is taken as a rejection of the entry. A timeout, or
+        # any error once the registration is lost, is not
+        if error == RESPONSE_ERROR.TIMEOUT or not self._monitor.registered:
+            return FAILURE.TRANSIENT
+        return FAILURE.PERMANENT
+
+    def _give_up(self, sequence: int, data: bytes, attempts: int):
+        header, payload = decode_entry(data)
+        if header["kind"] == FORWARD_MQTT:
+            target = header["topic"]
+        else:
+            target = HTTP_SND_COMMAND(header["method"]).name + " " + header["path"]
+        self.dropped += 1
+        if self._dead_letter is not None and self._dead_letter.append(data) is not None:
+            print(f"Journal entry {sequence} ({header['kind']} {target}) failed {attempts} times, moved to the "
+                  f"dead letter journal")
+        else:
+            print(f"Journal entry {sequence} ({header['kind']} {target}) failed {attempts} times, dropped")
@@ -0,0 +1,385 @@
+from enum import IntEnum
+import threading
+from typing import Iterable, List, Optional
+
+import serial
+
+
+class FRAME_TYPE(IntEnum):
+    LINE = 0
+    RESULT = 1
+    URC = 2
+    PROMPT = 3
+    DATA = 4
+    # Bytes received in online (transparent) mode
+    STREAM = 5
+
+
+# Final result codes. Every AT command is terminated by exactly one of these
+FINAL_RESULT_OK = b"OK"
+FINAL_RESULT_ERROR = (b"ERROR", b"+CME ERROR", b"+CMS ERROR", b"NO CARRIER")
+# Final result of a command that switches the modem to online mode
+FINAL_RESULT_CONNECT = b"CONNECT"
+FINAL_RESULT_NO_CARRIER = b"NO CARRIER"
+
+# In online mode only these sequences are looked for in the data. NO CARRIER ends online mode when the
+# connection is closed, OK acknowledges the +++ escape sequence
+ONLINE_NO_CARRIER = b"\r\nNO CARRIER\r\n"
+ONLINE_ESCAPED = b"\r\nOK\r\n"
+
+# Prompt shown by the modem when it is ready to accept the payload of a SEND/PUBLISH command
+DATA_PROMPT = ord(">")
+
+LINE_TERMINATORS = b"\r\n"
+
+RX_BUFFER_SIZE = 4096
+
+
+class Frame:
+    __slots__ = ("type", "data", "_text")
+
+    def __init__(self, frame_type: FRAME_TYPE, data: bytes | memoryview):
+        self.type = frame_type
+        self.data = data
+        self._text: Optional[str] = None
+
+    @property
+    def prefix(self) -> bytes:
+        # b"+SQNSRING: 1,5" -> b"+SQNSRING"
+        if self.type in (FRAME_TYPE.DATA, FRAME_TYPE.STREAM) or not self.data.startswith(b"+"):
+            return bytes(self.data)
+        return self.data.split(b":", 1)[0]
+
+    @property
+    def text(self) -> str:
+        # Frames are only decoded when a consumer asks for it
+        if self._text is None:
+            self._text = bytes(self.data).decode(errors="replace")
+        return self._text
+
+    def __bytes__(self) -> bytes:
+        return bytes(self.data)
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def __repr__(self) -> str:
+        return f"Frame({self.type.name}, {bytes(self.data)!r})"
+
+
+class Framer:
+
+    def __init__(self, urc_prefixes: Iterable[str], buffer_size: int = RX_BUFFER_SIZE):
+        self._urc_prefixes = frozenset(prefix.encode() for prefix in urc_prefixes)
+        # Receive buffer reused for the lifetime of the framer. Unparsed data lives in
+        # buffer[start:end]; parsed space at the front is reclaimed by moving the tail down
+        self._buffer = bytearray(buffer_size)
+        self._view = memoryview(self._buffer)
+        self._start = 0
+        self._end = 0
+        # Arming is done from the event loop while parsing runs on the reader thread
+        self._lock = threading.Lock()
+        self._prompt_armed = False
+        self._block_header: Optional[bytes] = None
+        self._block_marker: Optional[bytes] = None
+        self._block_length: Optional[int] = None
+        self._block_length_field = -1
+        self._block_into: Optional[memoryview] = None
+        self._block_echo: Optional[bytes] = None
+        self._block_echoed = False
+        self._block_armed = False
+        self._block: Optional[memoryview] = None
+        self._block_filled = 0
+        self._connect_armed = False
+        self._escape_armed = False
+        self._online = False
+
+    @property
+    def online(self) -> bool:
+        return self._online
+
+    def expect_connect(self):
+        # The command in flight switches the modem to online mode. Once its CONNECT is parsed, everything
+        # received is returned as STREAM frames until NO CARRIER, or OK after expect_escape()
+        with self._lock:
+            self._connect_armed = True
+
+    def expect_escape(self):
+        with self._lock:
+            self._escape_armed = True
+
+    def expect_prompt(self, enabled: bool = True):
+        with self._lock:
+            self._prompt_armed = enabled
+
+    def expect_block(self, length: Optional[int] = None,
+                     header: Optional[bytes] = None,
+                     marker: Optional[bytes] = None,
+                     into: Optional[memoryview] = None,
+                     length_field: int = -1,
+                     echo: Optional[bytes] = None):
+        # Arm the framer for a length delimited binary block:
+        #   header - the block follows the line starting with header, e.g. b"+SQNSRECV". If length is None
+        #            it is taken from field length_field of that line, the last one by default
+        #            ("+SQNSRECV: 1,5")
+        #   marker - the block follows marker at the start of a line, e.g. b"<<<" for AT+SQNHTTPRCV
+        #   neither - the block is the whole response (AT+SQNSMQTTRCVMESSAGE), after the echo of the
+        #            command when the modem echoes it. echo is the command as written, without its CR
+        # The block is copied straight from the receive buffer into `into` when given, otherwise into a
+        # buffer allocated once the length is known
+        if length is None and header is None:
+            raise ValueError("Block length must be given unless it is announced by a header line")
+        with self._lock:
+            self._block_header = header
+            self._block_marker = marker
+            self._block_length = length
+            self._block_length_field = length_field
+            self._block_into = into
+            self._block_echo = echo
+            self._block_echoed = False
+            self._block_armed = True
+
+    def cancel(self):
+        with self._lock:
+            self._prompt_armed = False
+            self._block_armed = False
+            self._block_into = None
+            self._connect_armed = False
+            self._escape_armed = False
+
+    def read_from(self, port: serial.Serial) -> List[Frame]:
+        # Read everything the UART has buffered in one go. Blocks up to the port timeout for the first byte
+        size = max(port.in_waiting, 1)
+        self._reserve(size)
+        received = port.readinto(self._view[self._end:self._end + size])
+        if not received:
+            return []
+        self._end += received
+        return self._parse()
+
+    def feed(self, data: bytes) -> List[Frame]:
+        self._reserve(len(data))
+        self._buffer[self._end:self._end + len(data)] = data
+        self._end += len(data)
+        return self._parse()
+
+    def _reserve(self, size: int):
+        if self._end + size <= len(self._buffer):
+            return
+        pending = self._end - self._start
+        if pending + size > len(self._buffer):
+            # Only grows when a single frame outgrows the buffer
+            self._view.release()
+            self._buffer.extend(bytes(max(pending + size, 2 * len(self._buffer)) - len(self._buffer)))
+            self._view = memoryview(self._buffer)
+        self._buffer[:pending] = self._buffer[self._start:self._end]
+        self._start = 0
+        self._end = pending
+
+    def _parse(self) -> List[Frame]:
+        frames = []
+        with self._lock:
+            while self._start < self._end:
+                frame = self._next_frame()
+                if frame is None:
+                    break
+                frames.append(frame)
+        if self._start == self._end:
+            self._start = self._end = 0
+        return frames
+
+    def _next_frame(self) -> Optional[Frame]:
+        if self._block is not None:
+            return self._fill_block()
+        if self._online:
+            return self._next_stream_frame()
+        if self._block_armed and self._block_header is None and self._block_marker is None:
+            return self._next_response_block_frame()
+        return self._next_line_frame()
+
+    def _next_line_frame(self) -> Optional[Frame]:
+        buffer = self._buffer
+        start = self._start
+        end = self._end
+        while start < end and buffer[start] in LINE_TERMINATORS:
+            start += 1
+        self._start = start
+        if start == end:
+            return None
+
+        if self._prompt_armed and buffer[start] == DATA_PROMPT:
+            # The prompt is not newline terminated, so it has to be recognised as soon as it arrives
+            self._prompt_armed = False
+            self._start = start + 1
+            if self._start < end and buffer[self._start] == ord(" "):
+                self._start += 1
+            return Frame(FRAME_TYPE.PROMPT, b">")
+
+        if self._block_armed and self._block_header is None and self._block_marker is not None:
+            marker = self._block_marker
+            if end - start < len(marker) and marker.startswith(buffer[start:end]):
+                # marker split across reads
+                return None
+            if buffer.startswith(marker, start):
+                self._start = start + len(marker)
+                self._start_block(self._block_length)
+                if self._block is None:
+                    # empty block
+                    return self._next_frame()
+                return self._fill_block()
+
+        newline = buffer.find(b"\n", start, end)
+        if newline < 0:
+            return None
+        line = bytes(buffer[start:newline]).rstrip(LINE_TERMINATORS)
+        self._start = newline + 1
+
+        if self._connect_armed and line == FINAL_RESULT_CONNECT:
+            self._connect_armed = False
+            self._online = True
+            return Frame(FRAME_TYPE.RESULT, line)
+
+        if self._block_armed and self._block_header is not None and line.startswith(self._block_header):
+            length = self._block_length
+            if length is None:
+                length = int(line.split(b":", 1)[-1].split(b",")[self._block_length_field])
+            self._start_block(length)
+        return Frame(self._classify(line), line)
+
+    def _next_response_block_frame(self) -> Optional[Frame]:
+        # The block is the response itself: [<echo>\r[\n]]\r\n<block>\r\n\r\nOK\r\n. It is anchored on the
+        # echo and on the one line break that opens the response, never on its own content, so CR/LF, '+' or
+        # the echoed command at the start of the block are data. Before the echo, a line that looks like a URC
+        # is taken for one. With echo off (no echo given) it is taken for the block if it is exactly as long as
+        # the block. A final error result is returned as a line
+        buffer = self._buffer
+        start = self._start
+        end = self._end
+        echo = self._block_echo
+        if echo is not None and not self._block_echoed:
+            # The modem echoes the CR that ended the command, the simulator CR LF
+            echoed = echo + b"\r"
+            if end - start <= len(echoed) and echoed.startswith(buffer[start:end]):
+                return None
+            if buffer.startswith(echoed, start):
+                self._start = start + len(echoed)
+                if buffer[self._start] == ord("\n"):
+                    self._start += 1
+                self._block_echoed = True
+                return Frame(FRAME_TYPE.LINE, echo)
+
+        if end - start < 2 or not buffer.startswith(LINE_TERMINATORS, start):
+            if buffer.startswith(LINE_TERMINATORS[:end - start], start):
+                return None
+            return self._next_line_frame()
+        opened = start + len(LINE_TERMINATORS)
+        if opened == end:
+            return None
+        if not self._block_echoed:
+            urc = self._starts_with_urc(opened, end)
+            if urc is None:
+                return None
+            if urc and (echo is not None or not self._is_block_line(opened, end)):
+                return self._next_line_frame()
+        error = self._starts_with_error(opened, end)
+        if error is None:
+            return None
+        if error:
+            return self._next_line_frame()
+
+        self._start = opened
+        self._start_block(self._block_length)
+        if self._block is None:
+            # empty block
+            return self._next_frame()
+        return self._fill_block()
+
+    def _is_block_line(self, start: int, end: int) -> bool:
+        # A complete line holding exactly the block and its CR LF
+        newline = self._buffer.find(b"\n", start, end)
+        return newline - start == self._block_length + 1 and self._buffer[newline - 1] == ord("\r")
+
+    def _starts_with_error(self, start: int, end: int) -> Optional[bool]:
+        # None until enough of the line has arrived to tell
+        newline = self._buffer.find(b"\n", start, end)
+        if newline < 0:
+            partial = bytes(self._buffer[start:end])
+            if any(result.startswith(partial) or partial.startswith(result) for result in FINAL_RESULT_ERROR):
+                return None
+            return False
+        return bytes(self._buffer[start:newline]).rstrip(LINE_TERMINATORS).startswith(FINAL_RESULT_ERROR)
+
+    def _next_stream_frame(self) -> Optional[Frame]:
+        # Online data is passed on as it arrives. Only a tail that could be the start of NO CARRIER or of
+        # the escape OK is held back until the next read tells
+        buffer = self._buffer
+        start = self._start
+        end = self._end
+        terminators = (ONLINE_NO_CARRIER, ONLINE_ESCAPED) if self._escape_armed else (ONLINE_NO_CARRIER,)
+
+        found = -1
+        for terminator in terminators:
+            index = buffer.find(terminator, start, end)
+            if index >= 0 and (found < 0 or index < found):
+                found, result = index, terminator
+        if found == start:
+            self._start = start + len(result)
+            self._online = False
+            self._escape_armed = False
+            return Frame(FRAME_TYPE.RESULT, result.strip(LINE_TERMINATORS))
+        if found > start:
+            stop = found
+        else:
+            stop = end
+            for terminator in terminators:
+                for size in range(min(len(terminator) - 1, end - start), 0, -1):
+                    if buffer.endswith(terminator[:size], start, end):
+                        stop = min(stop, end - size)
+                        break
+            if stop == start:
+                return None
+
+        self._start = stop
+        return Frame(FRAME_TYPE.STREAM, bytes(buffer[start:stop]))
+
+    def _starts_with_urc(self, start: int, end: int) -> Optional[bool]:
+        # None until enough of the line has arrived to tell
+        if self._buffer[start] != ord("+"):
+            return False
+        newline = self._buffer.find(b"\n", start, end)
+        if newline < 0:
+            partial = bytes(self._buffer[start:end])
+            if any(prefix.startswith(partial) or partial.startswith(prefix) for prefix in self._urc_prefixes):
+                return None
+            return False
+        return bytes(self._buffer[start:newline]).split(b":", 1)[0] in self._urc_prefixes
+
+    def _start_block(self, length: int):
+        self._block_armed = False
+        if length <= 0:
+            return
+        into = self._block_into
+        self._block_into = None
+        if into is not None and len(into) >= length:
+            self._block = into[:length]
+        else:
+            self._block = memoryview(bytearray(length))
+        self._block_filled = 0
+
+    def _fill_block(self) -> Optional[Frame]:
+        block = self._block
+        size = min(len(block) - self._block_filled, self._end - self._start)
+        block[self._block_filled:self._block_filled + size] = self._view[self._start:self._start + size]
+        self._block_filled += size
+        self._start += size
+        if self._block_filled < len(block):
+            return None
+        self._block = None
+        return Frame(FRAME_TYPE.DATA, block)
+
+    def _classify(self, line: bytes) -> FRAME_TYPE:
+        if line == FINAL_RESULT_OK or line.startswith(FINAL_RESULT_ERROR):
+            return FRAME_TYPE.RESULT
+        if line.startswith(b"+") and line.split(b":", 1)[0] in self._urc_prefixes:
+            return FRAME_TYPE.URC
+        return FRAME_TYPE.LINE
@@ -0,0 +1,474 @@
+import asyncio
+import contextlib
+from dataclasses import dataclass
+from enum import Enum
+import io
+import itertools
+import os
+import time
+from typing import AsyncIterator, BinaryIO, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple, Union
+
+from .engine import DEFAULT_TIMEOUT, ATEngine, ATResponse, PayloadError, RESPONSE_ERROR, RxBlock
+from .framer import FINAL_RESULT_OK, Frame
+from .records import Field, Record, text
+
+
+# HTTP configure command. This command sets the parameters needed to establish the HTTP connection
+HTTP_CFG_CMD_HEADER = "AT+SQNHTTPCFG="
+
+# This command performs HTTP GET, HEAD or DELETE requests to the server
+HTTP_QRY_CMD_HEADER = "AT+SQNHTTPQRY="
+
+# This command performs a POST or PUT request to a HTTP server and sends it the data.
+HTTP_SND_CMD_HEADER = "AT+SQNHTTPSND="
+# Bytes read from a file or iterator at a time when sending a request body
+HTTP_SND_CHUNK_SIZE = 4096
+
+# This command reads the HTTP response content data received with the last HTTP response (the HTTP
+# response reception advertised by the +SQNHTTPRING notification)
+HTTP_RCV_CMD_HEADER = "AT+SQNHTTPRCV="
+# The content data follows this marker in the AT+SQNHTTPRCV response
+HTTP_RCV_MARKER = b"<<<"
+# Bytes requested per AT+SQNHTTPRCV when streaming a response
+HTTP_RCV_CHUNK_SIZE = 1500
+
+HTTP_RING = "+SQNHTTPRING"
+
+# Modem HTTP profiles used by HTTPClient. Each profile carries one request at a time, so this is also the
+# number of requests that can be in flight at once
+HTTP_PROFILE_IDS = (1, 2, 3)
+
+# Reported by the modem when it (re)boots. Every HTTP profile is back to its defaults afterwards
+MODEM_START = "+SYSSTART"
+
+
+class HTTP_QRY_COMMAND(str, Enum):
+    GET = "0"
+    HEAD = "1"
+    DELETE = "2"
+
+
+class HTTP_SND_COMMAND(str, Enum):
+    POST = "0"
+    PUT = "1"
+
+
+@dataclass(frozen=True)
+class HTTPConfig:
+    host: str
+    port: int = 80
+    # 0: no authentication, 1: basic authentication
+    auth_type: int = 0
+    username: str = ""
+    password: str = ""
+    ssl_enabled: bool = False
+    # maximum time in seconds allowed for the HTTP(S) connection establishment/completion (if needed) and the data transfer
+    timeout: int = 120
+    # maximum time in seconds to wait for the HTTP server response
+    rcv_timeout: int = 1
+
+    def command(self, profile_id: int) -> str:
+        return HTTP_CFG_CMD_HEADER + \
+               str(profile_id) + "," + \
+               "\"" + self.host + "\"" + "," + \
+               str(self.port) + "," + \
+               str(self.auth_type) + "," + \
+               "\"" + self.username + "\"" + "," + \
+               "\"" + self.password + "\"" + "," + \
+               str(int(self.ssl_enabled)) + "," + \
+               str(self.timeout) + "," + \
+               str(self.rcv_timeout)
+
+
+@dataclass
+class HTTPResponse:
+    status: int = 0
+    content_type: str = ""
+    length: int = 0
+    body: memoryview = memoryview(b"")
+
+
+class HTTPRing(Record):
+    # +SQNHTTPRING: <prof_id>,<http_status_code>,<content_type>,<data_size>
+    __slots__ = ()
+    PREFIX = HTTP_RING
+    profile_id = Field(0)
+    status = Field(1)
+    content_type = Field(2, text, "")
+    length = Field(3, default=0)
+
+
+def parse_http_ring(ring: Frame) -> HTTPResponse:
+    record = HTTPRing.from_frame(ring)
+    return HTTPResponse(status=record.status, content_type=record.content_type, length=record.length)
+
+
+async def http_receive(engine: ATEngine,
+                       profile_id: int,
+                       length: int,
+                       into: Optional[memoryview] = None,
+                       timeout: float = DEFAULT_TIMEOUT,
+                       max_bytes: Optional[int] = None) -> Tuple[memoryview, RESPONSE_ERROR]:
+    # Read the response content announced by +SQNHTTPRING. Exactly `length` bytes are copied from the
+    # receive buffer into `into` (or a buffer of that size), and a view of them is returned. With max_bytes
+    # the modem returns at most that many bytes and keeps the rest for the next AT+SQNHTTPRCV
+    if into is not None and len(into) < length:
+        raise ValueError(f"Receive buffer too small: {len(into)} < {length}")
+
+    cmd = HTTP_RCV_CMD_HEADER + str(profile_id)
+    if max_bytes is not None:
+        cmd += "," + str(max_bytes)
+    response, error = await engine.command(cmd, timeout=timeout,
+                                           block=RxBlock(length=length, marker=HTTP_RCV_MARKER, into=into))
+    if response.data is None:
+        return memoryview(b""), error
+    return response.data, error
+
+
+class HTTPBody:
+
+    def __init__(self, body: Union[bytes, str, BinaryIO, Iterable[bytes]],
+                 length: Optional[int] = None,
+                 chunk_size: int = HTTP_SND_CHUNK_SIZE):
+        # The modem is told the exact number of bytes in AT+SQNHTTPSND, so the length is always in bytes:
+        #   bytes / str - a str is sent UTF-8 encoded
+        #   binary file - sent from the current position to the end, read chunk_size bytes at a time
+        #   iterable of bytes - streamed if length is given, otherwise joined to find the length
+        if isinstance(body, str):
+            body = body.encode()
+        if isinstance(body, (bytes, bytearray, memoryview)):
+            length = len(body)
+        elif isinstance(body, io.IOBase) or hasattr(body, "read"):
+            if length is None:
+                length = file_remaining(body)
+        elif length is None:
+            body = b"".join(body)
+            length = len(body)
+        self.length = length
+        self.bytes_sent = 0
+        self._body = body
+        self._chunk_size = chunk_size
+        self._start_time: Optional[float] = None
+        self._end_time: Optional[float] = None
+
+    @property
+    def elapsed(self) -> float:
+        if self._start_time is None:
+            return 0.0
+        end_time = self._end_time if self._end_time is not None else time.monotonic()
+        return end_time - self._start_time
+
+    @property
+    def bytes_per_second(self) -> float:
+        return self.bytes_sent / self.elapsed if self.elapsed > 0 else 0.0
+
+    def chunks(self) -> Iterator[bytes]:
+        # Runs on the engine writer thread once the modem shows the '>' prompt
+        self._start_time = time.monotonic()
+        self.bytes_sent = 0
+        try:
+            try:
+                for chunk in self._read_chunks():
+                    chunk = chunk[:self.length - self.bytes_sent]
+                    self.bytes_sent += len(chunk)
+                    yield chunk
+                    if self.bytes_sent == self.length:
+                        break
+            except OSError as e:
+                # A body file that can no longer be read is sent short
+                raise PayloadError(self.bytes_sent, self.length) from e
+            if self.bytes_sent != self.length:
+                raise PayloadError(self.bytes_sent, self.length)
+        finally:
+            self._end_time = time.monotonic()
+
+    def _read_chunks(self) -> Iterator[bytes]:
+        body = self._body
+        if isinstance(body, (bytes, bytearray, memoryview)):
+            yield body
+        elif hasattr(body, "read"):
+            while chunk := body.read(self._chunk_size):
+                yield chunk
+        else:
+            yield from body
+
+
+def file_remaining(file: BinaryIO) -> int:
+    # Bytes between the current position of a file and its end
+    position = file.tell()
+    try:
+        return os.fstat(file.fileno()).st_size - position
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        size = file.seek(0, io.SEEK_END)
+        file.seek(position)
+        return size - position
+
+
+class HTTPStream:
+
+    def __init__(self, engine: ATEngine,
+                 profile_id: int,
+                 response: HTTPResponse,
+                 error: RESPONSE_ERROR,
+                 chunk_size: int,
+                 timeout: float):
+        self.response = response
+        self.error = error
+        self.bytes_received = 0
+        self.records_received = 0
+        self._engine = engine
+        self._profile_id = profile_id
+        self._timeout = timeout
+        # Every chunk is read into the same buffer, so memory use does not depend on the response size
+        self._chunk = bytearray(chunk_size)
+        self._chunk_view = memoryview(self._chunk)
+        self._start_time = time.monotonic()
+        self._end_time: Optional[float] = None
+
+    @property
+    def elapsed(self) -> float:
+        end_time = self._end_time if self._end_time is not None else time.monotonic()
+        return end_time - self._start_time
+
+    @property
+    def bytes_per_second(self) -> float:
+        return self.bytes_received / self.elapsed if self.elapsed > 0 else 0.0
+
+    @property
+    def records_per_second(self) -> float:
+        return self.records_received / self.elapsed if self.elapsed > 0 else 0.0
+
+    async def chunks(self) -> AsyncIterator[memoryview]:
+        # Yields the body as it is read from the modem. A chunk is only valid until the next one is
+        # requested; copy it to keep it
+        self._start_time = time.monotonic()
+        try:
+            while self.error == RESPONSE_ERROR.OK and self.bytes_received < self.response.length:
+                length = min(len(self._chunk), self.response.length - self.bytes_received)
+                chunk, self.error = await http_receive(self._engine, self._profile_id, length,
+                                                       into=self._chunk_view, timeout=self._timeout,
+                                                       max_bytes=length)
+                if self.error != RESPONSE_ERROR.OK:
+                    return
+                self.bytes_received += len(chunk)
+                yield chunk
+        finally:
+            self._end_time = time.monotonic()
+
+    async def records(self) -> AsyncIterator[bytes]:
+        # Yields newline delimited records, e.g. the JSON documents returned by httpbin /stream/<n>. Only
+        # a record split across two chunks is buffered
+        partial = bytearray()
+        async for chunk in self.chunks():
+            start = 0
+            while True:
+                newline = self._chunk.find(b"\n", start, len(chunk))
+                if newline < 0:
+                    partial += chunk[start:]
+                    break
+                partial += chunk[start:newline]
+                start = newline + 1
+                record = bytes(partial).rstrip(b"\r")
+                partial.clear()
+                if record:
+                    self.records_received += 1
+                    yield record
+        if partial:
+            self.records_received += 1
+            yield bytes(partial)
+
+
+BodyType = Union[HTTPBody, bytes, str, BinaryIO, Iterable[bytes]]
+
+
+class HTTPClient:
+
+    def __init__(self, engine: ATEngine, profile_ids: Sequence[int] = HTTP_PROFILE_IDS):
+        self._engine = engine
+        # Configuration last applied to each modem HTTP profile. AT+SQNHTTPCFG is only issued when the
+        # configuration of a request differs from it
+        self._applied: Dict[int, HTTPConfig] = {}
+        # Profiles not carrying a request, least recently used first
+        self._free: List[int] = list(profile_ids)
+        self._profile_released = asyncio.Condition()
+        engine.subscribe(MODEM_START, self._on_modem_start)
+
+    @property
+    def engine(self) -> ATEngine:
+        return self._engine
+
+    def invalidate(self, profile_id: Optional[int] = None):
+        if profile_id is None:
+            self._applied.clear()
+        else:
+            self._applied.pop(profile_id, None)
+
+    async def get(self, config: HTTPConfig, path: str, timeout: float = DEFAULT_TIMEOUT) -> Tuple[HTTPResponse, RESPONSE_ERROR]:
+        return await self.query(config, HTTP_QRY_COMMAND.GET, path, timeout)
+
+    async def head(self, config: HTTPConfig, path: str, timeout: float = DEFAULT_TIMEOUT) -> Tuple[HTTPResponse, RESPONSE_ERROR]:
+        return await self.query(config, HTTP_QRY_COMMAND.HEAD, path, timeout)
+
+    async def delete(self, config: HTTPConfig, path: str, timeout: float = DEFAULT_TIMEOUT) -> Tuple[HTTPResponse, RESPONSE_ERROR]:
+        return await self.query(config, HTTP_QRY_COMMAND.DELETE, path, timeout)
+
+    async def post(self, config: HTTPConfig, path: str, body: BodyType, timeout: float = DEFAULT_TIMEOUT) -> Tuple[HTTPResponse, RESPONSE_ERROR]:
+        return await self.send(config, HTTP_SND_COMMAND.POST, path, body, timeout)
+
+    async def put(self, config: HTTPConfig, path: str, body: BodyType, timeout: float = DEFAULT_TIMEOUT) -> Tuple[HTTPResponse, RESPONSE_ERROR]:
+        return await self.send(config, HTTP_SND_COMMAND.PUT, path, body, timeout)
+
+    async def query(self, config: HTTPConfig,
+                    method: HTTP_QRY_COMMAND,
+                    path: str,
+                    timeout: float = DEFAULT_TIMEOUT) -> Tuple[HTTPResponse, RESPONSE_ERROR]:
+        profile_id = await self._acquire(config)
+        # timeout covers the whole request, the body included
+        deadline = time.monotonic() + timeout
+        try:
+            response, error = await self._query(profile_id, config, method, path, timeout)
+            if error != RESPONSE_ERROR.OK:
+                return response, error
+            return await self._read_body(profile_id, response, max(0.0, deadline - time.monotonic()))
+        finally:
+            await self._release(profile_id)
+
+    @contextlib.asynccontextmanager
+    async def stream(self, config: HTTPConfig,
+                     path: str,
+                     chunk_size: int = HTTP_RCV_CHUNK_SIZE,
+                     timeout: float = DEFAULT_TIMEOUT) -> AsyncIterator[HTTPStream]:
+        # GET a resource and read its body incrementally:
+        #   async with client.stream(config, "/stream/10") as stream:
+        #       async for record in stream.records():
+        profile_id = await self._acquire(config)
+        try:
+            response, error = await self._query(profile_id, config, HTTP_QRY_COMMAND.GET, path, timeout)
+            yield HTTPStream(self._engine, profile_id, response, error, chunk_size, timeout)
+        finally:
+            await self._release(profile_id)
+
+    async def send(self, config: HTTPConfig,
+                   method: HTTP_SND_COMMAND,
+                   path: str,
+                   body: BodyType,
+                   timeout: float = DEFAULT_TIMEOUT) -> Tuple[HTTPResponse, RESPONSE_ERROR]:
+        # Pass an HTTPBody to read the upload throughput afterwards
+        if not isinstance(body, HTTPBody):
+            body = HTTPBody(body)
+        profile_id = await self._acquire(config)
+        # timeout covers the whole request, the body included
+        deadline = time.monotonic() + timeout
+        try:
+            response, error = await self._send(profile_id, config, method, path, body, timeout)
+            if error != RESPONSE_ERROR.OK:
+                return response, error
+            return await self._read_body(profile_id, response, max(0.0, deadline - time.monotonic()))
+        finally:
+            await self._release(profile_id)
+
+    async def _acquire(self, config: HTTPConfig) -> int:
+        async with self._profile_released:
+            await self._profile_released.wait_for(lambda: self._free)
+            # Prefer a profile that already has this configuration applied, then the least recently used
+            profile_id = next((profile_id for profile_id in self._free if self._applied.get(profile_id) == config),
+                              self._free[0])
+            self._free.remove(profile_id)
+            return profile_id
+
+    async def _release(self, profile_id: int):
+        async with self._profile_released:
+            self._free.append(profile_id)
+            self._profile_released.notify()
+
+    async def _query(self, profile_id: int,
+                     config: HTTPConfig,
+                     method: HTTP_QRY_COMMAND,
+                     path: str,
+                     timeout: float) -> Tuple[HTTPResponse, RESPONSE_ERROR]:
+        # timeout covers the whole request, the ring included
+        deadline = time.monotonic() + timeout
+        cmd = HTTP_QRY_CMD_HEADER + str(profile_id) + "," + method.value + ",\"" + path + "\""
+        retry = self._engine.retry
+        for attempt in itertools.count():
+            # The ring is matched on the profile id, so requests on other profiles can complete in any order
+            ring = self._expect_ring(profile_id)
+
+            # A pending configuration and the query run as one dependent batch: no other request can
+            # reconfigure the profile between them, and the query is not sent if the configuration failed
+            commands = self._configure_commands(profile_id, config) + [cmd]
+            results = await self._engine.command_batch(commands, max(0.0, deadline - time.monotonic()),
+                                                       dependent=True)
+            for response, error in results:
+                if error != RESPONSE_ERROR.OK:
+                    self._engine.cancel_urc(ring)
+                    self.invalidate(profile_id)
+                    return HTTPResponse(), error
+            self._applied[profile_id] = config
+
+            response, error = await self._wait_ring(ring, deadline, "+SQNHTTPQRY")
+            # The engine retries the query command itself. A query is idempotent, so one whose ring never
+            # came is issued again as well
+            if (error != RESPONSE_ERROR.TIMEOUT or retry is None
+                    or not retry.retryable("+SQNHTTPQRY", ATResponse(cmd), error, attempt)
+                    or not await retry.backoff(attempt, deadline - time.monotonic())):
+                return response, error
+            self._engine.stats.record_retry("+SQNHTTPQRY")
+
+    async def _send(self, profile_id: int,
+                    config: HTTPConfig,
+                    method: HTTP_SND_COMMAND,
+                    path: str,
+                    body: HTTPBody,
+                    timeout: float) -> Tuple[HTTPResponse, RESPONSE_ERROR]:
+        # timeout covers the whole request, the ring included
+        deadline = time.monotonic() + timeout
+        for cmd in self._configure_commands(profile_id, config):
+            response, error = await self._engine.command(cmd, max(0.0, deadline - time.monotonic()))
+            if error != RESPONSE_ERROR.OK:
+                self.invalidate(profile_id)
+                return HTTPResponse(), error
+        self._applied[profile_id] = config
+
+        ring = self._expect_ring(profile_id)
+        cmd = HTTP_SND_CMD_HEADER + str(profile_id) + "," + method.value + ",\"" + path + "\"," + str(body.length)
+        response, error = await self._engine.command(cmd, max(0.0, deadline - time.monotonic()),
+                                                     data=body.chunks())
+        if error != RESPONSE_ERROR.OK:
+            short = body.bytes_sent != body.length
+            if short and response.final is not None and response.final.data == FINAL_RESULT_OK:
+                # The modem sent the request padded from a short body. Its ring is taken here, not by the next
+                # request on the profile
+                await self._wait_ring(ring, deadline, "+SQNHTTPSND")
+            else:
+                self._engine.cancel_urc(ring)
+            self.invalidate(profile_id)
+            return HTTPResponse(), error
+
+        return await self._wait_ring(ring, deadline, "+SQNHTTPSND")
+
+    def _configure_commands(self, profile_id: int, config: HTTPConfig) -> List[str]:
+        if self._applied.get(profile_id) == config:
+            return []
+        return [config.command(profile_id)]
+
+    def _expect_ring(self, profile_id: int):
+        return self._engine.expect_urc(HTTP_RING, lambda frame: HTTPRing.from_frame(frame).profile_id == profile_id)
+
+    async def _wait_ring(self, ring, deadline: float, verb: str) -> Tuple[HTTPResponse, RESPONSE_ERROR]:
+        # Called as soon as the request command completes, so the wait is the network round trip
+        ring, error = await self._engine.wait_urc(ring, max(0.0, deadline - time.monotonic()), verb=verb)
+        if error != RESPONSE_ERROR.OK:
+            return HTTPResponse(), error
+        return parse_http_ring(ring), error
+
+    async def _read_body(self, profile_id: int, response: HTTPResponse, timeout: float) -> Tuple[HTTPResponse, RESPONSE_ERROR]:
+        error = RESPONSE_ERROR.OK
+        if response.length > 0:
+            response.body, error = await http_receive(self._engine, profile_id, response.length, timeout=timeout)
+            if error != RESPONSE_ERROR.OK:
+                self.invalidate(profile_id)
+        return response, error
+
+    def _on_modem_start(self, frame: Frame):
+        self.invalidate()
@@ -0,0 +1,206 @@
+from dataclasses import dataclass
+from enum import IntEnum
+import os
+import pathlib
+import struct
+from typing import BinaryIO, List, Optional, Tuple, Union
+import zlib
+
+
+# Each record is a header followed by its data:
+#   sequence number (8 bytes), data length (4 bytes), CRC-32 of the data (4 bytes)
+RECORD_HEADER = struct.Struct("<QII")
+
+# The acknowledged sequence number is kept in this file, next to the segments
+INDEX_FILE = "journal.idx"
+INDEX_FORMAT = struct.Struct("<Q")
+
+SEGMENT_SUFFIX = ".seg"
+
+# A new segment is started once the current one reaches this size
+SEGMENT_SIZE = 1024 * 1024
+
+# Size the journal may grow to on disk before records are evicted
+JOURNAL_MAX_SIZE = 16 * 1024 * 1024
+
+
+class JOURNAL_EVICTION(IntEnum):
+    # make room by deleting the oldest segment
+    DROP_OLDEST = 0
+    # refuse new records until the journal drains
+    DROP_NEWEST = 1
+
+
+@dataclass
+class _Segment:
+    path: pathlib.Path
+    first_sequence: int
+    size: int = 0
+
+
+@dataclass
+class _Entry:
+    sequence: int
+    segment: _Segment
+    offset: int
+    length: int
+
+
+class Journal:
+    # Append-only, disk-backed record queue. Records are appended to segment files and stay on disk until
+    # they are acknowledged; only their location is kept in memory. Acknowledging a record acknowledges
+    # every record before it, and segments holding only acknowledged records are deleted
+
+    def __init__(self, directory: Union[str, os.PathLike],
+                 max_size: int = JOURNAL_MAX_SIZE,
+                 segment_size: int = SEGMENT_SIZE,
+                 eviction: JOURNAL_EVICTION = JOURNAL_EVICTION.DROP_OLDEST,
+                 fsync: bool = False):
+        # With fsync every append is forced to the storage device before it returns, so records survive a
+        # power loss and not only a crash of the script
+        self._directory = pathlib.Path(directory)
+        self._directory.mkdir(parents=True, exist_ok=True)
+        self._max_size = max_size
+        self._segment_size = segment_size
+        self._eviction = eviction
+        self._fsync = fsync
+
+        self._segments: List[_Segment] = []
+        self._entries: List[_Entry] = []
+        # index of the oldest unacknowledged entry in _entries
+        self._head = 0
+        self._acked = self._read_index()
+        self._next_sequence = self._acked + 1
+        self._writer: Optional[BinaryIO] = None
+        self.evicted = 0
+        self._load()
+
+    def __len__(self) -> int:
+        return len(self._entries) - self._head
+
+    @property
+    def size(self) -> int:
+        # bytes on disk
+        return sum(segment.size for segment in self._segments)
+
+    def append(self, data: bytes) -> Optional[int]:
+        # Returns the sequence number of the record, or None if the journal is full and evicts the newest
+        record_size = RECORD_HEADER.size + len(data)
+        while self.size + record_size > self._max_size:
+            if self._eviction == JOURNAL_EVICTION.DROP_NEWEST or not self._evict_oldest():
+                self.evicted += 1
+                return None
+
+        segment = self._segments[-1] if self._segments else None
+        if segment is None or (segment.size and segment.size + record_size > self._segment_size):
+            segment = self._new_segment()
+
+        sequence = self._next_sequence
+        self._next_sequence += 1
+        self._writer.write(RECORD_HEADER.pack(sequence, len(data), zlib.crc32(data)))
+        self._writer.write(data)
+        self._writer.flush()
+        if self._fsync:
+            os.fsync(self._writer.fileno())
+        self._entries.append(_Entry(sequence, segment, segment.size + RECORD_HEADER.size, len(data)))
+        segment.size += record_size
+        return sequence
+
+    def peek(self, count: int) -> List[Tuple[int, bytes]]:
+        # The oldest unacknowledged records, read back from disk
+        records = []
+        for entry in self._entries[self._head:self._head + count]:
+            with open(entry.segment.path, "rb") as f:
+                f.seek(entry.offset)
+                records.append((entry.sequence, f.read(entry.length)))
+        return records
+
+    def ack(self, sequence: int):
+        while self._head < len(self._entries) and self._entries[self._head].sequence <= sequence:
+            self._head += 1
+        self._acked = max(self._acked, sequence)
+        self._write_index()
+
+        # Delete the segments that only hold acknowledged records, keeping the one being written
+        oldest = self._entries[self._head].segment if self._head < len(self._entries) else None
+        while len(self._segments) > 1 and self._segments[0] is not oldest:
+            self._delete_segment(self._segments.pop(0))
+        del self._entries[:self._head]
+        self._head = 0
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    def _evict_oldest(self) -> bool:
+        if len(self._segments) < 2:
+            # never evict the segment being written
+            return False
+        segment = self._segments.pop(0)
+        dropped = [entry for entry in self._entries[self._head:] if entry.segment is segment]
+        self.evicted += len(dropped)
+        self._entries = [entry for entry in self._entries[self._head:] if entry.segment is not segment]
+        self._head = 0
+        if dropped:
+            self._acked = max(self._acked, dropped[-1].sequence)
+            self._write_index()
+        self._delete_segment(segment)
+        return True
+
+    def _new_segment(self) -> _Segment:
+        if self._writer is not None:
+            self._writer.close()
+        segment = _Segment(self._directory / f"{self._next_sequence:016d}{SEGMENT_SUFFIX}", self._next_sequence)
+        self._writer = open(segment.path, "ab")
+        self._segments.append(segment)
+        return segment
+
+    def _delete_segment(self, segment: _Segment):
+        if self._writer is not None and self._writer.name == str(segment.path):
+            self._writer.close()
+            self._writer = None
+        segment.path.unlink(missing_ok=True)
+
+    def _load(self):
+        # Rebuild the in-memory index from the segments. A record cut short by a crash is dropped
+        for path in sorted(self._directory.glob("*" + SEGMENT_SUFFIX)):
+            segment = _Segment(path, int(path.stem))
+            with open(path, "rb") as f:
+                while True:
+                    header = f.read(RECORD_HEADER.size)
+                    if len(header) < RECORD_HEADER.size:
+                        break
+                    sequence, length, crc = RECORD_HEADER.unpack(header)
+                    data = f.read(length)
+                    if len(data) < length or zlib.crc32(data) != crc:
+                        break
+                    if sequence > self._acked:
+                        self._entries.append(_Entry(sequence, segment, segment.size + RECORD_HEADER.size, length))
+                    segment.size += RECORD_HEADER.size + length
+                    self._next_sequence = max(self._next_sequence, sequence + 1)
+            if segment.size < path.stat().st_size:
+                os.truncate(path, segment.size)
+            self._segments.append(segment)
+
+        if self._segments:
+            self._writer = open(self._segments[-1].path, "ab")
+            self.ack(self._acked)
+
+    def _read_index(self) -> int:
+        try:
+            with open(self._directory / INDEX_FILE, "rb") as f:
+                return INDEX_FORMAT.unpack(f.read(INDEX_FORMAT.size))[0]
+        except (OSError, struct.error):
+            return 0
+
+    def _write_index(self):
+        # Replaced atomically, so a crash leaves either the old or the new value
+        path = self._directory / INDEX_FILE
+        temporary = path.with_suffix(".tmp")
+        with open(temporary, "wb") as f:
+            f.write(INDEX_FORMAT.pack(self._acked))
+            f.flush()
+            if self._fsync:
+                os.fsync(f.fileno())
+        os.replace(temporary, path)
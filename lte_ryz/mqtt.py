@@ -0,0 +1,691 @@
+import asyncio
+import collections
+import concurrent.futures
+from dataclasses import dataclass, field
+from enum import Enum
+import itertools
+import time
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Tuple, Union
+
+from .engine import DEFAULT_TIMEOUT, ATEngine, ATResponse, RESPONSE_ERROR, RxBlock, command_verb
+from .framer import Frame
+from .records import Field, Record, text
+
+
+# This command configures the MQTT stack with the client id, user name, and password (if required) for the
+# remote broker, and the CA cert name to use for server authentication
+MQTT_CFG_CMD_HEADER = "AT+SQNSMQTTCFG="
+
+# This command is used to create new client connection to an external bridge or a broker
+MQTT_CONNECT_CMD_HEADER = "AT+SQNSMQTTCONNECT="
+
+# This command disconnects from a broker. Connection must have been previously initiated with the +SQNSMQTTCONNECT command
+MQTT_DISCONNECT_CMD_HEADER = "AT+SQNSMQTTDISCONNECT="
+
+# This command subscribes to a topic on a broker host previously contacted with AT+SQNSMQTTCONNECT
+MQTT_SUBSCRIBE_CMD_HEADER = "AT+SQNSMQTTSUBSCRIBE="
+
+# This command unsubscribes from a topic previously subscribed with AT+SQNSMQTTSUBSCRIBE
+MQTT_UNSUBSCRIBE_CMD_HEADER = "AT+SQNSMQTTUNSUBSCRIBE="
+
+# This command is used to publish a payload into a topic on to a broker host. It starts the publishing operation
+MQTT_PUBLISH_CMD_HEADER = "AT+SQNSMQTTPUBLISH="
+
+# This command delivers a message selected by its id or the last received message if <qos>=0. The device
+# must have been connected using the AT+SQNSMQTTCONNECT command
+MQTT_RCV_MESSAGE_CMD_HEADER = "AT+SQNSMQTTRCVMESSAGE="
+
+# Result line of AT+SQNSMQTTPUBLISH with the message id, left out by firmware that only reports the id in
+# +SQNSMQTTONPUBLISH
+MQTT_PUBLISH = "+SQNSMQTTPUBLISH"
+
+MQTT_ON_CONNECT = "+SQNSMQTTONCONNECT"
+MQTT_ON_DISCONNECT = "+SQNSMQTTONDISCONNECT"
+MQTT_ON_PUBLISH = "+SQNSMQTTONPUBLISH"
+MQTT_ON_SUBSCRIBE = "+SQNSMQTTONSUBSCRIBE"
+MQTT_ON_UNSUBSCRIBE = "+SQNSMQTTONUNSUBSCRIBE"
+MQTT_ON_MESSAGE = "+SQNSMQTTONMESSAGE"
+
+# Reported by the modem when it (re)boots. The broker connection is gone afterwards
+MODEM_START = "+SYSSTART"
+
+# The modem runs a single MQTT client
+MQTT_STACK_ID = "0"
+
+# Seconds between reconnection attempts after the broker connection is lost. The last delay repeats
+RECONNECT_DELAYS = (1, 2, 5, 10, 30, 60)
+
+# Messages MQTTPublisher accepts before producers are made to wait
+PUBLISH_QUEUE_SIZE = 100
+# Publishes MQTTPublisher keeps waiting for +SQNSMQTTONPUBLISH at once
+PUBLISH_WINDOW = 8
+# Acknowledgement latencies kept for the statistics
+ACK_LATENCY_SAMPLES = 1000
+
+# Message handlers MQTTSubscriber runs at once
+SUBSCRIBER_WORKERS = 4
+
+
+class QOS(str, Enum):
+    AT_MOST_ONCE = "0"
+    AT_LEAST_ONCE = "1"
+    EXACTLY_ONCE = "2"
+
+
+@dataclass(frozen=True)
+class MQTTConfig:
+    host: str
+    port: int = 1883
+    client_id: str = "ryz_client"
+    # leave empty if the broker does not require authentication
+    username: str = ""
+    password: str = ""
+
+    def cfg_command(self) -> str:
+        cmd = MQTT_CFG_CMD_HEADER + MQTT_STACK_ID + "," + "\"" + self.client_id + "\""
+        if self.username:
+            cmd += "," + "\"" + self.username + "\"" + "," + "\"" + self.password + "\""
+        return cmd
+
+    def connect_command(self) -> str:
+        return MQTT_CONNECT_CMD_HEADER + MQTT_STACK_ID + "," + "\"" + self.host + "\"" + "," + str(self.port)
+
+
+class MQTTOnConnect(Record):
+    # +SQNSMQTTONCONNECT: <id>,<rc>
+    __slots__ = ()
+    PREFIX = MQTT_ON_CONNECT
+    stack_id = Field(0)
+    result = Field(1)
+
+
+class MQTTPublishResult(Record):
+    # +SQNSMQTTPUBLISH: <id>,<mid>
+    __slots__ = ()
+    PREFIX = MQTT_PUBLISH
+    stack_id = Field(0)
+    mid = Field(1)
+
+
+class MQTTOnPublish(Record):
+    # +SQNSMQTTONPUBLISH: <id>,<mid>,<rc>
+    __slots__ = ()
+    PREFIX = MQTT_ON_PUBLISH
+    stack_id = Field(0)
+    mid = Field(1)
+    result = Field(2)
+
+
+class MQTTOnSubscribe(Record):
+    # +SQNSMQTTONSUBSCRIBE: <id>,<topic>,<rc>
+    __slots__ = ()
+    PREFIX = MQTT_ON_SUBSCRIBE
+    stack_id = Field(0)
+    topic = Field(1, text)
+    result = Field(2)
+
+
+class MQTTOnUnsubscribe(MQTTOnSubscribe):
+    # +SQNSMQTTONUNSUBSCRIBE: <id>,<topic>,<rc>
+    __slots__ = ()
+    PREFIX = MQTT_ON_UNSUBSCRIBE
+
+
+class MQTTOnMessage(Record):
+    # +SQNSMQTTONMESSAGE: <id>,<topic>,<length>,<qos>[,<mid>]
+    __slots__ = ()
+    PREFIX = MQTT_ON_MESSAGE
+    stack_id = Field(0)
+    topic = Field(1, text)
+    length = Field(2)
+    qos = Field(3, default=0)
+    mid = Field(4)
+
+
+def mqtt_publish_cmd(topic: str, qos: "QOS", length: int) -> str:
+    return MQTT_PUBLISH_CMD_HEADER + MQTT_STACK_ID + "," + "\"" + topic + "\"" + "," + qos.value + "," + str(length)
+
+
+def mqtt_publish_mid(response: ATResponse) -> Optional[int]:
+    # Message id from the result of AT+SQNSMQTTPUBLISH, None when the modem does not report it there
+    for line in response.lines:
+        if line.prefix == MQTT_PUBLISH:
+            return MQTTPublishResult.from_frame(line).mid
+    return None
+
+
+def mqtt_topic_match(topic: str):
+    # Matches the +SQNSMQTTONSUBSCRIBE/+SQNSMQTTONUNSUBSCRIBE notification of a topic
+    return lambda frame: MQTTOnSubscribe.from_frame(frame).topic == topic
+
+
+class MQTTClient:
+    # Keeps one broker connection open for the lifetime of the client. If the modem reports the connection
+    # lost (+SQNSMQTTONDISCONNECT, or +SYSSTART after a reboot) the client reconnects in the background
+    # and subscribes to its topics again
+
+    def __init__(self, engine: ATEngine, config: MQTTConfig, reconnect_delays: Tuple[float, ...] = RECONNECT_DELAYS):
+        self.config = config
+        self._engine = engine
+        self._reconnect_delays = reconnect_delays
+        self._subscriptions: Dict[str, QOS] = {}
+        self._connected = asyncio.Event()
+        # Set while the application wants the connection open, i.e. between connect() and disconnect()
+        self._wanted = False
+        # The modem may still hold a session from a previous run, which is closed before connecting once
+        self._stale = True
+        self._connect_lock = asyncio.Lock()
+        self._reconnect: Optional[asyncio.Task] = None
+        # The running MQTTPublisher, which takes every +SQNSMQTTONPUBLISH while it runs
+        self._publisher: Optional["MQTTPublisher"] = None
+        engine.subscribe(MQTT_ON_DISCONNECT, self._on_connection_lost)
+        engine.subscribe(MODEM_START, self._on_connection_lost)
+
+    @property
+    def engine(self) -> ATEngine:
+        return self._engine
+
+    @property
+    def connected(self) -> bool:
+        return self._connected.is_set()
+
+    @property
+    def subscriptions(self) -> Dict[str, QOS]:
+        return dict(self._subscriptions)
+
+    async def connect(self, timeout: float = DEFAULT_TIMEOUT) -> RESPONSE_ERROR:
+        self._wanted = True
+        async with self._connect_lock:
+            if self.connected:
+                return RESPONSE_ERROR.OK
+            return await self._connect(timeout)
+
+    async def wait_connected(self, timeout: float = DEFAULT_TIMEOUT) -> RESPONSE_ERROR:
+        try:
+            await asyncio.wait_for(self._connected.wait(), timeout)
+        except asyncio.TimeoutError:
+            return RESPONSE_ERROR.TIMEOUT
+        return RESPONSE_ERROR.OK
+
+    async def disconnect(self, timeout: float = DEFAULT_TIMEOUT) -> RESPONSE_ERROR:
+        self._wanted = False
+        if self._reconnect is not None:
+            self._reconnect.cancel()
+        async with self._connect_lock:
+            if not self.connected:
+                return RESPONSE_ERROR.OK
+            # Cleared first, so the +SQNSMQTTONDISCONNECT we asked for is not taken for a lost connection
+            self._connected.clear()
+            response, error = await self._engine.command(MQTT_DISCONNECT_CMD_HEADER + MQTT_STACK_ID, timeout,
+                                                         urc=MQTT_ON_DISCONNECT)
+            return error
+
+    async def subscribe(self, topic: str, qos: QOS = QOS.AT_LEAST_ONCE, timeout: float = DEFAULT_TIMEOUT) -> RESPONSE_ERROR:
+        # The topic is remembered and subscribed again after every reconnection. While disconnected the
+        # subscription is only sent once the connection is back
+        self._subscriptions[topic] = qos
+        if not self.connected:
+            return RESPONSE_ERROR.OK
+        return await self._subscribe(topic, qos, timeout)
+
+    async def unsubscribe(self, topic: str, timeout: float = DEFAULT_TIMEOUT) -> RESPONSE_ERROR:
+        if self._subscriptions.pop(topic, None) is None or not self.connected:
+            return RESPONSE_ERROR.OK
+        cmd = MQTT_UNSUBSCRIBE_CMD_HEADER + MQTT_STACK_ID + "," + "\"" + topic + "\""
+        response, error = await self._engine.command(cmd, timeout, urc=MQTT_ON_UNSUBSCRIBE,
+                                                     urc_match=mqtt_topic_match(topic))
+        return error
+
+    async def publish(self, topic: str,
+                      payload: bytes,
+                      qos: QOS = QOS.AT_MOST_ONCE,
+                      timeout: float = DEFAULT_TIMEOUT) -> Tuple[Optional[int], RESPONSE_ERROR]:
+        # Returns the message id reported in +SQNSMQTTONPUBLISH. Waits for the connection to come back if
+        # it has been lost
+        if self._publisher is not None:
+            # The publisher matches the acks to its publishes, so this one must be in its line
+            return await (await self._publisher.publish(topic, payload, qos))
+
+        error = await self.wait_connected(timeout)
+        if error != RESPONSE_ERROR.OK:
+            return None, error
+
+        cmd = mqtt_publish_cmd(topic, qos, len(payload))
+        response, error = await self._engine.command(cmd, timeout, data=payload, urc=MQTT_ON_PUBLISH)
+        if error != RESPONSE_ERROR.OK:
+            return None, error
+
+        ack = MQTTOnPublish.from_frame(response.urc)
+        if ack.result != 0:
+            return ack.mid, RESPONSE_ERROR.ERROR
+        return ack.mid, RESPONSE_ERROR.OK
+
+    async def _connect(self, timeout: float) -> RESPONSE_ERROR:
+        # The connect command is not sent if the configuration failed
+        commands = [self.config.cfg_command(), self.config.connect_command()]
+        deadline = time.monotonic() + timeout
+        if self._stale:
+            # The disconnect fails if there was no session to close, so its result is not checked
+            await self._engine.command(MQTT_DISCONNECT_CMD_HEADER + MQTT_STACK_ID, timeout)
+            self._stale = False
+
+        connect = self._engine.expect_urc(MQTT_ON_CONNECT)
+        results = await self._engine.command_batch(commands, max(0.0, deadline - time.monotonic()),
+                                                   dependent=True)
+        for response, error in results:
+            if error != RESPONSE_ERROR.OK:
+                self._engine.cancel_urc(connect)
+                return error
+
+        connect, error = await self._engine.wait_urc(connect, max(0.0, deadline - time.monotonic()),
+                                                     verb=command_verb(MQTT_CONNECT_CMD_HEADER))
+        if error != RESPONSE_ERROR.OK:
+            return error
+
+        response_code = MQTTOnConnect.from_frame(connect).result
+        if response_code != 0:
+            print(f"MQTT connect failed with error code: {response_code}")
+            return RESPONSE_ERROR.ERROR
+        self._connected.set()
+
+        for topic, qos in list(self._subscriptions.items()):
+            error = await self._subscribe(topic, qos, timeout)
+            if error != RESPONSE_ERROR.OK:
+                return error
+        return RESPONSE_ERROR.OK
+
+    async def _subscribe(self, topic: str, qos: QOS, timeout: float) -> RESPONSE_ERROR:
+        cmd = MQTT_SUBSCRIBE_CMD_HEADER + MQTT_STACK_ID + "," + "\"" + topic + "\"" + "," + qos.value
+        response, error = await self._engine.command(cmd, timeout, urc=MQTT_ON_SUBSCRIBE,
+                                                     urc_match=mqtt_topic_match(topic))
+        if error != RESPONSE_ERROR.OK:
+            return error
+
+        if MQTTOnSubscribe.from_frame(response.urc).result != 0:
+            return RESPONSE_ERROR.ERROR
+        return RESPONSE_ERROR.OK
+
+    def _on_connection_lost(self, frame: Frame):
+        if not self.connected:
+            return
+        self._connected.clear()
+        print(f"MQTT connection to {self.config.host} lost")
+        if self._wanted and (self._reconnect is None or self._reconnect.done()):
+            self._reconnect = asyncio.create_task(self._reconnect_loop())
+
+    async def _reconnect_loop(self):
+        delays = itertools.chain(self._reconnect_delays, itertools.repeat(self._reconnect_delays[-1]))
+        for delay in delays:
+            await asyncio.sleep(delay)
+            async with self._connect_lock:
+                if not self._wanted or self.connected:
+                    return
+                error = await self._connect(DEFAULT_TIMEOUT)
+                if error == RESPONSE_ERROR.OK:
+                    print(f"MQTT connection to {self.config.host} restored")
+                    return
+                print(f"Error: {error.name}. Reconnecting to {self.config.host} failed, retrying")
+
+
+@dataclass
+class _Publish:
+    topic: str
+    payload: bytes
+    qos: QOS
+    future: asyncio.Future
+    sent_at: float = 0.0
+    ack_timer: Optional[asyncio.TimerHandle] = field(default=None, repr=False)
+    # From the result of the publish command, None until it is read or if the modem does not report it
+    mid: Optional[int] = None
+    completed: bool = False
+    # Completed with TIMEOUT, but still waiting for its ack so a late one is not taken for the next publish's
+    expired: bool = False
+
+
+class MQTTPublisher:
+    # Publishes queued messages without waiting for each acknowledgement. Up to `window` publishes are
+    # outstanding at once. An ack completes the publish with its message id, taken from the
+    # +SQNSMQTTPUBLISH result. Acks for publishes whose id is not known, because the firmware does not
+    # report it or because the ack was read together with the OK, complete them in order, so a publish is in
+    # line before its command is written. The queue is bounded, so producers wait
+    # in publish() when the modem cannot keep up. While a publisher runs, MQTTClient.publish() goes
+    # through it
+
+    def __init__(self, client: MQTTClient,
+                 queue_size: int = PUBLISH_QUEUE_SIZE,
+                 window: int = PUBLISH_WINDOW,
+                 timeout: float = DEFAULT_TIMEOUT):
+        self._client = client
+        self._engine = client.engine
+        self._timeout = timeout
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self._window = asyncio.Semaphore(window)
+        self._in_flight: Deque[_Publish] = collections.deque()
+        self._task: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+        self.published = 0
+        self.failed = 0
+        self.max_queue_depth = 0
+        self.ack_latencies: Deque[float] = collections.deque(maxlen=ACK_LATENCY_SAMPLES)
+        self._start_time = time.monotonic()
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    @property
+    def in_flight(self) -> int:
+        return sum(not item.expired for item in self._in_flight)
+
+    @property
+    def elapsed(self) -> float:
+        return time.monotonic() - self._start_time
+
+    @property
+    def messages_per_second(self) -> float:
+        return self.published / self.elapsed if self.elapsed > 0 else 0.0
+
+    def ack_latency(self, percent: float) -> float:
+        # nearest rank percentile of the recent acknowledgement latencies, in seconds
+        if not self.ack_latencies:
+            return 0.0
+        ordered = sorted(self.ack_latencies)
+        return ordered[min(len(ordered), max(1, round(percent / 100 * len(ordered)))) - 1]
+
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._start_time = time.monotonic()
+        self._client._publisher = self
+        self._engine.subscribe(MQTT_ON_PUBLISH, self._on_publish)
+        self._engine.subscribe(MQTT_ON_DISCONNECT, self._on_connection_lost)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self, drain: bool = True):
+        # With drain, returns once every queued message has been acknowledged or has failed
+        if drain:
+            await self._queue.join()
+        if self._task is not None:
+            self._task.cancel()
+        if self._client._publisher is self:
+            self._client._publisher = None
+        self._engine.unsubscribe(MQTT_ON_PUBLISH, self._on_publish)
+        self._engine.unsubscribe(MQTT_ON_DISCONNECT, self._on_connection_lost)
+
+    async def publish(self, topic: str, payload: bytes, qos: QOS = QOS.AT_LEAST_ONCE) -> asyncio.Future:
+        # Waits while the queue is full. The returned future resolves to (mid, RESPONSE_ERROR) once the
+        # modem has reported the publish
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put(_Publish(topic, payload, qos, future))
+        self.max_queue_depth = max(self.max_queue_depth, self._queue.qsize())
+        return future
+
+    def publish_threadsafe(self, topic: str, payload: bytes, qos: QOS = QOS.AT_LEAST_ONCE) -> concurrent.futures.Future:
+        # For producer threads: blocks while the queue is full, then returns a future that resolves to
+        # (mid, RESPONSE_ERROR)
+        result = concurrent.futures.Future()
+
+        async def enqueue():
+            future = await self.publish(topic, payload, qos)
+            future.add_done_callback(lambda done: result.set_result(done.result()))
+
+        asyncio.run_coroutine_threadsafe(enqueue(), self._loop).result()
+        return result
+
+    async def _run(self):
+        while True:
+            item = await self._queue.get()
+            await self._window.acquire()
+
+            error = await self._client.wait_connected(self._timeout)
+            if error == RESPONSE_ERROR.OK:
+                item.sent_at = time.monotonic()
+                self._in_flight.append(item)
+                cmd = mqtt_publish_cmd(item.topic, item.qos, len(item.payload))
+                response, error = await self._engine.command(cmd, self._timeout, data=item.payload)
+                if error == RESPONSE_ERROR.OK and not item.completed:
+                    item.mid = mqtt_publish_mid(response)
+                elif item in self._in_flight:
+                    self._in_flight.remove(item)
+            if error != RESPONSE_ERROR.OK:
+                self._complete(item, None, error)
+            elif not item.completed:
+                item.ack_timer = self._loop.call_later(self._timeout, self._on_ack_timeout, item)
+
+    def _on_publish(self, frame: Frame):
+        ack = MQTTOnPublish.from_frame(frame)
+        item = next((item for item in self._in_flight if item.mid == ack.mid), None)
+        if item is None:
+            # The oldest publish whose id is not known yet
+            item = next((item for item in self._in_flight if item.mid is None), None)
+        if item is None:
+            # The late ack of a publish that timed out once its id was known
+            return
+        self._in_flight.remove(item)
+        if item.expired:
+            # The late ack of a publish already reported as timed out
+            return
+        item.mid = ack.mid
+        self.ack_latencies.append(time.monotonic() - item.sent_at)
+        self._complete(item, ack.mid, RESPONSE_ERROR.OK if ack.result == 0 else RESPONSE_ERROR.ERROR)
+
+    def _on_ack_timeout(self, item: _Publish):
+        # Without an id, the publish keeps its place in line until its ack arrives or the connection drops.
+        # With one, a late ack finds no publish and is dropped
+        if item in self._in_flight and not item.completed:
+            if item.mid is None:
+                item.expired = True
+            else:
+                self._in_flight.remove(item)
+            self._complete(item, None, RESPONSE_ERROR.TIMEOUT)
+
+    def _on_connection_lost(self, frame: Frame):
+        # Publishes that were not acknowledged before the connection dropped are reported failed. No ack
+        # will come for them, including those that already timed out
+        while self._in_flight:
+            item = self._in_flight.popleft()
+            self._complete(item, None, RESPONSE_ERROR.ERROR)
+
+    def _complete(self, item: _Publish, mid: Optional[int], error: RESPONSE_ERROR):
+        # An ack read together with the OK completes the publish before its command returns
+        if item.completed:
+            return
+        item.completed = True
+        if item.ack_timer is not None:
+            item.ack_timer.cancel()
+        if error == RESPONSE_ERROR.OK:
+            self.published += 1
+        else:
+            self.failed += 1
+        if not item.future.done():
+            item.future.set_result((mid, error))
+        self._window.release()
+        self._queue.task_done()
+
+
+@dataclass
+class MQTTMessage:
+    topic: str
+    payload: bytes
+    qos: int
+    # None for QoS 0 messages
+    mid: Optional[int] = None
+
+
+MessageHandler = Callable[[MQTTMessage], Union[None, Awaitable[None]]]
+
+
+class _TopicNode:
+    __slots__ = ("children", "values")
+
+    def __init__(self):
+        self.children: Dict[str, "_TopicNode"] = {}
+        self.values: List[Any] = []
+
+
+class TopicTrie:
+    # Maps MQTT topic filters to values. A topic is matched level by level, so the cost depends on the
+    # depth of the topic rather than on the number of filters. Supports the + and # wildcards
+
+    def __init__(self):
+        self._root = _TopicNode()
+
+    def add(self, topic_filter: str, value: Any):
+        node = self._root
+        for level in topic_filter.split("/"):
+            node = node.children.setdefault(level, _TopicNode())
+        node.values.append(value)
+
+    def remove(self, topic_filter: str, value: Any) -> bool:
+        # Returns True if the filter has no values left
+        path = [self._root]
+        for level in topic_filter.split("/"):
+            node = path[-1].children.get(level)
+            if node is None:
+                return True
+            path.append(node)
+        node = path[-1]
+        if value in node.values:
+            node.values.remove(value)
+        empty = not node.values
+        # prune the branches left empty
+        for parent, level in zip(reversed(path[:-1]), reversed(topic_filter.split("/"))):
+            child = parent.children[level]
+            if child.values or child.children:
+                break
+            del parent.children[level]
+        return empty
+
+    def match(self, topic: str) -> List[Any]:
+        values = []
+        levels = topic.split("/")
+        nodes = [self._root]
+        for i, level in enumerate(levels):
+            next_nodes = []
+            # Topics starting with $ are not matched by wildcards at the first level
+            wildcard = not (i == 0 and level.startswith("$"))
+            for node in nodes:
+                if wildcard and "#" in node.children:
+                    values += node.children["#"].values
+                if level in node.children:
+                    next_nodes.append(node.children[level])
+                if wildcard and "+" in node.children:
+                    next_nodes.append(node.children["+"])
+            nodes = next_nodes
+            if not nodes:
+                return values
+        for node in nodes:
+            values += node.values
+            # "a/#" also matches "a"
+            if "#" in node.children:
+                values += node.children["#"].values
+        return values
+
+
+class MQTTSubscriber:
+    # Dispatches incoming messages to handlers registered per topic filter. Each +SQNSMQTTONMESSAGE is
+    # fetched by the message id it carries, and the handlers run on worker tasks (plain functions on a
+    # thread pool), so a slow handler does not hold up the modem
+
+    def __init__(self, client: MQTTClient, workers: int = SUBSCRIBER_WORKERS, timeout: float = DEFAULT_TIMEOUT):
+        self._client = client
+        self._engine = client.engine
+        self._workers = workers
+        self._timeout = timeout
+        self._trie = TopicTrie()
+        self._filters: Dict[str, List[MessageHandler]] = {}
+        self._notifications: asyncio.Queue = asyncio.Queue()
+        self._messages: asyncio.Queue = asyncio.Queue()
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="mqtt-handler")
+        self._tasks: List[asyncio.Task] = []
+        self.messages_received = 0
+        self.messages_unhandled = 0
+
+    async def start(self):
+        self._engine.subscribe(MQTT_ON_MESSAGE, self._notifications.put_nowait)
+        self._tasks = [asyncio.create_task(self._fetch())]
+        self._tasks += [asyncio.create_task(self._dispatch()) for _ in range(self._workers)]
+
+    async def stop(self, timeout: float = DEFAULT_TIMEOUT):
+        # Unsubscribes every topic filter, then waits for the handlers that are still running
+        self._engine.unsubscribe(MQTT_ON_MESSAGE, self._notifications.put_nowait)
+        for topic_filter in list(self._filters):
+            await self._client.unsubscribe(topic_filter, timeout)
+        self._filters.clear()
+        self._trie = TopicTrie()
+        await self._messages.join()
+        for task in self._tasks:
+            task.cancel()
+        self._pool.shutdown(wait=False)
+
+    async def subscribe(self, topic_filter: str,
+                        handler: MessageHandler,
+                        qos: QOS = QOS.AT_LEAST_ONCE) -> RESPONSE_ERROR:
+        # The broker subscription is only made for the first handler of a filter
+        self._trie.add(topic_filter, handler)
+        handlers = self._filters.setdefault(topic_filter, [])
+        handlers.append(handler)
+        if len(handlers) > 1:
+            return RESPONSE_ERROR.OK
+        error = await self._client.subscribe(topic_filter, qos, self._timeout)
+        if error != RESPONSE_ERROR.OK:
+            self._remove(topic_filter, handler)
+        return error
+
+    async def unsubscribe(self, topic_filter: str, handler: MessageHandler) -> RESPONSE_ERROR:
+        if handler not in self._filters.get(topic_filter, []):
+            return RESPONSE_ERROR.OK
+        if not self._remove(topic_filter, handler):
+            return RESPONSE_ERROR.OK
+        return await self._client.unsubscribe(topic_filter, self._timeout)
+
+    def _remove(self, topic_filter: str, handler: MessageHandler) -> bool:
+        # Returns True once the filter has no handlers left
+        self._trie.remove(topic_filter, handler)
+        handlers = self._filters[topic_filter]
+        handlers.remove(handler)
+        if handlers:
+            return False
+        del self._filters[topic_filter]
+        return True
+
+    async def _fetch(self):
+        while True:
+            frame = await self._notifications.get()
+            notification = MQTTOnMessage.from_frame(frame)
+            topic = notification.topic
+            length = notification.length
+            qos = notification.qos
+            mid = notification.mid
+
+            cmd = MQTT_RCV_MESSAGE_CMD_HEADER + MQTT_STACK_ID + "," + "\"" + topic + "\""
+            if mid is not None:
+                cmd += "," + str(mid)
+            # The payload is the whole response, a binary block of the announced length after the echo
+            response, error = await self._engine.command(cmd, self._timeout, block=RxBlock(length=length))
+            if error != RESPONSE_ERROR.OK:
+                print(f"Error: {error.name}. Failed at {cmd}")
+                continue
+
+            payload = bytes(response.data) if response.data is not None else b""
+            self.messages_received += 1
+            self._messages.put_nowait(MQTTMessage(topic, payload, qos, mid))
+
+    async def _dispatch(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            message = await self._messages.get()
+            try:
+                handlers = self._trie.match(message.topic)
+                if not handlers:
+                    self.messages_unhandled += 1
+                for handler in handlers:
+                    try:
+                        if asyncio.iscoroutinefunction(handler):
+                            await handler(message)
+                        else:
+                            await loop.run_in_executor(self._pool, handler, message)
+                    except Exception as e:
+                        print(f"MQTT handler for {message.topic} failed: {e!r}")
+            finally:
+                self._messages.task_done()
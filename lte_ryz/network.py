@@ -0,0 +1,105 @@
+import asyncio
+from enum import IntEnum
+from typing import Callable, List, Optional
+
+from .engine import DEFAULT_TIMEOUT, ATEngine, RESPONSE_ERROR
+from .framer import Frame
+from .records import Field, Record, enum_value, hex_int
+
+
+# This command enables the +CEREG notification, reported whenever the EPS registration status changes
+# (2: status, tracking area and cell id)
+CEREG_ENABLE_CMD = "AT+CEREG=2"
+
+# This command reads the current EPS registration status
+CEREG_QUERY_CMD = "AT+CEREG?"
+
+CEREG = "+CEREG"
+
+
+class REGISTRATION_STATUS(IntEnum):
+    NOT_REGISTERED = 0
+    REGISTERED_HOME = 1
+    SEARCHING = 2
+    DENIED = 3
+    UNKNOWN = 4
+    REGISTERED_ROAMING = 5
+
+
+REGISTERED = (REGISTRATION_STATUS.REGISTERED_HOME, REGISTRATION_STATUS.REGISTERED_ROAMING)
+
+
+class CEREGNotification(Record):
+    # +CEREG: <stat>[,<tac>,<ci>,<AcT>]
+    __slots__ = ()
+    PREFIX = CEREG
+    status = Field(0, enum_value(REGISTRATION_STATUS, REGISTRATION_STATUS.UNKNOWN), REGISTRATION_STATUS.UNKNOWN)
+    tracking_area = Field(1, hex_int)
+    cell_id = Field(2, hex_int)
+    access_technology = Field(3)
+
+
+class CEREGStatus(Record):
+    # +CEREG: <n>,<stat>[,<tac>,<ci>,<AcT>]        (response to AT+CEREG?)
+    # Same prefix as the notification, so it is only used for the response and not entered in RECORDS
+    __slots__ = ()
+    mode = Field(0)
+    status = Field(1, enum_value(REGISTRATION_STATUS, REGISTRATION_STATUS.UNKNOWN), REGISTRATION_STATUS.UNKNOWN)
+    tracking_area = Field(2, hex_int)
+    cell_id = Field(3, hex_int)
+    access_technology = Field(4)
+
+
+def parse_cereg(frame: Frame, solicited: bool = False) -> REGISTRATION_STATUS:
+    record = CEREGStatus.from_frame(frame) if solicited else CEREGNotification.from_frame(frame)
+    return record.status
+
+
+class NetworkMonitor:
+    # Tracks the EPS registration status reported by +CEREG
+
+    def __init__(self, engine: ATEngine):
+        self._engine = engine
+        self.status = REGISTRATION_STATUS.UNKNOWN
+        self._registered = asyncio.Event()
+        self._callbacks: List[Callable[[REGISTRATION_STATUS], None]] = []
+        engine.subscribe(CEREG, self._on_cereg)
+
+    @property
+    def registered(self) -> bool:
+        return self.status in REGISTERED
+
+    async def start(self, timeout: float = DEFAULT_TIMEOUT) -> RESPONSE_ERROR:
+        # Enables the notification and reads the current status
+        results = await self._engine.command_batch((CEREG_ENABLE_CMD, CEREG_QUERY_CMD), timeout)
+        for response, error in results:
+            if error != RESPONSE_ERROR.OK:
+                return error
+        response, error = results[-1]
+        if response.lines:
+            self._update(parse_cereg(response.lines[-1], solicited=True))
+        return RESPONSE_ERROR.OK
+
+    def on_change(self, callback: Callable[[REGISTRATION_STATUS], None]):
+        self._callbacks.append(callback)
+
+    async def wait_registered(self, timeout: Optional[float] = None) -> RESPONSE_ERROR:
+        try:
+            await asyncio.wait_for(self._registered.wait(), timeout)
+        except asyncio.TimeoutError:
+            return RESPONSE_ERROR.TIMEOUT
+        return RESPONSE_ERROR.OK
+
+    def _on_cereg(self, frame: Frame):
+        self._update(parse_cereg(frame))
+
+    def _update(self, status: REGISTRATION_STATUS):
+        changed = status != self.status
+        self.status = status
+        if self.registered:
+            self._registered.set()
+        else:
+            self._registered.clear()
+        if changed:
+            for callback in self._callbacks:
+                callback(status)
@@ -0,0 +1,22 @@
+from typing import Optional, Union
+
+import serial
+
+from .capture import CaptureSerial
+
+# Lets serial_for_url() find lte_ryz.protocol_ryzsim and lte_ryz.protocol_replay, so a ryzsim:// or replay://
+# URL can be used in place of a COM port
+if "lte_ryz" not in serial.protocol_handler_packages:
+    serial.protocol_handler_packages.append("lte_ryz")
+
+
+def open_serial_port(com_port: str, flow_cntrl: bool, capture: Optional[str] = None) -> Union[serial.Serial, CaptureSerial]:
+    ser = serial.serial_for_url(com_port, do_not_open=True)
+    ser.baudrate = 115200
+    ser.rtscts = flow_cntrl
+    ser.timeout = 1
+    ser.open()
+    # Everything crossing the UART is recorded to the capture file, which replay://<capture> plays back
+    if capture:
+        return CaptureSerial(ser, capture)
+    return ser
@@ -0,0 +1,105 @@
+import urllib.parse
+
+from serial.serialutil import PortNotOpenError, SerialBase, SerialException
+
+from .capture import REPLAY_MAX_SPEED, ReplaySession
+
+
+# pyserial URL handler playing back a capture written by open_serial_port(..., capture=path), so any script
+# can be run against a recorded session:
+#   replay://captures/session.cap?speed=1
+# speed 1 (default) keeps the original timing, 10 plays ten times faster and max as fast as the script
+# reads. The session is available as port.replay
+
+
+class Serial(SerialBase):
+
+    def __init__(self, *args, **kwargs):
+        self.replay = None
+        super().__init__(*args, **kwargs)
+
+    def open(self):
+        if self.is_open:
+            raise SerialException("Port is already open.")
+        if self._port is None:
+            raise SerialException("Port must be configured before it can be used.")
+        path, speed = self.from_url(self._port)
+        try:
+            self.replay = ReplaySession(path, speed)
+        except (OSError, ValueError) as e:
+            raise SerialException(f"cannot replay {path}: {e}")
+        self.is_open = True
+
+    def close(self):
+        self.is_open = False
+
+    def from_url(self, url: str):
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme != "replay":
+            raise SerialException(f"expected a string in the form \"replay://<path>[?speed=<n>|max]\": not starting "
+                                  f"with replay:// ({parts.scheme!r})")
+        path = parts.netloc + parts.path
+        speed = 1.0
+        try:
+            for option, values in urllib.parse.parse_qs(parts.query).items():
+                value = values[0]
+                match option:
+                    case "speed":
+                        speed = REPLAY_MAX_SPEED if value == "max" else float(value)
+                        if speed < 0:
+                            raise ValueError(f"speed must not be negative: {value!r}")
+                    case _:
+                        raise ValueError(f"unknown option: {option!r}")
+        except ValueError as e:
+            raise SerialException(f"expected a string in the form \"replay://<path>[?speed=<n>|max]\": {e}")
+        if not path:
+            raise SerialException("expected a string in the form \"replay://<path>[?speed=<n>|max]\": no path")
+        return path, speed
+
+    def _reconfigure_port(self, force_update: bool = False):
+        pass
+
+    @property
+    def in_waiting(self) -> int:
+        if not self.is_open:
+            raise PortNotOpenError()
+        return self.replay.in_waiting
+
+    def read(self, size: int = 1) -> bytes:
+        if not self.is_open:
+            raise PortNotOpenError()
+        return self.replay.read(size, self._timeout)
+
+    def write(self, data) -> int:
+        if not self.is_open:
+            raise PortNotOpenError()
+        return self.replay.write(bytes(data))
+
+    def reset_input_buffer(self):
+        if not self.is_open:
+            raise PortNotOpenError()
+        self.replay.reset_input_buffer()
+
+    def reset_output_buffer(self):
+        if not self.is_open:
+            raise PortNotOpenError()
+
+    @property
+    def out_waiting(self) -> int:
+        return 0
+
+    @property
+    def cts(self) -> bool:
+        return True
+
+    @property
+    def dsr(self) -> bool:
+        return True
+
+    @property
+    def ri(self) -> bool:
+        return False
+
+    @property
+    def cd(self) -> bool:
+        return True
@@ -0,0 +1,102 @@
+import urllib.parse
+
+from serial.serialutil import PortNotOpenError, SerialBase, SerialException
+
+from .simulator import ModemSimulator, SimulatorConfig
+
+
+# pyserial URL handler for the modem simulator. open_serial_port() registers this package with pyserial,
+# so any script accepts a URL in place of a COM port:
+#   ryzsim://?latency=0.01&network_latency=0.2&baudrate=115200&error_rate=0.01&seed=1&echo=1&guard_time=0.1
+# baudrate defaults to the baud rate the port is opened with. The simulator is available as port.modem
+
+
+class Serial(SerialBase):
+
+    def __init__(self, *args, **kwargs):
+        self.modem = None
+        super().__init__(*args, **kwargs)
+
+    def open(self):
+        if self.is_open:
+            raise SerialException("Port is already open.")
+        if self._port is None:
+            raise SerialException("Port must be configured before it can be used.")
+        self.modem = ModemSimulator(self.from_url(self._port))
+        self.modem.start()
+        self.is_open = True
+
+    def close(self):
+        if self.modem is not None:
+            self.modem.stop()
+        self.is_open = False
+
+    def from_url(self, url: str) -> SimulatorConfig:
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme != "ryzsim":
+            raise SerialException(f"expected a string in the form \"ryzsim://[?option[=value][&...]]\": not starting "
+                                  f"with ryzsim:// ({parts.scheme!r})")
+        config = SimulatorConfig(baudrate=self._baudrate)
+        try:
+            for option, values in urllib.parse.parse_qs(parts.query).items():
+                value = values[0]
+                match option:
+                    case "latency" | "network_latency" | "error_rate" | "guard_time" | "packet_loss":
+                        setattr(config, option, float(value))
+                    case "baudrate" | "seed":
+                        setattr(config, option, int(value))
+                    case "echo":
+                        config.echo = value not in ("0", "false")
+                    case _:
+                        raise ValueError(f"unknown option: {option!r}")
+        except ValueError as e:
+            raise SerialException(f"expected a string in the form \"ryzsim://[?option[=value][&...]]\": {e}")
+        return config
+
+    def _reconfigure_port(self, force_update: bool = False):
+        pass
+
+    @property
+    def in_waiting(self) -> int:
+        if not self.is_open:
+            raise PortNotOpenError()
+        return self.modem.in_waiting
+
+    def read(self, size: int = 1) -> bytes:
+        if not self.is_open:
+            raise PortNotOpenError()
+        return self.modem.read(size, self._timeout)
+
+    def write(self, data) -> int:
+        if not self.is_open:
+            raise PortNotOpenError()
+        return self.modem.write(bytes(data))
+
+    def reset_input_buffer(self):
+        if not self.is_open:
+            raise PortNotOpenError()
+        self.modem.reset_input_buffer()
+
+    def reset_output_buffer(self):
+        if not self.is_open:
+            raise PortNotOpenError()
+
+    @property
+    def out_waiting(self) -> int:
+        return 0
+
+    @property
+    def cts(self) -> bool:
+        return True
+
+    @property
+    def dsr(self) -> bool:
+        return True
+
+    @property
+    def ri(self) -> bool:
+        return False
+
+    @property
+    def cd(self) -> bool:
+        return True
@@ -0,0 +1,140 @@
+import re
+from enum import IntEnum
+from typing import Any, Callable, Dict, List, Optional, Tuple, Type
+
+from .framer import Frame
+
+
+# One field of a result line: a quoted string, which may hold commas, or anything up to the next comma
+FIELD_PATTERN = re.compile(rb'\s*((?:"[^"]*"|[^,])*)(,?)')
+
+# Placeholder for fields that have not been decoded yet
+_UNDECODED = object()
+
+
+def text(value: bytes) -> str:
+    # "application/json" -> application/json
+    return bytes(value).strip().strip(b"\"").decode(errors="replace")
+
+
+def hex_int(value: bytes) -> int:
+    # "1A2B" -> 0x1A2B, as +CEREG reports the tracking area code and cell id
+    return int(text(value), 16)
+
+
+def enum_value(enum: Type[IntEnum], default: Optional[IntEnum] = None) -> Callable[[bytes], Any]:
+    # Values the enum does not know decode to default, or raise ValueError without one
+    def decode(value: bytes):
+        try:
+            return enum(int(value))
+        except ValueError:
+            if default is None:
+                raise
+            return default
+    return decode
+
+
+class Field:
+    # A field of a Record, decoded from the line on first access and cached. Fields beyond the end of the
+    # line, and empty ones, read as default
+
+    def __init__(self, index: int, decode: Callable[[bytes], Any] = int, default: Any = None):
+        self.index = index
+        self.decode = decode
+        self.default = default
+        self.name = ""
+
+    def __set_name__(self, owner, name: str):
+        self.name = name
+
+    def __get__(self, record: Optional["Record"], owner=None):
+        if record is None:
+            return self
+        values = record._decoded()
+        value = values[self.index]
+        if value is _UNDECODED:
+            raw = record.raw(self.index)
+            value = self.default if raw is None or not raw else self.decode(raw)
+            values[self.index] = value
+        return value
+
+
+class Record:
+    # Base of the typed result and URC records. A subclass lists its fields as Field class attributes and
+    # names the line prefix it parses; subclasses with a prefix are entered in RECORDS, the table
+    # parse_record() dispatches on. Creating a record only keeps a reference to the line: the field
+    # boundaries are found on the first access, and each field is decoded when it is read
+
+    __slots__ = ("_line", "_start", "_spans", "_values")
+
+    PREFIX: Optional[str] = None
+    FIELDS: Tuple[Field, ...] = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        fields = (getattr(cls, name) for name in dir(cls))
+        cls.FIELDS = tuple(sorted((field for field in fields if isinstance(field, Field)), key=lambda field: field.index))
+        cls._width = max((field.index + 1 for field in cls.FIELDS), default=0)
+        if cls.PREFIX is not None and "PREFIX" in vars(cls):
+            RECORDS[cls.PREFIX.encode()] = cls
+
+    def __init__(self, line: bytes):
+        # line is the whole result line, prefix included: b"+SQNSRING: 1,5"
+        self._line = line
+        self._start = line.find(b":") + 1
+        self._spans: Optional[List[Tuple[int, int]]] = None
+        self._values: Optional[List[Any]] = None
+
+    @classmethod
+    def from_frame(cls, frame: Frame):
+        return cls(frame.data)
+
+    def __len__(self) -> int:
+        # number of fields on the line
+        return len(self._split())
+
+    def raw(self, index: int) -> Optional[bytes]:
+        # Undecoded field, None beyond the end of the line
+        spans = self._split()
+        if index >= len(spans):
+            return None
+        start, end = spans[index]
+        return self._line[start:end]
+
+    def _split(self) -> List[Tuple[int, int]]:
+        if self._spans is None:
+            spans = []
+            line = self._line
+            position = self._start
+            while True:
+                match = FIELD_PATTERN.match(line, position)
+                start, end = match.span(1)
+                while end > start and line[end - 1] in b" \r\n":
+                    end -= 1
+                spans.append((start, end))
+                if not match.group(2):
+                    break
+                position = match.end()
+            self._spans = spans
+        return self._spans
+
+    def _decoded(self) -> List[Any]:
+        if self._values is None:
+            self._values = [_UNDECODED] * self._width
+        return self._values
+
+    def __repr__(self) -> str:
+        fields = ", ".join(f"{field.name}={getattr(self, field.name)!r}" for field in self.FIELDS)
+        return f"{type(self).__name__}({fields})"
+
+
+# Line prefix -> record type, filled in by the Record subclasses of each module
+RECORDS: Dict[bytes, Type[Record]] = {}
+
+
+def parse_record(frame: Frame) -> Optional[Record]:
+    # Typed record of a result or URC line, None for lines no record is defined for
+    record_type = RECORDS.get(frame.prefix)
+    if record_type is None:
+        return None
+    return record_type(frame.data)
@@ -0,0 +1,216 @@
+import asyncio
+from enum import IntEnum
+import random
+import time
+from typing import FrozenSet, Optional
+
+from .engine import ATResponse, RESPONSE_ERROR
+from .framer import FINAL_RESULT_NO_CARRIER
+from .network import REGISTRATION_STATUS, NetworkMonitor
+
+
+class FAILURE(IntEnum):
+    # Retrying cannot help, e.g. the command is malformed or not allowed in this state
+    PERMANENT = 0
+    # The modem refused the command without acting on it, e.g. no network service. Any command can be retried
+    REJECTED = 1
+    # The outcome is unknown: a timeout, NO CARRIER, a network timeout. Only idempotent commands are retried
+    TRANSIENT = 2
+
+
+class BREAKER_STATE(IntEnum):
+    CLOSED = 0
+    OPEN = 1
+    # One network command is let through to find out if the network is back
+    HALF_OPEN = 2
+
+
+# +CME ERROR codes (3GPP TS 27.007)
+CME_SIM_BUSY = 14
+CME_NO_NETWORK_SERVICE = 30
+CME_NETWORK_TIMEOUT = 31
+CME_EMERGENCY_CALLS_ONLY = 32
+CME_UNKNOWN = 100
+
+REJECTED_CME_ERRORS = frozenset((CME_SIM_BUSY, CME_NO_NETWORK_SERVICE, CME_EMERGENCY_CALLS_ONLY))
+TRANSIENT_CME_ERRORS = frozenset((CME_NETWORK_TIMEOUT, CME_UNKNOWN))
+
+CME_ERROR = b"+CME ERROR:"
+
+# Commands that leave the modem and the server in the same state however many times they are issued.
+# The others (AT+SQNHTTPSND, AT+SQNSSENDEXT, AT+SQNSMQTTPUBLISH, AT+SQNSRECV, ...) are only retried when
+# the modem refused them. "" is the bare AT. AT+SQNSMQTTCONNECT is left out: a repeated connect can fail
+# against a session the first one opened, and MQTTClient reconnects by itself
+IDEMPOTENT_VERBS = frozenset(("",
+                              "+CEREG",
+                              "+SQNHTTPCFG",
+                              "+SQNHTTPQRY",
+                              "+SQNSCFG",
+                              "+SQNSMQTTCFG",
+                              "+SQNSMQTTSUBSCRIBE",
+                              "+SQNSMQTTUNSUBSCRIBE",
+                              "+SQNSS"
+                              ))
+
+# Commands that need the modem registered to the network. The circuit breaker only holds these back.
+# AT+SQNSMQTTCONNECT is paced by the reconnect loop of MQTTClient instead
+NETWORK_VERBS = frozenset(("+SQNHTTPQRY",
+                           "+SQNHTTPSND",
+                           "+SQNSD",
+                           "+SQNSO",
+                           "+SQNSSENDEXT",
+                           "+SQNSMQTTPUBLISH",
+                           "+SQNSMQTTSUBSCRIBE",
+                           "+SQNSMQTTUNSUBSCRIBE"
+                           ))
+
+# Registration states in which network commands cannot succeed. UNKNOWN is also what NetworkMonitor reports
+# before it has read the status, so it does not open the breaker
+UNREGISTERED = (REGISTRATION_STATUS.NOT_REGISTERED, REGISTRATION_STATUS.SEARCHING, REGISTRATION_STATUS.DENIED)
+
+RETRY_ATTEMPTS = 4
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 8.0
+
+# Consecutive failed network transactions that open the breaker while the modem is registered, and the
+# seconds before a command is let through again
+BREAKER_THRESHOLD = 5
+BREAKER_COOLDOWN = 30.0
+
+
+def classify(response: ATResponse, error: RESPONSE_ERROR) -> Optional[FAILURE]:
+    # None for a transaction that succeeded
+    if error == RESPONSE_ERROR.OK:
+        return None
+    if error == RESPONSE_ERROR.TIMEOUT:
+        return FAILURE.TRANSIENT
+    final = response.final
+    if final is None:
+        # Refused by the engine itself, e.g. in online mode or by the breaker
+        return FAILURE.PERMANENT
+    if final.data == FINAL_RESULT_NO_CARRIER:
+        return FAILURE.TRANSIENT
+    if final.data.startswith(CME_ERROR):
+        try:
+            code = int(final.data[len(CME_ERROR):])
+        except ValueError:
+            # Verbose error reporting (AT+CMEE=2)
+            return FAILURE.PERMANENT
+        if code in REJECTED_CME_ERRORS:
+            return FAILURE.REJECTED
+        if code in TRANSIENT_CME_ERRORS:
+            return FAILURE.TRANSIENT
+    return FAILURE.PERMANENT
+
+
+class CircuitBreaker:
+    # Fails network commands at once while they cannot succeed, instead of after their timeouts and retries.
+    # Open while the NetworkMonitor reports the modem not registered, closed as soon as it is registered
+    # again. While registered, it also opens after `threshold` consecutive network transactions failed for
+    # a reason that can go away, and lets one through `cooldown` seconds later: closed if it succeeds,
+    # open for another cooldown if not
+
+    def __init__(self, monitor: NetworkMonitor,
+                 threshold: int = BREAKER_THRESHOLD,
+                 cooldown: float = BREAKER_COOLDOWN):
+        self._monitor = monitor
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened = 0
+        self.rejected = 0
+        self._opened_at: Optional[float] = None
+        self._trial = False
+        monitor.on_change(self._on_registration)
+
+    @property
+    def state(self) -> BREAKER_STATE:
+        if self._monitor.status in UNREGISTERED:
+            return BREAKER_STATE.OPEN
+        if self._opened_at is None:
+            return BREAKER_STATE.CLOSED
+        if time.monotonic() - self._opened_at < self.cooldown:
+            return BREAKER_STATE.OPEN
+        return BREAKER_STATE.HALF_OPEN
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == BREAKER_STATE.CLOSED:
+            return True
+        if state == BREAKER_STATE.HALF_OPEN and not self._trial:
+            self._trial = True
+            return True
+        self.rejected += 1
+        return False
+
+    def record(self, failure: Optional[FAILURE]):
+        # A permanent failure was answered by the modem, so it says nothing against the network
+        if failure is None or failure == FAILURE.PERMANENT:
+            self.failures = 0
+            self._opened_at = None
+            self._trial = False
+            return
+        self.failures += 1
+        if self._trial or (self._opened_at is None and self.failures >= self.threshold):
+            self._opened_at = time.monotonic()
+            self.opened += 1
+        self._trial = False
+
+    def _on_registration(self, status: REGISTRATION_STATUS):
+        if self._monitor.registered:
+            self.failures = 0
+            self._opened_at = None
+            self._trial = False
+
+
+class RetryPolicy:
+    # Retries AT transactions that failed for a reason that can go away (see classify()). Commands outside
+    # idempotent_verbs are only retried when the modem refused them, never when the outcome is unknown.
+    # Attempts are spaced by exponential backoff with full jitter and never run past the transaction
+    # deadline. The optional breaker holds back network commands while they cannot succeed
+
+    def __init__(self, breaker: Optional[CircuitBreaker] = None,
+                 attempts: int = RETRY_ATTEMPTS,
+                 base_delay: float = RETRY_BASE_DELAY,
+                 max_delay: float = RETRY_MAX_DELAY,
+                 idempotent_verbs: FrozenSet[str] = IDEMPOTENT_VERBS,
+                 seed: Optional[int] = None):
+        self.breaker = breaker
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.idempotent_verbs = idempotent_verbs
+        self.retries = 0
+        self._random = random.Random(seed)
+
+    def allow(self, verb: str) -> bool:
+        return self.breaker is None or verb not in NETWORK_VERBS or self.breaker.allow()
+
+    def record(self, verb: str, failure: Optional[FAILURE]):
+        if self.breaker is not None and verb in NETWORK_VERBS:
+            self.breaker.record(failure)
+
+    def should_retry(self, verb: str, failure: Optional[FAILURE], attempt: int) -> bool:
+        # attempt counts from 0
+        if failure is None or failure == FAILURE.PERMANENT or attempt + 1 >= self.attempts:
+            return False
+        return failure == FAILURE.REJECTED or verb in self.idempotent_verbs
+
+    def retryable(self, verb: str, response: ATResponse, error: RESPONSE_ERROR, attempt: int,
+                  payload_written: bool = False) -> bool:
+        # Records the outcome of a transaction with the breaker and tells if it is worth another attempt.
+        # Once the payload of a data command was written, a refusal no longer means the modem did nothing
+        failure = classify(response, error)
+        self.record(verb, failure)
+        if failure == FAILURE.REJECTED and payload_written:
+            failure = FAILURE.TRANSIENT
+        return self.should_retry(verb, failure, attempt)
+
+    async def backoff(self, attempt: int, remaining: float) -> bool:
+        # Waits before the next attempt. False, without waiting, if the deadline would pass first
+        delay = self._random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        if delay >= remaining:
+            return False
+        await asyncio.sleep(delay)
+        self.retries += 1
+        return True
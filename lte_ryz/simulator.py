@@ -0,0 +1,760 @@
+import collections
+import csv
+import heapq
+import itertools
+import json
+import random
+import re
+import threading
+import time
+from dataclasses import dataclass, field
+from enum import IntEnum
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+
+
+# Every byte on the UART is a start bit, 8 data bits and a stop bit
+BITS_PER_BYTE = 10
+
+# Throttled output is released to the host in pieces of this size, so long responses trickle in the way
+# they do on a real UART
+UART_PIECE_SIZE = 64
+
+SOCKET_IDS = range(1, 7)
+UDP = 1
+# AT+SQNSD <acceptAnyRemote>: 2 receives from and sends to any remote address
+RECEIVE_SEND_ANY = 2
+
+# Address reported for the simulated modem in the +SQNSS table
+LOCAL_IP = "10.0.0.2"
+
+DATA_PROMPT = b"> "
+# Sent instead of OK when a socket enters online (transparent) mode, and when it leaves it because the
+# connection was closed
+CONNECT = b"\r\nCONNECT\r\n"
+NO_CARRIER = b"\r\nNO CARRIER\r\n"
+# In online mode, "+++" surrounded by guard_time of silence returns the modem to command mode
+ESCAPE_SEQUENCE = b"+++"
+HTTP_RCV_MARKER = b"<<<"
+
+# +CME ERROR codes used by the simulator
+CME_OPERATION_NOT_ALLOWED = 3
+CME_NOT_FOUND = 22
+CME_NO_NETWORK_SERVICE = 30
+
+# +CEREG registration status: 1 registered (home network), 5 registered (roaming)
+REGISTERED_HOME = 1
+REGISTERED_ROAMING = 5
+
+# Commands that need the modem registered to the network
+NETWORK_COMMANDS = ("+SQNHTTPQRY", "+SQNHTTPSND", "+SQNSMQTTCONNECT", "+SQNSMQTTPUBLISH", "+SQNSMQTTSUBSCRIBE",
+                    "+SQNSD", "+SQNSSENDEXT")
+
+# Matches "AT", "ATE0", "AT+SQNSS", "AT+CEREG?", "AT+SQNSD=1,0,..."
+COMMAND_PATTERN = re.compile(r"^AT(\+?[A-Z0-9]*)(=\?|\?|=)?(.*)$", re.IGNORECASE)
+
+
+class SOCKET_STATE(IntEnum):
+    CLOSED = 0
+    ACTIVE_TXSFER_CONNECTION = 1
+    SUSPENDED_NO_PENDING_DATA = 2
+    SUSPENDED_PENDING_DATA = 3
+
+
+# (method, host, path, body) -> (status, content type, content)
+HTTPServer = Callable[[str, str, str, bytes], Tuple[int, str, bytes]]
+# (connection id, data sent by the modem) -> data sent back by the remote end
+SocketServer = Callable[[int, bytes], bytes]
+
+
+def httpbin_server(method: str, host: str, path: str, body: bytes) -> Tuple[int, str, bytes]:
+    # A small stand-in for httpbin.org: /stream/<n> returns n JSON lines, /status/<code> returns that
+    # status, anything else echoes the request back as JSON
+    url = "http://" + host + path
+    parts = path.split("?", 1)[0].strip("/").split("/")
+    if parts[0] == "status" and len(parts) > 1 and parts[1].isdigit():
+        return int(parts[1]), "text/html; charset=utf-8", b""
+    if parts[0] == "stream" and len(parts) > 1 and parts[1].isdigit():
+        records = (json.dumps({"url": url, "args": {}, "headers": {"Host": host}, "origin": LOCAL_IP, "id": i})
+                   for i in range(min(int(parts[1]), 100)))
+        return 200, "application/json", "".join(record + "\n" for record in records).encode()
+
+    data = body.decode(errors="replace")
+    try:
+        body_json = json.loads(data) if data else None
+    except ValueError:
+        body_json = None
+    echo = {"args": {},
+            "data": data,
+            "headers": {"Host": host, "Content-Length": str(len(body))},
+            "json": body_json,
+            "method": method,
+            "origin": LOCAL_IP,
+            "url": url}
+    return 200, "application/json", json.dumps(echo, indent=2).encode()
+
+
+def echo_server(connection_id: int, data: bytes) -> bytes:
+    return data
+
+
+def topic_matches(topic_filter: str, topic: str) -> bool:
+    # MQTT topic filter matching with the + (single level) and # (remaining levels) wildcards
+    filter_levels = topic_filter.split("/")
+    topic_levels = topic.split("/")
+    for i, level in enumerate(filter_levels):
+        if level == "#":
+            return True
+        if i >= len(topic_levels) or (level != "+" and level != topic_levels[i]):
+            return False
+    return len(filter_levels) == len(topic_levels)
+
+
+@dataclass
+class SimulatorConfig:
+    # Delay before the modem answers a command
+    latency: float = 0.0
+    # Delay before results that come back from the network are reported (+SQNHTTPRING, +SQNSRING,
+    # +SQNSMQTTON...)
+    network_latency: float = 0.05
+    # UART speed used to pace the data in both directions. 0 disables throttling
+    baudrate: int = 115200
+    # Probability that a command fails with +CME ERROR regardless of its arguments
+    error_rate: float = 0.0
+    seed: Optional[int] = None
+    # Echo commands back, like the modem does until ATE0
+    echo: bool = False
+    # Silence required before and after the "+++" escape sequence in online mode
+    guard_time: float = 1.0
+    # Probability that a UDP datagram is lost, in each direction
+    packet_loss: float = 0.0
+
+
+@dataclass
+class _Socket:
+    protocol: int
+    remote_ip: str
+    remote_port: int
+    local_port: int
+    accept_any_remote: int = 0
+    pending: bytearray = field(default_factory=bytearray)
+    # UDP keeps the datagram boundaries: (data, remote ip, remote port)
+    datagrams: Deque[Tuple[bytes, str, int]] = field(default_factory=collections.deque)
+
+    @property
+    def state(self) -> SOCKET_STATE:
+        if self.pending or self.datagrams:
+            return SOCKET_STATE.SUSPENDED_PENDING_DATA
+        return SOCKET_STATE.SUSPENDED_NO_PENDING_DATA
+
+    @property
+    def pending_length(self) -> int:
+        return len(self.pending) + sum(len(datagram[0]) for datagram in self.datagrams)
+
+
+@dataclass
+class _MqttMessage:
+    topic: str
+    payload: bytes
+    qos: int
+
+
+class ModemSimulator:
+    # Emulates the subset of the Sequans AT command set used by the scripts in this repository. The host
+    # side looks like a serial port: write() takes the bytes sent to the modem and read() returns the
+    # bytes sent back, paced by the configured baud rate. Expose it with the ryzsim:// URL handler or the
+    # pty in simulator/modem_simulator.py
+
+    def __init__(self, config: Optional[SimulatorConfig] = None,
+                 http_server: HTTPServer = httpbin_server,
+                 socket_server: SocketServer = echo_server):
+        self.config = config or SimulatorConfig()
+        self._random = random.Random(self.config.seed)
+        self._http_server = http_server
+        self._socket_server = socket_server
+
+        # A re-entrant lock lets scheduled events run command handlers that emit further output
+        self._cv = threading.Condition(threading.RLock())
+        self._running = False
+        self._worker: Optional[threading.Thread] = None
+        self._events: List[Tuple[float, int, Callable[[], None]]] = []
+        self._sequence = itertools.count()
+
+        # Output on its way to the host as (time it has crossed the UART, bytes), and output that has
+        # arrived but not been read yet
+        self._tx: Deque[Tuple[float, bytes]] = collections.deque()
+        self._tx_free_at = 0.0
+        self._rx_ready = bytearray()
+
+        # Input from the host. After a '>' prompt the next _data_length bytes go to _data_handler
+        self._input = bytearray()
+        self._data = bytearray()
+        self._data_length: Optional[int] = None
+        self._data_handler: Optional[Callable[[bytes], None]] = None
+
+        self._handlers: Dict[str, Callable[[List[str], str], None]] = {
+            "": self._at,
+            "E0": self._echo_off,
+            "E1": self._echo_on,
+            "+CEREG": self._cereg,
+            "+CFUN": self._cfun,
+            "+SQNHTTPCFG": self._http_cfg,
+            "+SQNHTTPQRY": self._http_qry,
+            "+SQNHTTPSND": self._http_snd,
+            "+SQNHTTPRCV": self._http_rcv,
+            "+SQNSMQTTCFG": self._mqtt_cfg,
+            "+SQNSMQTTCONNECT": self._mqtt_connect,
+            "+SQNSMQTTDISCONNECT": self._mqtt_disconnect,
+            "+SQNSMQTTSUBSCRIBE": self._mqtt_subscribe,
+            "+SQNSMQTTUNSUBSCRIBE": self._mqtt_unsubscribe,
+            "+SQNSMQTTPUBLISH": self._mqtt_publish,
+            "+SQNSMQTTRCVMESSAGE": self._mqtt_rcv_message,
+            "+SQNSCFG": self._socket_cfg,
+            "+SQNSD": self._socket_dial,
+            "+SQNSSENDEXT": self._socket_send,
+            "+SQNSRECV": self._socket_receive,
+            "+SQNSS": self._socket_status,
+            "+SQNSH": self._socket_close,
+            "+SQNSO": self._socket_resume,
+        }
+
+        self._echo = self.config.echo
+        self._registration = REGISTERED_HOME
+        # +CEREG reporting mode set with AT+CEREG=<n>, 0: no notifications
+        self._cereg_mode = 0
+        self._http_hosts: Dict[int, str] = {}
+        self._http_content: Dict[int, memoryview] = {}
+        self._mqtt_connected = False
+        self._mqtt_subscriptions: Dict[str, int] = {}
+        self._mqtt_messages: Dict[int, _MqttMessage] = {}
+        self._mqtt_mid = itertools.count(1)
+        self._sockets: Dict[int, _Socket] = {}
+        # Connection id of the socket in online mode, if any. Everything the host writes is sent on it
+        self._online: Optional[int] = None
+        self._online_last_rx = 0.0
+        self._escape = bytearray()
+        self._local_ports = itertools.count(49152)
+
+        self.commands_received = 0
+        self.bytes_received = 0
+        self.bytes_sent = 0
+
+    def start(self):
+        with self._cv:
+            self._running = True
+        self._worker = threading.Thread(target=self._run_events, daemon=True)
+        self._worker.start()
+
+    def stop(self):
+        with self._cv:
+            self._running = False
+            self._cv.notify_all()
+        if self._worker is not None:
+            self._worker.join()
+
+    # Host side of the UART
+
+    @property
+    def in_waiting(self) -> int:
+        with self._cv:
+            self._arrived(time.monotonic())
+            return len(self._rx_ready)
+
+    def read(self, size: int, timeout: Optional[float] = None) -> bytes:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cv:
+            while True:
+                now = time.monotonic()
+                self._arrived(now)
+                if self._rx_ready or not self._running:
+                    break
+                waits = [when - now for when in (self._tx[0][0] if self._tx else None, deadline) if when is not None]
+                if deadline is not None and deadline <= now:
+                    break
+                self._cv.wait(min(waits) if waits else None)
+            data = bytes(self._rx_ready[:size])
+            del self._rx_ready[:size]
+            return data
+
+    def write(self, data: bytes) -> int:
+        if self.config.baudrate:
+            time.sleep(len(data) * BITS_PER_BYTE / self.config.baudrate)
+        with self._cv:
+            self.bytes_received += len(data)
+            if self._online is not None:
+                self._online_received(data)
+            else:
+                self._input += data
+                self._parse_input()
+        return len(data)
+
+    def reset_input_buffer(self):
+        with self._cv:
+            self._tx.clear()
+            self._rx_ready.clear()
+
+    # Events originating from the network
+
+    def inject_mqtt_message(self, topic: str, payload: bytes, qos: int = 1):
+        # Deliver a message from the broker as if another client had published it
+        with self._cv:
+            self._deliver_mqtt_message(topic, payload, qos)
+
+    def drop_mqtt_connection(self, reason: int = 7):
+        # The broker connection is lost, as if the network went away (7: connection lost)
+        with self._cv:
+            if self._mqtt_connected:
+                self._mqtt_connected = False
+                self._mqtt_subscriptions.clear()
+                self._urc(f"+SQNSMQTTONDISCONNECT: 0,{reason}", delay=0)
+
+    def set_registration(self, status: int):
+        # Change the network registration status (+CEREG <stat>). Losing the registration drops the
+        # broker connection, and network commands fail until the modem is registered again
+        with self._cv:
+            if status == self._registration:
+                return
+            self._registration = status
+            if self._cereg_mode:
+                self._urc(f"+CEREG: {status}", delay=0)
+            if not self.registered:
+                self.drop_mqtt_connection()
+
+    @property
+    def registered(self) -> bool:
+        return self._registration in (REGISTERED_HOME, REGISTERED_ROAMING)
+
+    def inject_socket_data(self, connection_id: int, data: bytes):
+        with self._cv:
+            self._socket_data_received(connection_id, data)
+
+    def remote_close(self, connection_id: int):
+        with self._cv:
+            if self._sockets.pop(connection_id, None) is None:
+                return
+            if self._online == connection_id:
+                # Back to command mode
+                self._online = None
+                self._escape.clear()
+                self._send(NO_CARRIER, self.config.network_latency)
+            else:
+                self._urc(f"+SQNSH: {connection_id}")
+
+    def inject_urc(self, urc: str):
+        with self._cv:
+            self._urc(urc, delay=0)
+
+    # Scheduling
+
+    def _schedule(self, delay: float, callback: Callable[[], None]):
+        heapq.heappush(self._events, (time.monotonic() + delay, next(self._sequence), callback))
+        self._cv.notify_all()
+
+    def _run_events(self):
+        with self._cv:
+            while self._running:
+                now = time.monotonic()
+                if self._events and self._events[0][0] <= now:
+                    _, _, callback = heapq.heappop(self._events)
+                    callback()
+                    continue
+                self._cv.wait(self._events[0][0] - now if self._events else None)
+
+    def _send(self, data: bytes, delay: float):
+        self._schedule(delay, lambda: self._transmit(data))
+
+    def _transmit(self, data: bytes):
+        # Queue output behind whatever is still crossing the UART
+        now = time.monotonic()
+        self.bytes_sent += len(data)
+        if not self.config.baudrate:
+            self._tx.append((now, data))
+        else:
+            byte_time = BITS_PER_BYTE / self.config.baudrate
+            for offset in range(0, len(data), UART_PIECE_SIZE):
+                piece = data[offset:offset + UART_PIECE_SIZE]
+                self._tx_free_at = max(now, self._tx_free_at) + len(piece) * byte_time
+                self._tx.append((self._tx_free_at, piece))
+        self._cv.notify_all()
+
+    def _arrived(self, now: float):
+        while self._tx and self._tx[0][0] <= now:
+            self._rx_ready += self._tx.popleft()[1]
+
+    # Responses
+
+    def _respond(self, *lines: str, data: Optional[bytes] = None):
+        response = b"".join(b"\r\n" + line.encode() + b"\r\n" for line in lines)
+        if data is not None:
+            # a binary block follows the last line, or starts a line of its own
+            response += (b"" if lines else b"\r\n") + data + b"\r\n"
+        self._send(response + b"\r\nOK\r\n", self.config.latency)
+
+    def _error(self, code: Optional[int] = None):
+        result = b"ERROR" if code is None else b"+CME ERROR: %d" % code
+        self._send(b"\r\n" + result + b"\r\n", self.config.latency)
+
+    def _prompt(self, length: int, handler: Callable[[bytes], None]):
+        self._data.clear()
+        self._data_length = length
+        self._data_handler = handler
+        self._send(b"\r\n" + DATA_PROMPT, self.config.latency)
+
+    def _urc(self, urc: str, delay: Optional[float] = None):
+        self._send(b"\r\n" + urc.encode() + b"\r\n", self.config.network_latency if delay is None else delay)
+
+    # Command interpreter
+
+    def _parse_input(self):
+        while self._input:
+            if self._data_length is not None:
+                size = min(self._data_length - len(self._data), len(self._input))
+                self._data += self._input[:size]
+                del self._input[:size]
+                if len(self._data) == self._data_length:
+                    handler = self._data_handler
+                    self._data_length = None
+                    self._data_handler = None
+                    handler(bytes(self._data))
+                continue
+
+            end = self._input.find(b"\r")
+            if end < 0:
+                return
+            line = bytes(self._input[:end]).strip(b"\n ").decode(errors="replace")
+            del self._input[:end + 1]
+            if line:
+                self._command(line)
+
+    def _command(self, line: str):
+        self.commands_received += 1
+        if self._echo:
+            self._send(line.encode() + b"\r\n", 0)
+
+        match = COMMAND_PATTERN.match(line)
+        handler = self._handlers.get(match.group(1).upper()) if match else None
+        if handler is None:
+            self._error()
+            return
+        if self.config.error_rate and self._random.random() < self.config.error_rate:
+            self._error(CME_OPERATION_NOT_ALLOWED)
+            return
+        if match.group(1).upper() in NETWORK_COMMANDS and not self.registered and match.group(2) == "=":
+            self._error(CME_NO_NETWORK_SERVICE)
+            return
+
+        operator = match.group(2) or ""
+        args = next(csv.reader([match.group(3)])) if match.group(3) else []
+        try:
+            handler(args, operator)
+        except (IndexError, ValueError):
+            self._error()
+
+    def _at(self, args: List[str], operator: str):
+        self._respond()
+
+    def _echo_off(self, args: List[str], operator: str):
+        self._echo = False
+        self._respond()
+
+    def _echo_on(self, args: List[str], operator: str):
+        self._echo = True
+        self._respond()
+
+    def _cereg(self, args: List[str], operator: str):
+        if operator == "?":
+            self._respond(f"+CEREG: {self._cereg_mode},{self._registration}")
+        else:
+            if operator == "=":
+                self._cereg_mode = int(args[0])
+            self._respond()
+
+    def _cfun(self, args: List[str], operator: str):
+        if operator == "?":
+            self._respond("+CFUN: 1")
+        else:
+            self._respond()
+
+    # HTTP
+
+    def _http_cfg(self, args: List[str], operator: str):
+        profile_id = int(args[0])
+        host = args[1]
+        port = int(args[2]) if len(args) > 2 and args[2] else 80
+        self._http_hosts[profile_id] = host if port == 80 else host + ":" + str(port)
+        self._respond()
+
+    def _http_qry(self, args: List[str], operator: str):
+        profile_id = int(args[0])
+        method = {"0": "GET", "1": "HEAD", "2": "DELETE"}[args[1]]
+        if profile_id not in self._http_hosts:
+            self._error(CME_OPERATION_NOT_ALLOWED)
+            return
+        self._respond()
+        self._http_request(profile_id, method, args[2], b"")
+
+    def _http_snd(self, args: List[str], operator: str):
+        profile_id = int(args[0])
+        method = {"0": "POST", "1": "PUT"}[args[1]]
+        length = int(args[3])
+        if profile_id not in self._http_hosts:
+            self._error(CME_OPERATION_NOT_ALLOWED)
+            return
+
+        def body_received(body: bytes):
+            self._respond()
+            self._http_request(profile_id, method, args[2], body)
+
+        self._prompt(length, body_received)
+
+    def _http_request(self, profile_id: int, method: str, path: str, body: bytes):
+        status, content_type, content = self._http_server(method, self._http_hosts[profile_id], path, body)
+        if method == "HEAD":
+            content = b""
+        self._http_content[profile_id] = memoryview(content)
+        self._urc(f"+SQNHTTPRING: {profile_id},{status},\"{content_type}\",{len(content)}")
+
+    def _http_rcv(self, args: List[str], operator: str):
+        profile_id = int(args[0])
+        max_bytes = int(args[1]) if len(args) > 1 and args[1] else 0
+        content = self._http_content.get(profile_id)
+        if not content:
+            self._error(CME_NOT_FOUND)
+            return
+        size = len(content) if max_bytes <= 0 else min(max_bytes, len(content))
+        self._http_content[profile_id] = content[size:]
+        self._send(b"\r\n" + HTTP_RCV_MARKER + bytes(content[:size]) + b"\r\n\r\nOK\r\n", self.config.latency)
+
+    # MQTT
+
+    def _mqtt_cfg(self, args: List[str], operator: str):
+        self._respond()
+
+    def _mqtt_connect(self, args: List[str], operator: str):
+        if self._mqtt_connected:
+            self._error(CME_OPERATION_NOT_ALLOWED)
+            return
+        self._mqtt_connected = True
+        self._respond()
+        self._urc("+SQNSMQTTONCONNECT: 0,0")
+
+    def _mqtt_disconnect(self, args: List[str], operator: str):
+        if not self._mqtt_connected:
+            self._error(CME_OPERATION_NOT_ALLOWED)
+            return
+        self._mqtt_connected = False
+        self._mqtt_subscriptions.clear()
+        self._respond()
+        self._urc("+SQNSMQTTONDISCONNECT: 0,0")
+
+    def _mqtt_subscribe(self, args: List[str], operator: str):
+        if not self._mqtt_connected:
+            self._error(CME_OPERATION_NOT_ALLOWED)
+            return
+        topic = args[1]
+        self._mqtt_subscriptions[topic] = int(args[2]) if len(args) > 2 and args[2] else 0
+        self._respond()
+        self._urc(f"+SQNSMQTTONSUBSCRIBE: 0,\"{topic}\",0")
+
+    def _mqtt_unsubscribe(self, args: List[str], operator: str):
+        topic = args[1]
+        if not self._mqtt_connected or self._mqtt_subscriptions.pop(topic, None) is None:
+            self._error(CME_OPERATION_NOT_ALLOWED)
+            return
+        self._respond()
+        self._urc(f"+SQNSMQTTONUNSUBSCRIBE: 0,\"{topic}\",0")
+
+    def _mqtt_publish(self, args: List[str], operator: str):
+        if not self._mqtt_connected:
+            self._error(CME_OPERATION_NOT_ALLOWED)
+            return
+        topic = args[1]
+        qos = int(args[2]) if args[2] else 0
+        length = int(args[3])
+
+        def payload_received(payload: bytes):
+            mid = next(self._mqtt_mid)
+            self._respond(f"+SQNSMQTTPUBLISH: 0,{mid}")
+            self._urc(f"+SQNSMQTTONPUBLISH: 0,{mid},0")
+            # The broker hands the message back to this client if it is subscribed to the topic
+            self._schedule(self.config.network_latency, lambda: self._deliver_mqtt_message(topic, payload, qos))
+
+        self._prompt(length, payload_received)
+
+    def _deliver_mqtt_message(self, topic: str, payload: bytes, qos: int):
+        subscriptions = [sub_qos for topic_filter, sub_qos in self._mqtt_subscriptions.items()
+                         if topic_matches(topic_filter, topic)]
+        if not self._mqtt_connected or not subscriptions:
+            return
+        qos = min(qos, max(subscriptions))
+        mid = next(self._mqtt_mid)
+        self._mqtt_messages[mid] = _MqttMessage(topic, payload, qos)
+        if qos == 0:
+            self._urc(f"+SQNSMQTTONMESSAGE: 0,\"{topic}\",{len(payload)},0", delay=0)
+        else:
+            self._urc(f"+SQNSMQTTONMESSAGE: 0,\"{topic}\",{len(payload)},{qos},{mid}", delay=0)
+
+    def _mqtt_rcv_message(self, args: List[str], operator: str):
+        topic = args[1]
+        if len(args) > 2 and args[2]:
+            mid = int(args[2])
+        else:
+            # last message received on the topic
+            mid = max((mid for mid, message in self._mqtt_messages.items() if message.topic == topic), default=None)
+        message = self._mqtt_messages.pop(mid, None)
+        if message is None or message.topic != topic:
+            self._error(CME_NOT_FOUND)
+            return
+        self._respond(data=message.payload)
+
+    # Sockets
+
+    def _socket_cfg(self, args: List[str], operator: str):
+        if int(args[0]) not in SOCKET_IDS:
+            self._error(CME_OPERATION_NOT_ALLOWED)
+            return
+        self._respond()
+
+    def _socket_dial(self, args: List[str], operator: str):
+        connection_id = int(args[0])
+        if connection_id not in SOCKET_IDS or connection_id in self._sockets:
+            self._error(CME_OPERATION_NOT_ALLOWED)
+            return
+        connection_mode = int(args[6]) if len(args) > 6 and args[6] else 0
+        self._sockets[connection_id] = _Socket(protocol=int(args[1]),
+                                               remote_ip=args[3],
+                                               remote_port=int(args[2]),
+                                               local_port=next(self._local_ports),
+                                               accept_any_remote=int(args[7]) if len(args) > 7 and args[7] else 0)
+        if connection_mode == 0:
+            self._go_online(connection_id)
+        else:
+            self._respond()
+
+    def _socket_resume(self, args: List[str], operator: str):
+        # AT+SQNSO=<connId> resumes online mode on a socket suspended with the escape sequence
+        connection_id = int(args[0])
+        if connection_id not in self._sockets or self._online is not None:
+            self._error(CME_OPERATION_NOT_ALLOWED)
+            return
+        self._go_online(connection_id)
+
+    def _go_online(self, connection_id: int):
+        socket = self._sockets[connection_id]
+        self._online = connection_id
+        self._online_last_rx = time.monotonic()
+        self._send(CONNECT, self.config.latency)
+        if socket.pending:
+            # data received while suspended follows the CONNECT
+            self._send(bytes(socket.pending), self.config.latency)
+            socket.pending.clear()
+
+    def _online_received(self, data: bytes):
+        # The escape sequence only counts when it is preceded and followed by guard_time of silence.
+        # Anything else is payload for the remote end
+        now = time.monotonic()
+        silent = now - self._online_last_rx >= self.config.guard_time
+        self._online_last_rx = now
+        if (self._escape or silent) and ESCAPE_SEQUENCE.startswith(self._escape + data):
+            self._escape += data
+            if self._escape == ESCAPE_SEQUENCE:
+                self._schedule(self.config.guard_time, lambda: self._check_escape(now))
+            return
+        data = bytes(self._escape) + data
+        self._escape.clear()
+        self._online_send(self._online, data)
+
+    def _check_escape(self, received_at: float):
+        if self._online is None or self._escape != ESCAPE_SEQUENCE or self._online_last_rx != received_at:
+            return
+        self._escape.clear()
+        self._online = None
+        self._send(b"\r\nOK\r\n", 0)
+
+    def _online_send(self, connection_id: int, data: bytes):
+        reply = self._socket_server(connection_id, data)
+        if reply:
+            self._schedule(self.config.network_latency, lambda: self._socket_data_received(connection_id, reply))
+
+    def _socket_send(self, args: List[str], operator: str):
+        # AT+SQNSSENDEXT=<connId>,<length>[,<rai>[,<remoteIp>,<remotePort>]]
+        connection_id = int(args[0])
+        length = int(args[1])
+        socket = self._sockets.get(connection_id)
+        if socket is None:
+            self._error(CME_OPERATION_NOT_ALLOWED)
+            return
+        address = (socket.remote_ip, socket.remote_port)
+        if len(args) > 4 and args[3]:
+            if socket.protocol != UDP or socket.accept_any_remote != RECEIVE_SEND_ANY:
+                self._error(CME_OPERATION_NOT_ALLOWED)
+                return
+            address = (args[3], int(args[4]))
+
+        def data_received(data: bytes):
+            self._respond()
+            if socket.protocol == UDP and self._lost():
+                return
+            reply = self._socket_server(connection_id, data)
+            if reply and not (socket.protocol == UDP and self._lost()):
+                self._schedule(self.config.network_latency,
+                               lambda: self._socket_data_received(connection_id, reply, address))
+
+        self._prompt(length, data_received)
+
+    def _lost(self) -> bool:
+        return bool(self.config.packet_loss) and self._random.random() < self.config.packet_loss
+
+    def _socket_data_received(self, connection_id: int, data: bytes, address: Optional[Tuple[str, int]] = None):
+        socket = self._sockets.get(connection_id)
+        if socket is None:
+            return
+        if self._online == connection_id:
+            self._send(data, 0)
+            return
+        if socket.protocol == UDP:
+            ip, port = address or (socket.remote_ip, socket.remote_port)
+            socket.datagrams.append((data, ip, port))
+        else:
+            socket.pending += data
+        self._urc(f"+SQNSRING: {connection_id},{socket.pending_length}", delay=0)
+
+    def _socket_receive(self, args: List[str], operator: str):
+        connection_id = int(args[0])
+        max_bytes = int(args[1])
+        socket = self._sockets.get(connection_id)
+        if socket is None:
+            self._error(CME_OPERATION_NOT_ALLOWED)
+            return
+        if socket.protocol == UDP:
+            # One datagram per read, the part that does not fit is discarded. Sockets accepting any remote
+            # report the sender after the length
+            if not socket.datagrams:
+                self._respond(f"+SQNSRECV: {connection_id},0", data=b"")
+                return
+            data, ip, port = socket.datagrams.popleft()
+            data = data[:max_bytes]
+            if socket.accept_any_remote == RECEIVE_SEND_ANY:
+                self._respond(f"+SQNSRECV: {connection_id},{len(data)},\"{ip}\",{port}", data=data)
+            else:
+                self._respond(f"+SQNSRECV: {connection_id},{len(data)}", data=data)
+            return
+        data = bytes(socket.pending[:max_bytes])
+        del socket.pending[:len(data)]
+        self._respond(f"+SQNSRECV: {connection_id},{len(data)}", data=data)
+
+    def _socket_status(self, args: List[str], operator: str):
+        lines = []
+        for connection_id in SOCKET_IDS:
+            socket = self._sockets.get(connection_id)
+            if socket is None:
+                lines.append(f"+SQNSS: {connection_id},{SOCKET_STATE.CLOSED.value}")
+            else:
+                lines.append(f"+SQNSS: {connection_id},{socket.state.value},\"{LOCAL_IP}\",{socket.local_port},"
+                             f"\"{socket.remote_ip}\",{socket.remote_port},{socket.protocol}")
+        self._respond(*lines)
+
+    def _socket_close(self, args: List[str], operator: str):
+        if self._sockets.pop(int(args[0]), None) is None:
+            self._error(CME_OPERATION_NOT_ALLOWED)
+            return
+        self._respond()
@@ -0,0 +1,884 @@
+import asyncio
+import collections
+import concurrent.futures
+from dataclasses import dataclass
+from enum import IntEnum
+import struct
+from typing import AsyncIterator, Deque, Dict, List, Optional, Sequence, Tuple, Union
+
+from .engine import DEFAULT_TIMEOUT, ESCAPE_GUARD_TIME, ATEngine, ATResponse, RESPONSE_ERROR, RxBlock
+from .framer import Frame
+from .records import Field, Record, enum_value, text
+
+
+# This command sets the socket configuration parameters.
+SOCKET_CFG_CMD = "AT+SQNSCFG="
+
+# This command opens a remote connection using a socket.
+SOCKET_DIAL_CMD_HEADER = "AT+SQNSD="
+
+# This command closes a socket connection
+SOCKET_DISCONNECT_CMD_HEADER = "AT+SQNSH="
+
+# A This command allows to send binary data on a connected socket while the module is in ‘command mode’.
+SOCKET_SEND_COMMAND_MODE_CMD_HEADER = "AT+SQNSSENDEXT="
+
+# This command resumes online mode on a socket suspended with the +++ escape sequence
+SOCKET_RESUME_CMD_HEADER = "AT+SQNSO="
+
+# This command dumps the data received on a connected socket while the module is in ‘command mode’.
+SOCKET_RECEIVE_CMD = "AT+SQNSRECV="
+# The data follows the "+SQNSRECV: <connId>,<length>" line of the response. UDP sockets that accept any
+# remote report the sender as well: "+SQNSRECV: <connId>,<length>,<remoteIp>,<remotePort>"
+SOCKET_RECEIVE_HEADER = b"+SQNSRECV"
+SOCKET_RECEIVE_LENGTH_FIELD = 1
+
+# Largest read AT+SQNSRECV accepts
+SOCKET_RECV_CHUNK_SIZE = 1500
+
+# Bytes ModemSocket buffers before it stops draining the modem
+RECV_BUFFER_LIMIT = 64 * 1024
+
+# Datagrams UDPSocket buffers before it stops draining the modem
+RECV_DATAGRAM_LIMIT = 256
+
+# UDPBatcher defaults: how long a message may wait for others to share its datagram, and the largest
+# datagram it builds. Datagrams up to SOCKET_RECV_CHUNK_SIZE are read back in a single AT+SQNSRECV
+UDP_BATCH_WINDOW = 0.05
+UDP_BATCH_MAX_SIZE = SOCKET_RECV_CHUNK_SIZE
+
+# Every message in a batched datagram is preceded by its length, 2 bytes big endian
+UDP_BATCH_LENGTH = struct.Struct(">H")
+
+# This command reports the current status of the sockets.
+SOCKET_STATUS_CMD = "AT+SQNSS"
+SOCKET_STATUS = "+SQNSS"
+
+# Reported when data is pending on a socket, and when the remote end closes it
+SOCKET_RING = "+SQNSRING"
+SOCKET_CLOSED = "+SQNSH"
+
+# The modem provides six sockets, identified by their connection id
+SOCKET_IDS = (1, 2, 3, 4, 5, 6)
+
+# Socket commands complete faster than HTTP/MQTT, so give up on them sooner
+SOCKET_TIMEOUT = 10
+
+
+class SOCKET_STATE(IntEnum):
+    CLOSED = 0
+    ACTIVE_TXSFER_CONNECTION = 1
+    SUSPENDED_NO_PENDING_DATA = 2
+    SUSPENDED_PENDING_DATA = 3
+    LISTENING = 4
+    INCOMING_CONNECTION = 5
+    IN_OPENING_PROCESS = 6
+
+
+class TRANSMISSION_PROTOCOL(IntEnum):
+    TCP = 0
+    UDP = 1
+
+
+class TCP_CLOSURE(IntEnum):
+    HANG_UP_AFTER_REMOTE = 0
+    HANG_UP_AFTER_ESCAPE = 255
+
+
+class CONNECTION_MODE(IntEnum):
+    ONLINE_MODE = 0
+    COMMAND_MODE = 1
+
+
+class ACCEPT_ANY_REMPOTE(IntEnum):
+    DISABLED = 0
+    ACCEPTS_ANY = 1
+    RECEIVE_SEND_ANY = 2
+
+
+class CONNECTION_SETUP(IntEnum):
+    SYNCHRONOUS = 0
+    ASYNCHRONOUS = 1
+
+
+class CONNECTION_SETUP_RESULT(IntEnum):
+    OK = 0
+    NO_CARRIER = 1
+    UNKNOWN = 2
+    COINNECTION_REFUSED = 3
+    AUTHENTICATION_REJECTED = 4
+
+
+def config_socket_cmd(connection_id: int,
+                      cid: int = 1,
+                      packet_size: int = 0,
+                      max_timeout: int = 0,
+                      connection_timeout: int = 600,
+                      tx_timeout: int = 50):
+
+    return SOCKET_CFG_CMD + \
+           str(connection_id) + "," + \
+           str(cid) + "," + \
+           str(packet_size) + "," + \
+           str(max_timeout) + "," + \
+           str(connection_timeout) + "," + \
+           str(tx_timeout)
+
+
+def dial_socket_cmd(connection_id: int,
+                    tx_protocol: TRANSMISSION_PROTOCOL,
+                    remote_host_port: int,
+                    ip_addr: str,
+                    closure: TCP_CLOSURE = TCP_CLOSURE.HANG_UP_AFTER_REMOTE,
+                    udp_local_port: int = 0,
+                    conn_mode: CONNECTION_MODE = CONNECTION_MODE.COMMAND_MODE,
+                    accept_any_remote: ACCEPT_ANY_REMPOTE = ACCEPT_ANY_REMPOTE.DISABLED,
+                    conn_setup: CONNECTION_SETUP = CONNECTION_SETUP.SYNCHRONOUS):
+
+    return SOCKET_DIAL_CMD_HEADER + \
+           str(connection_id) + "," + \
+           str(tx_protocol.value) + "," + \
+           str(remote_host_port) + "," + \
+           "\"" + ip_addr + "\"" + "," + \
+           str(closure.value) + "," + \
+           str(udp_local_port) + "," + \
+           str(conn_mode.value) + "," + \
+           str(accept_any_remote.value) + "," + \
+           str(conn_setup.value)
+
+
+@dataclass
+class SocketStatus:
+    connection_id: int
+    state: SOCKET_STATE
+    local_ip: str = ""
+    local_port: int = 0
+    remote_ip: str = ""
+    remote_port: int = 0
+    protocol: Optional[TRANSMISSION_PROTOCOL] = None
+
+
+class SocketStatusLine(Record):
+    # +SQNSS: <connId>,<state>[,<locIP>,<locPort>,<remIP>,<remPort>,<txProt>]
+    __slots__ = ()
+    PREFIX = SOCKET_STATUS
+    connection_id = Field(0)
+    state = Field(1, enum_value(SOCKET_STATE))
+    local_ip = Field(2, text, "")
+    local_port = Field(3, default=0)
+    remote_ip = Field(4, text, "")
+    remote_port = Field(5, default=0)
+    protocol = Field(6, enum_value(TRANSMISSION_PROTOCOL))
+
+
+class SocketReceiveLine(Record):
+    # +SQNSRECV: <connId>,<length>[,<remoteIp>,<remotePort>]
+    __slots__ = ()
+    PREFIX = SOCKET_RECEIVE_HEADER.decode()
+    connection_id = Field(0)
+    length = Field(1)
+    remote_ip = Field(2, text)
+    remote_port = Field(3)
+
+
+class SocketRing(Record):
+    # +SQNSRING: <connId>,<recData>
+    __slots__ = ()
+    PREFIX = SOCKET_RING
+    connection_id = Field(0)
+    pending = Field(1, default=0)
+
+
+class SocketClosed(Record):
+    # +SQNSH: <connId>
+    __slots__ = ()
+    PREFIX = SOCKET_CLOSED
+    connection_id = Field(0)
+
+
+def parse_socket_status(response: ATResponse) -> Dict[int, SocketStatus]:
+    # Response of the form:
+    # +SQNSS: 1,2,"100.111.25.78",64675,"xxx.xx.xxx.xx",12345,1
+    # +SQNSS: 2,0
+    # ...
+    # Lines are matched by connection id rather than by position
+    table = {}
+    prefix = SOCKET_STATUS.encode()
+    for line in response.lines:
+        if line.prefix != prefix:
+            continue
+        record = SocketStatusLine.from_frame(line)
+        table[record.connection_id] = SocketStatus(record.connection_id, record.state, record.local_ip,
+                                                   record.local_port, record.remote_ip, record.remote_port,
+                                                   record.protocol)
+    return table
+
+
+def socket_send_cmd(connection_id: int, length: int, address: Optional[Tuple[str, int]] = None) -> str:
+    # AT+SQNSSENDEXT=<connId>,<length>[,<rai>,<remoteIp>,<remotePort>]. The address is only accepted by
+    # UDP sockets dialed with ACCEPT_ANY_REMPOTE.RECEIVE_SEND_ANY
+    cmd = SOCKET_SEND_COMMAND_MODE_CMD_HEADER + str(connection_id) + "," + str(length)
+    if address is not None:
+        cmd += ",0,\"" + address[0] + "\"," + str(address[1])
+    return cmd
+
+
+def socket_receive_address(response: ATResponse) -> Optional[Tuple[str, int]]:
+    # Sender reported after the length on +SQNSRECV, None when the modem does not report it
+    for line in response.lines:
+        if line.prefix == SOCKET_RECEIVE_HEADER:
+            record = SocketReceiveLine.from_frame(line)
+            if record.remote_port is not None:
+                return record.remote_ip, record.remote_port
+    return None
+
+
+def pack_messages(messages: Sequence[bytes]) -> bytes:
+    return b"".join(UDP_BATCH_LENGTH.pack(len(message)) + message for message in messages)
+
+
+def unpack_messages(datagram: bytes) -> List[bytes]:
+    # Messages of a datagram built by UDPBatcher. A truncated last message is dropped
+    messages = []
+    offset = 0
+    while offset + UDP_BATCH_LENGTH.size <= len(datagram):
+        length, = UDP_BATCH_LENGTH.unpack_from(datagram, offset)
+        offset += UDP_BATCH_LENGTH.size
+        if offset + length > len(datagram):
+            break
+        messages.append(bytes(datagram[offset:offset + length]))
+        offset += length
+    return messages
+
+
+async def socket_receive(engine: ATEngine,
+                         connection_id: int,
+                         max_length: int,
+                         into: Optional[memoryview] = None,
+                         timeout: float = DEFAULT_TIMEOUT) -> Tuple[memoryview, RESPONSE_ERROR]:
+    # Read up to max_length bytes pending on a socket. The modem announces how many bytes it returns in
+    # the +SQNSRECV line, and exactly that many are copied into `into` (or a buffer of that size)
+    data, address, error = await socket_receive_from(engine, connection_id, max_length, into, timeout)
+    return data, error
+
+
+async def socket_receive_from(engine: ATEngine,
+                              connection_id: int,
+                              max_length: int,
+                              into: Optional[memoryview] = None,
+                              timeout: float = DEFAULT_TIMEOUT) \
+        -> Tuple[memoryview, Optional[Tuple[str, int]], RESPONSE_ERROR]:
+    # socket_receive() that also returns the sender, when the modem reports it. On a UDP socket every
+    # read returns one datagram, and the part of it beyond max_length is discarded by the modem
+    if into is not None and len(into) < max_length:
+        raise ValueError(f"Receive buffer too small: {len(into)} < {max_length}")
+
+    cmd = SOCKET_RECEIVE_CMD + str(connection_id) + "," + str(max_length)
+    block = RxBlock(header=SOCKET_RECEIVE_HEADER, into=into, length_field=SOCKET_RECEIVE_LENGTH_FIELD)
+    response, error = await engine.command(cmd, timeout=timeout, block=block)
+    if response.data is None:
+        return memoryview(b""), None, error
+    return response.data, socket_receive_address(response), error
+
+
+class ModemSocket:
+    # A socket on the modem, in command mode. Obtained from SocketManager.open(). Every +SQNSRING starts a
+    # drain that reads the data in AT+SQNSRECV chunks of up to SOCKET_RECV_CHUNK_SIZE into a receive
+    # buffer, whether or not the application is reading, so replies larger than the request and data
+    # pushed by the server are not missed. The buffer is bounded: draining pauses when it holds
+    # RECV_BUFFER_LIMIT bytes, and the data waits in the modem until the application catches up.
+    # The coroutines are used from the event loop; the *_threadsafe variants block and are meant for
+    # worker threads
+
+    def __init__(self, manager: "SocketManager", connection_id: int, protocol: TRANSMISSION_PROTOCOL,
+                 remote_ip: str, remote_port: int, timeout: float):
+        self._manager = manager
+        self._engine = manager.engine
+        self.connection_id = connection_id
+        self.protocol = protocol
+        self.remote_ip = remote_ip
+        self.remote_port = remote_port
+        self.timeout = timeout
+        # Bytes the modem last announced with +SQNSRING
+        self.pending = 0
+        self.closed = False
+        self.bytes_received = 0
+        self._received = bytearray()
+        self._readable = asyncio.Event()
+        self._space = asyncio.Event()
+        self._space.set()
+        # AT+SQNSRECV target, reused for every chunk
+        self._chunk = memoryview(bytearray(SOCKET_RECV_CHUNK_SIZE))
+        self._drain: Optional[asyncio.Task] = None
+        self._ring = False
+
+    def __repr__(self) -> str:
+        return (f"<ModemSocket {self.connection_id} {self.protocol.name} {self.remote_ip}:{self.remote_port}"
+                f"{' closed' if self.closed else ''}>")
+
+    @property
+    def buffered(self) -> int:
+        return len(self._received)
+
+    async def send(self, data: bytes) -> RESPONSE_ERROR:
+        if self.closed:
+            return RESPONSE_ERROR.ERROR
+        response, error = await self._engine.command(socket_send_cmd(self.connection_id, len(data)), self.timeout,
+                                                     data=data)
+        return error
+
+    async def recv(self, size: int, timeout: Optional[float] = None) -> Tuple[bytes, RESPONSE_ERROR]:
+        # Up to `size` received bytes, waiting for data if none is buffered. Returns b"" once the socket
+        # is closed and everything has been read
+        error = await self._wait_readable(timeout)
+        if error != RESPONSE_ERROR.OK:
+            return b"", error
+        data = bytes(self._received[:size])
+        self._consume(len(data))
+        return data, RESPONSE_ERROR.OK
+
+    async def recv_into(self, buffer: memoryview, nbytes: int = 0,
+                        timeout: Optional[float] = None) -> Tuple[int, RESPONSE_ERROR]:
+        # Like socket.recv_into(): copies up to nbytes (or len(buffer)) received bytes into buffer
+        buffer = memoryview(buffer)
+        error = await self._wait_readable(timeout)
+        if error != RESPONSE_ERROR.OK:
+            return 0, error
+        size = min(nbytes or len(buffer), len(self._received))
+        buffer[:size] = self._received[:size]
+        self._consume(size)
+        return size, RESPONSE_ERROR.OK
+
+    async def recv_exactly(self, size: int, timeout: Optional[float] = None) -> Tuple[bytes, RESPONSE_ERROR]:
+        # Waits until `size` bytes have been received. Returns what was received if the socket is
+        # closed first, with ERROR
+        data = bytearray()
+        while len(data) < size:
+            chunk, error = await self.recv(size - len(data), timeout)
+            if error != RESPONSE_ERROR.OK:
+                return bytes(data), error
+            if not chunk:
+                return bytes(data), RESPONSE_ERROR.ERROR
+            data += chunk
+        return bytes(data), RESPONSE_ERROR.OK
+
+    async def chunks(self, timeout: Optional[float] = None) -> AsyncIterator[bytes]:
+        # Everything received until the socket is closed, as it arrives
+        while True:
+            data, error = await self.recv(len(self._chunk), timeout)
+            if not data:
+                return
+            yield data
+
+    async def close(self) -> RESPONSE_ERROR:
+        if self.closed:
+            # Closed by the remote end already
+            self._manager._release(self)
+            return RESPONSE_ERROR.OK
+        self._set_closed()
+        response, error = await self._engine.command(SOCKET_DISCONNECT_CMD_HEADER + str(self.connection_id),
+                                                     self.timeout)
+        self._manager._release(self)
+        return error
+
+    def send_threadsafe(self, data: bytes) -> RESPONSE_ERROR:
+        return self._run_threadsafe(self.send(data))
+
+    def recv_threadsafe(self, size: int, timeout: Optional[float] = None) -> Tuple[bytes, RESPONSE_ERROR]:
+        return self._run_threadsafe(self.recv(size, timeout))
+
+    def close_threadsafe(self) -> RESPONSE_ERROR:
+        return self._run_threadsafe(self.close())
+
+    def _run_threadsafe(self, coroutine):
+        future: concurrent.futures.Future = asyncio.run_coroutine_threadsafe(coroutine, self._manager.loop)
+        return future.result()
+
+    async def _wait_readable(self, timeout: Optional[float]) -> RESPONSE_ERROR:
+        try:
+            await asyncio.wait_for(self._readable.wait(), timeout or self.timeout)
+        except asyncio.TimeoutError:
+            return RESPONSE_ERROR.TIMEOUT
+        return RESPONSE_ERROR.OK
+
+    def _consume(self, size: int):
+        del self._received[:size]
+        if not self._received and not self.closed:
+            self._readable.clear()
+        if len(self._received) < RECV_BUFFER_LIMIT:
+            self._space.set()
+
+    def _on_ring(self, pending: int):
+        self.pending = pending
+        if self._drain is None or self._drain.done():
+            self._drain = asyncio.create_task(self._drain_pending())
+        else:
+            # a ring during the drain means more data to fetch once the current read completes
+            self._ring = True
+
+    async def _drain_pending(self):
+        # Full chunks are read until the modem returns a short one, i.e. it has nothing more for now
+        while not self.closed:
+            self._ring = False
+            await self._space.wait()
+            if self.closed:
+                return
+            data, error = await socket_receive(self._engine, self.connection_id, len(self._chunk),
+                                               into=self._chunk, timeout=self.timeout)
+            if error != RESPONSE_ERROR.OK:
+                return
+            if data:
+                self.bytes_received += len(data)
+                self._received += data
+                self._readable.set()
+                if len(self._received) >= RECV_BUFFER_LIMIT:
+                    self._space.clear()
+            self.pending = max(0, self.pending - len(data))
+            if len(data) < len(self._chunk) and not self._ring:
+                return
+
+    def _set_closed(self):
+        # Wakes up readers, which return what is still buffered and then b""
+        self.closed = True
+        self._readable.set()
+        self._space.set()
+
+
+class UDPSocket:
+    # A UDP socket on the modem, in command mode. Obtained from SocketManager.open_udp(). Datagram
+    # boundaries are kept: every +SQNSRING starts a drain that reads one datagram per AT+SQNSRECV into a
+    # queue of up to RECV_DATAGRAM_LIMIT datagrams, and recvfrom() returns them one at a time with their
+    # sender. Datagrams that arrive while the queue is full wait in the modem. The counters cover every
+    # datagram sent and received, for rate and loss reporting
+
+    def __init__(self, manager: "SocketManager", connection_id: int, remote_ip: str, remote_port: int,
+                 accept_any_remote: ACCEPT_ANY_REMPOTE, timeout: float):
+        self._manager = manager
+        self._engine = manager.engine
+        self.connection_id = connection_id
+        self.protocol = TRANSMISSION_PROTOCOL.UDP
+        self.remote_ip = remote_ip
+        self.remote_port = remote_port
+        self.accept_any_remote = accept_any_remote
+        self.timeout = timeout
+        # Bytes the modem last announced with +SQNSRING
+        self.pending = 0
+        self.closed = False
+        self.datagrams_sent = 0
+        self.datagrams_received = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.send_errors = 0
+        self._received: Deque[Tuple[bytes, Tuple[str, int]]] = collections.deque()
+        self._readable = asyncio.Event()
+        self._space = asyncio.Event()
+        self._space.set()
+        self._chunk = memoryview(bytearray(SOCKET_RECV_CHUNK_SIZE))
+        self._drain: Optional[asyncio.Task] = None
+        self._ring = False
+
+    def __repr__(self) -> str:
+        return (f"<UDPSocket {self.connection_id} {self.remote_ip}:{self.remote_port}"
+                f"{' closed' if self.closed else ''}>")
+
+    @property
+    def buffered(self) -> int:
+        return len(self._received)
+
+    async def sendto(self, data: bytes, address: Optional[Tuple[str, int]] = None) -> RESPONSE_ERROR:
+        # One AT+SQNSSENDEXT per datagram. Without an address the datagram goes to the dialed remote
+        if self.closed:
+            return RESPONSE_ERROR.ERROR
+        response, error = await self._engine.command(socket_send_cmd(self.connection_id, len(data), address),
+                                                     self.timeout, data=data)
+        if error == RESPONSE_ERROR.OK:
+            self.datagrams_sent += 1
+            self.bytes_sent += len(data)
+        else:
+            self.send_errors += 1
+        return error
+
+    async def send(self, data: bytes) -> RESPONSE_ERROR:
+        return await self.sendto(data)
+
+    async def recvfrom(self, timeout: Optional[float] = None) \
+            -> Tuple[bytes, Optional[Tuple[str, int]], RESPONSE_ERROR]:
+        # The next datagram and its sender. Returns b"" and None once the socket is closed and every
+        # datagram has been read
+        try:
+            await asyncio.wait_for(self._readable.wait(), timeout or self.timeout)
+        except asyncio.TimeoutError:
+            return b"", None, RESPONSE_ERROR.TIMEOUT
+        if not self._received:
+            return b"", None, RESPONSE_ERROR.OK
+        data, address = self._received.popleft()
+        if not self._received and not self.closed:
+            self._readable.clear()
+        if len(self._received) < RECV_DATAGRAM_LIMIT:
+            self._space.set()
+        return data, address, RESPONSE_ERROR.OK
+
+    async def recv(self, size: int = SOCKET_RECV_CHUNK_SIZE,
+                   timeout: Optional[float] = None) -> Tuple[bytes, RESPONSE_ERROR]:
+        # Like socket.recv() on a datagram socket, the part of the datagram beyond size is discarded
+        data, address, error = await self.recvfrom(timeout)
+        return data[:size], error
+
+    async def close(self) -> RESPONSE_ERROR:
+        if self.closed:
+            self._manager._release(self)
+            return RESPONSE_ERROR.OK
+        self._set_closed()
+        response, error = await self._engine.command(SOCKET_DISCONNECT_CMD_HEADER + str(self.connection_id),
+                                                     self.timeout)
+        self._manager._release(self)
+        return error
+
+    def _on_ring(self, pending: int):
+        self.pending = pending
+        if self._drain is None or self._drain.done():
+            self._drain = asyncio.create_task(self._drain_pending())
+        else:
+            self._ring = True
+
+    async def _drain_pending(self):
+        # Datagrams are read until the modem returns an empty one, or has announced nothing more
+        while not self.closed:
+            self._ring = False
+            await self._space.wait()
+            if self.closed:
+                return
+            data, address, error = await socket_receive_from(self._engine, self.connection_id, len(self._chunk),
+                                                             into=self._chunk, timeout=self.timeout)
+            if error != RESPONSE_ERROR.OK:
+                return
+            if data:
+                self.datagrams_received += 1
+                self.bytes_received += len(data)
+                self._received.append((bytes(data), address or (self.remote_ip, self.remote_port)))
+                self._readable.set()
+                if len(self._received) >= RECV_DATAGRAM_LIMIT:
+                    self._space.clear()
+            self.pending = max(0, self.pending - len(data))
+            if not data or (not self.pending and not self._ring):
+                return
+
+    def _set_closed(self):
+        self.closed = True
+        self._readable.set()
+        self._space.set()
+
+
+class UDPBatcher:
+    # Coalesces small messages into fewer datagrams. Every AT+SQNSSENDEXT costs a UART round trip and
+    # every datagram a radio transmission, so messages queued within `window` seconds of the first one
+    # are packed, each behind its length (see pack_messages), into a datagram of up to max_size bytes.
+    # The receiver splits them again with unpack_messages(). A message that would overflow the datagram
+    # flushes it first
+
+    def __init__(self, sock: UDPSocket,
+                 window: float = UDP_BATCH_WINDOW,
+                 max_size: int = UDP_BATCH_MAX_SIZE,
+                 address: Optional[Tuple[str, int]] = None):
+        if max_size <= UDP_BATCH_LENGTH.size:
+            raise ValueError(f"Datagram size too small: {max_size}")
+        self.sock = sock
+        self.window = window
+        self.max_size = max_size
+        self.address = address
+        self.messages_queued = 0
+        self.messages_sent = 0
+        self.messages_failed = 0
+        self.datagrams_sent = 0
+        self.bytes_sent = 0
+        self._messages: List[bytes] = []
+        self._size = 0
+        self._timer: Optional[asyncio.Task] = None
+        self._lock = asyncio.Lock()
+
+    @property
+    def queued(self) -> int:
+        return len(self._messages)
+
+    async def send(self, message: bytes) -> RESPONSE_ERROR:
+        # Queues a message. Only sending a full datagram waits, the error returned is that of the
+        # datagram flushed, if any
+        size = UDP_BATCH_LENGTH.size + len(message)
+        if size > self.max_size:
+            raise ValueError(f"Message too large: {len(message)} > {self.max_size - UDP_BATCH_LENGTH.size}")
+        error = RESPONSE_ERROR.OK
+        if self._size + size > self.max_size:
+            error = await self.flush()
+        self._messages.append(message)
+        self._size += size
+        self.messages_queued += 1
+        if self._timer is None:
+            self._timer = asyncio.create_task(self._flush_later())
+        return error
+
+    async def flush(self) -> RESPONSE_ERROR:
+        if self._timer is not None and self._timer is not asyncio.current_task():
+            self._timer.cancel()
+        self._timer = None
+        messages, self._messages, self._size = self._messages, [], 0
+        if not messages:
+            return RESPONSE_ERROR.OK
+        datagram = pack_messages(messages)
+        # Datagrams leave in the order their messages were queued
+        async with self._lock:
+            error = await self.sock.sendto(datagram, self.address)
+        if error == RESPONSE_ERROR.OK:
+            self.messages_sent += len(messages)
+            self.datagrams_sent += 1
+            self.bytes_sent += len(datagram)
+        else:
+            self.messages_failed += len(messages)
+        return error
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.window)
+        await self.flush()
+
+
+class OnlineSocket:
+    # A socket in online (transparent) mode. After CONNECT the UART carries the socket data with no AT
+    # framing, so bulk transfers run at line rate. Received bytes are read from `reader`, an
+    # asyncio.StreamReader. escape() returns the modem to command mode with the connection kept open, so
+    # other commands can be issued, and resume() goes back online
+
+    def __init__(self, manager: "SocketManager", connection_id: int, protocol: TRANSMISSION_PROTOCOL,
+                 remote_ip: str, remote_port: int, timeout: float):
+        self._manager = manager
+        self._engine = manager.engine
+        self.connection_id = connection_id
+        self.protocol = protocol
+        self.remote_ip = remote_ip
+        self.remote_port = remote_port
+        self.timeout = timeout
+        self.reader = asyncio.StreamReader()
+        self.online = False
+        self.closed = False
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def __repr__(self) -> str:
+        state = "closed" if self.closed else "online" if self.online else "suspended"
+        return f"<OnlineSocket {self.connection_id} {self.protocol.name} {self.remote_ip}:{self.remote_port} {state}>"
+
+    async def write(self, data: bytes) -> RESPONSE_ERROR:
+        if not self.online:
+            return RESPONSE_ERROR.ERROR
+        await self._engine.write_chunks([data])
+        self.bytes_sent += len(data)
+        return RESPONSE_ERROR.OK
+
+    async def read(self, size: int = -1) -> bytes:
+        # Returns b"" once the connection is closed
+        return await self.reader.read(size)
+
+    async def escape(self, guard_time: float = ESCAPE_GUARD_TIME) -> RESPONSE_ERROR:
+        if not self.online:
+            return RESPONSE_ERROR.OK
+        error = await self._engine.escape_online_mode(guard_time, self.timeout)
+        if not self._engine.online:
+            self.online = False
+        return error
+
+    async def resume(self) -> RESPONSE_ERROR:
+        if self.closed:
+            return RESPONSE_ERROR.ERROR
+        if self.online:
+            return RESPONSE_ERROR.OK
+        return await self._connect(SOCKET_RESUME_CMD_HEADER + str(self.connection_id))
+
+    async def close(self, guard_time: float = ESCAPE_GUARD_TIME) -> RESPONSE_ERROR:
+        if self.closed:
+            self._manager._release(self)
+            return RESPONSE_ERROR.OK
+        error = await self.escape(guard_time)
+        if error != RESPONSE_ERROR.OK:
+            return error
+        self._set_closed()
+        response, error = await self._engine.command(SOCKET_DISCONNECT_CMD_HEADER + str(self.connection_id),
+                                                     self.timeout)
+        self._manager._release(self)
+        return error
+
+    async def _connect(self, command: str) -> RESPONSE_ERROR:
+        response, error = await self._engine.enter_online_mode(command, self._on_data, self.timeout)
+        self.online = error == RESPONSE_ERROR.OK
+        return error
+
+    def _on_data(self, data: Optional[bytes]):
+        if data is None:
+            # NO CARRIER
+            self._set_closed()
+            self._manager._release(self)
+            return
+        self.bytes_received += len(data)
+        self.reader.feed_data(data)
+
+    def _on_ring(self, pending: int):
+        # Data received while suspended is delivered after resume()
+        pass
+
+    def _set_closed(self):
+        self.online = False
+        self.closed = True
+        if not self.reader.at_eof():
+            self.reader.feed_eof()
+
+
+class SocketManager:
+    # Hands out the modem's six connection ids and routes +SQNSRING and +SQNSH to the socket that owns
+    # the id, so several TCP and UDP connections can share the modem
+
+    def __init__(self, engine: ATEngine, connection_ids: Sequence[int] = SOCKET_IDS):
+        self.engine = engine
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self._free: List[int] = list(connection_ids)
+        self._sockets: Dict[int, Union[ModemSocket, UDPSocket, OnlineSocket]] = {}
+        self._id_released = asyncio.Condition()
+        engine.subscribe(SOCKET_RING, self._on_ring)
+        engine.subscribe(SOCKET_CLOSED, self._on_closed)
+
+    @property
+    def sockets(self) -> Dict[int, Union[ModemSocket, UDPSocket, OnlineSocket]]:
+        return dict(self._sockets)
+
+    async def start(self, timeout: float = SOCKET_TIMEOUT) -> RESPONSE_ERROR:
+        # Sockets left open by a previous run are closed, so every id starts free
+        self.loop = asyncio.get_running_loop()
+        table, error = await self.status(timeout)
+        if error != RESPONSE_ERROR.OK:
+            return error
+        stale = [status.connection_id for status in table.values()
+                 if status.state != SOCKET_STATE.CLOSED and status.connection_id in self._free]
+        if stale:
+            commands = [SOCKET_DISCONNECT_CMD_HEADER + str(connection_id) for connection_id in stale]
+            await self.engine.command_batch(commands, timeout)
+        return RESPONSE_ERROR.OK
+
+    async def stop(self):
+        for sock in list(self._sockets.values()):
+            await sock.close()
+        self.engine.unsubscribe(SOCKET_RING, self._on_ring)
+        self.engine.unsubscribe(SOCKET_CLOSED, self._on_closed)
+
+    async def status(self, timeout: float = SOCKET_TIMEOUT) -> Tuple[Dict[int, SocketStatus], RESPONSE_ERROR]:
+        response, error = await self.engine.command(SOCKET_STATUS_CMD, timeout)
+        if error != RESPONSE_ERROR.OK:
+            return {}, error
+        return parse_socket_status(response), error
+
+    async def open(self, protocol: TRANSMISSION_PROTOCOL,
+                   remote_ip: str,
+                   remote_port: int,
+                   udp_local_port: int = 0,
+                   accept_any_remote: ACCEPT_ANY_REMPOTE = ACCEPT_ANY_REMPOTE.DISABLED,
+                   wait: bool = False,
+                   timeout: float = SOCKET_TIMEOUT) -> Tuple[Optional[ModemSocket], RESPONSE_ERROR]:
+        # Configures and dials the next free connection id. With wait, waits for a socket to be closed
+        # when all six are in use, otherwise fails straight away
+        connection_id = await self._allocate(wait)
+        if connection_id is None:
+            return None, RESPONSE_ERROR.ERROR
+
+        sock = ModemSocket(self, connection_id, protocol, remote_ip, remote_port, timeout)
+        error = await self._dial(sock, udp_local_port, accept_any_remote, timeout)
+        if error != RESPONSE_ERROR.OK:
+            return None, error
+        return sock, RESPONSE_ERROR.OK
+
+    async def open_udp(self, remote_ip: str,
+                       remote_port: int,
+                       local_port: int = 0,
+                       accept_any_remote: ACCEPT_ANY_REMPOTE = ACCEPT_ANY_REMPOTE.DISABLED,
+                       wait: bool = False,
+                       timeout: float = SOCKET_TIMEOUT) -> Tuple[Optional[UDPSocket], RESPONSE_ERROR]:
+        # Dials a UDP socket that keeps datagram boundaries. With RECEIVE_SEND_ANY, sendto() accepts any
+        # destination and recvfrom() reports the sender of each datagram
+        connection_id = await self._allocate(wait)
+        if connection_id is None:
+            return None, RESPONSE_ERROR.ERROR
+
+        sock = UDPSocket(self, connection_id, remote_ip, remote_port, accept_any_remote, timeout)
+        error = await self._dial(sock, local_port, accept_any_remote, timeout)
+        if error != RESPONSE_ERROR.OK:
+            return None, error
+        return sock, RESPONSE_ERROR.OK
+
+    async def open_online(self, protocol: TRANSMISSION_PROTOCOL,
+                          remote_ip: str,
+                          remote_port: int,
+                          wait: bool = False,
+                          timeout: float = SOCKET_TIMEOUT) -> Tuple[Optional[OnlineSocket], RESPONSE_ERROR]:
+        # Dials a socket in online mode. Until it is escaped, no other command can be issued, so the other
+        # sockets are only served while it is suspended
+        connection_id = await self._allocate(wait)
+        if connection_id is None:
+            return None, RESPONSE_ERROR.ERROR
+
+        sock = OnlineSocket(self, connection_id, protocol, remote_ip, remote_port, timeout)
+        self._sockets[connection_id] = sock
+        response, error = await self.engine.command(config_socket_cmd(connection_id), timeout)
+        if error == RESPONSE_ERROR.OK:
+            error = await sock._connect(dial_socket_cmd(connection_id, protocol, remote_port, remote_ip,
+                                                        conn_mode=CONNECTION_MODE.ONLINE_MODE))
+        if error != RESPONSE_ERROR.OK:
+            sock._set_closed()
+            self._release(sock)
+            return None, error
+        return sock, RESPONSE_ERROR.OK
+
+    async def _dial(self, sock: Union[ModemSocket, UDPSocket], udp_local_port: int,
+                    accept_any_remote: ACCEPT_ANY_REMPOTE, timeout: float) -> RESPONSE_ERROR:
+        self._sockets[sock.connection_id] = sock
+        # The dial is not sent if the configuration failed, so no socket is left open on a freed id
+        commands = (config_socket_cmd(sock.connection_id),
+                    dial_socket_cmd(sock.connection_id, sock.protocol, sock.remote_port, sock.remote_ip,
+                                    udp_local_port=udp_local_port,
+                                    accept_any_remote=accept_any_remote))
+        results = await self.engine.command_batch(commands, timeout, dependent=True)
+        for response, error in results:
+            if error != RESPONSE_ERROR.OK:
+                sock._set_closed()
+                self._release(sock)
+                return error
+        return RESPONSE_ERROR.OK
+
+    async def _allocate(self, wait: bool) -> Optional[int]:
+        if self.loop is None:
+            self.loop = asyncio.get_running_loop()
+        async with self._id_released:
+            if not self._free and wait:
+                await self._id_released.wait_for(lambda: self._free)
+            if not self._free:
+                return None
+            return self._free.pop(0)
+
+    def _release(self, sock: Union[ModemSocket, UDPSocket, OnlineSocket]):
+        if self._sockets.get(sock.connection_id) is not sock:
+            return
+        del self._sockets[sock.connection_id]
+        self._free.append(sock.connection_id)
+        self._free.sort()
+
+        async def notify():
+            async with self._id_released:
+                self._id_released.notify()
+
+        asyncio.ensure_future(notify())
+
+    def _on_ring(self, frame: Frame):
+        ring = SocketRing.from_frame(frame)
+        sock = self._sockets.get(ring.connection_id)
+        if sock is not None:
+            sock._on_ring(ring.pending)
+
+    def _on_closed(self, frame: Frame):
+        # The remote end closed the connection. Data already received can still be read
+        sock = self._sockets.get(SocketClosed.from_frame(frame).connection_id)
+        if sock is not None:
+            sock._set_closed()
+            self._release(sock)
@@ -0,0 +1,239 @@
+import bisect
+import collections
+import itertools
+import json
+import os
+from typing import Deque, Dict, Iterable, List, Optional, Tuple
+
+
+# Latency histogram buckets, upper bounds in seconds. The last bucket takes everything above
+LATENCY_BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0, 60.0)
+
+# Commands that fetch data a URC announced. The time from the URC to the end of the fetch is the latency
+# the application sees. A +SQNSRING drain reads everything announced so far, so one fetch settles all the
+# rings before it; the other fetches settle one URC each
+FETCH_URCS = {
+    "+SQNHTTPRCV": ("+SQNHTTPRING", False),
+    "+SQNSMQTTRCVMESSAGE": ("+SQNSMQTTONMESSAGE", False),
+    "+SQNSRECV": ("+SQNSRING", True),
+}
+
+# URC arrivals remembered per prefix while waiting for their fetch
+URC_BACKLOG = 64
+
+# Line terminators around every line the modem sends, counted in the bytes received
+LINE_OVERHEAD = 4
+
+PROMETHEUS_PREFIX = "lte_ryz"
+
+
+class LatencyHistogram:
+
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds: float):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, percent: float) -> float:
+        # upper bound of the bucket holding the percentile, in seconds
+        if not self.count:
+            return 0.0
+        rank = max(1, round(percent / 100 * self.count))
+        for count, bound in zip(itertools.accumulate(self.counts), self.buckets + (self.max,)):
+            if count >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def to_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "sum": self.total,
+            "mean": self.mean,
+            "max": self.max,
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "p99": self.percentile(99),
+            "buckets": {str(bound): count for bound, count in zip(self.buckets + ("+Inf",), self.counts)},
+        }
+
+    def prometheus(self, name: str, labels: str) -> List[str]:
+        lines = []
+        for bound, count in zip(self.buckets + ("+Inf",), itertools.accumulate(self.counts)):
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {count}')
+        lines.append(f"{name}_sum{{{labels}}} {self.total}")
+        lines.append(f"{name}_count{{{labels}}} {self.count}")
+        return lines
+
+
+class VerbStats:
+    # Everything recorded for one command verb, e.g. +SQNHTTPQRY
+
+    def __init__(self):
+        self.commands = 0
+        self.errors = 0
+        self.timeouts = 0
+        # Attempts repeated by a RetryPolicy, also counted in commands
+        self.retries = 0
+        self.bytes_out = 0
+        self.bytes_in = 0
+        # From the command being written to the first frame of its response (the prompt, a line or the
+        # final result): the UART and the modem
+        self.first_byte = LatencyHistogram()
+        # From the command being written to its final result code
+        self.final = LatencyHistogram()
+        # From the final result code to the URC that completes the transaction (AT+SQNHTTPQRY OK ->
+        # +SQNHTTPRING): the network
+        self.urc = LatencyHistogram()
+
+    def to_dict(self) -> dict:
+        return {
+            "commands": self.commands,
+            "errors": self.errors,
+            "timeouts": self.timeouts,
+            "retries": self.retries,
+            "bytes_out": self.bytes_out,
+            "bytes_in": self.bytes_in,
+            "first_byte_s": self.first_byte.to_dict(),
+            "final_s": self.final.to_dict(),
+            "urc_s": self.urc.to_dict(),
+        }
+
+
+class CommandStats:
+    # Per verb latency and throughput of the AT transactions an ATEngine runs, and the latency from a URC
+    # to the end of the command fetching what it announced. All methods run on the event loop
+
+    def __init__(self):
+        self.verbs: Dict[str, VerbStats] = {}
+        # "+SQNHTTPRING" -> histogram of URC to end of AT+SQNHTTPRCV
+        self.urc_fetch: Dict[str, LatencyHistogram] = {}
+        self._urc_arrivals: Dict[str, Deque[float]] = {}
+
+    def record(self, verb: str, sent: Optional[float], first: Optional[float], final: float,
+               bytes_out: int, bytes_in: int, error: int):
+        # error is a RESPONSE_ERROR value: 0 OK, 1 ERROR, 2 TIMEOUT
+        stats = self.verbs.get(verb)
+        if stats is None:
+            stats = self.verbs[verb] = VerbStats()
+        stats.commands += 1
+        stats.bytes_out += bytes_out
+        stats.bytes_in += bytes_in
+        if error == 1:
+            stats.errors += 1
+        elif error == 2:
+            stats.timeouts += 1
+        if sent is None:
+            return
+        if first is not None:
+            stats.first_byte.add(first - sent)
+        if error != 2:
+            stats.final.add(final - sent)
+            self._fetched(verb, final)
+
+    def record_retry(self, verb: str):
+        stats = self.verbs.get(verb)
+        if stats is None:
+            stats = self.verbs[verb] = VerbStats()
+        stats.retries += 1
+
+    def record_urc(self, verb: str, seconds: float):
+        stats = self.verbs.get(verb)
+        if stats is not None:
+            stats.urc.add(seconds)
+
+    def urc_received(self, prefix: str, received: float):
+        if prefix not in self._urc_arrivals:
+            if not any(urc == prefix for urc, drains in FETCH_URCS.values()):
+                return
+            self._urc_arrivals[prefix] = collections.deque(maxlen=URC_BACKLOG)
+        self._urc_arrivals[prefix].append(received)
+
+    def reset(self):
+        self.verbs.clear()
+        self.urc_fetch.clear()
+        self._urc_arrivals.clear()
+
+    def _fetched(self, verb: str, final: float):
+        if verb not in FETCH_URCS:
+            return
+        prefix, drains = FETCH_URCS[verb]
+        arrivals = self._urc_arrivals.get(prefix)
+        if not arrivals:
+            return
+        histogram = self.urc_fetch.get(prefix)
+        if histogram is None:
+            histogram = self.urc_fetch[prefix] = LatencyHistogram()
+        histogram.add(final - arrivals.popleft())
+        if drains:
+            arrivals.clear()
+
+    def to_dict(self) -> dict:
+        return {
+            "commands": {verb: stats.to_dict() for verb, stats in sorted(self.verbs.items())},
+            "urc_to_fetch_s": {prefix: histogram.to_dict() for prefix, histogram in sorted(self.urc_fetch.items())},
+        }
+
+    def to_json(self) -> str:
+        return json.dumps(self.to_dict(), indent=2)
+
+    def to_prometheus(self) -> str:
+        # Prometheus text exposition format, e.g. for the node exporter textfile collector
+        prefix = PROMETHEUS_PREFIX
+        verbs = sorted(self.verbs.items())
+        lines = []
+        counters = (("commands_total", "commands"), ("command_errors_total", "errors"),
+                    ("command_timeouts_total", "timeouts"), ("command_retries_total", "retries"),
+                    ("bytes_out_total", "bytes_out"),
+                    ("bytes_in_total", "bytes_in"))
+        for name, attribute in counters:
+            lines.append(f"# TYPE {prefix}_{name} counter")
+            lines += [f'{prefix}_{name}{{verb="{verb}"}} {getattr(stats, attribute)}' for verb, stats in verbs]
+        histograms = (("first_byte_seconds", "first_byte"), ("command_seconds", "final"),
+                      ("command_urc_seconds", "urc"))
+        for name, attribute in histograms:
+            lines.append(f"# TYPE {prefix}_{name} histogram")
+            for verb, stats in verbs:
+                lines += getattr(stats, attribute).prometheus(f"{prefix}_{name}", f'verb="{verb}"')
+        lines.append(f"# TYPE {prefix}_urc_to_fetch_seconds histogram")
+        for urc, histogram in sorted(self.urc_fetch.items()):
+            lines += histogram.prometheus(f"{prefix}_urc_to_fetch_seconds", f'urc="{urc}"')
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: str):
+        # Prometheus text for .prom files, JSON otherwise. Written to a temporary file first, so a collector
+        # never reads a partial file
+        text = self.to_prometheus() if path.endswith(".prom") else self.to_json()
+        temporary = path + ".tmp"
+        with open(temporary, "w") as f:
+            f.write(text)
+        os.replace(temporary, path)
+
+    def format(self) -> Iterable[str]:
+        # Table printed by the STATS command of the scripts, latencies in milliseconds
+        yield (f"{'verb':<22} {'cmds':>6} {'err':>4} {'tmo':>4} {'rty':>4} {'first p50':>9} {'final p50':>9} "
+               f"{'final p95':>9} {'final max':>9} {'urc p50':>9} {'bytes out':>10} {'bytes in':>10}")
+        for verb, stats in sorted(self.verbs.items()):
+            urc = f"{stats.urc.percentile(50) * 1000:>9.1f}" if stats.urc.count else f"{'-':>9}"
+            yield (f"{verb:<22} {stats.commands:>6} {stats.errors:>4} {stats.timeouts:>4} {stats.retries:>4} "
+                   f"{stats.first_byte.percentile(50) * 1000:>9.1f} {stats.final.percentile(50) * 1000:>9.1f} "
+                   f"{stats.final.percentile(95) * 1000:>9.1f} {stats.final.max * 1000:>9.1f} {urc} "
+                   f"{stats.bytes_out:>10} {stats.bytes_in:>10}")
+        for urc, histogram in sorted(self.urc_fetch.items()):
+            yield (f"{urc} to fetch: {histogram.count} samples, p50 {histogram.percentile(50) * 1000:.1f} ms, "
+                   f"p95 {histogram.percentile(95) * 1000:.1f} ms, max {histogram.max * 1000:.1f} ms")
+
+    def print(self):
+        for line in self.format():
+            print(line)
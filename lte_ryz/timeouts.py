@@ -0,0 +1,129 @@
+from enum import IntEnum
+from typing import Dict, FrozenSet, Optional, Tuple
+
+
+class TIMEOUT_PHASE(IntEnum):
+    # From the command being written to its prompt or final result code
+    RESPONSE = 0
+    # From the final result code to the URC that completes the transaction (AT+SQNHTTPQRY OK -> +SQNHTTPRING)
+    URC = 1
+
+
+# Commands the modem answers without going to the network. They are answered in milliseconds, so until
+# their latency has been learned they time out after LOCAL_TIMEOUT rather than the transaction timeout.
+# "" is the bare AT
+LOCAL_VERBS = frozenset(("",
+                         "+CEREG",
+                         "+SQNHTTPCFG",
+                         "+SQNSCFG",
+                         "+SQNSMQTTCFG",
+                         "+SQNSS"
+                         ))
+LOCAL_TIMEOUT = 5.0
+
+# Commands that carry a payload over the UART. Their latency grows with the payload, which can take many
+# seconds at 115200 baud, so none is learned from the others: they wait until the transaction deadline
+BULK_VERBS = frozenset(("+SQNHTTPRCV",
+                        "+SQNSMQTTRCVMESSAGE",
+                        "+SQNSRECV",
+                        "+SQNSSENDEXT"
+                        ))
+
+# Transactions seen before the learned timeout of a verb is used
+MIN_SAMPLES = 8
+
+# Gains of the moving averages of the latency and of its deviation, and the number of deviations allowed
+# above the average (RFC 6298)
+LATENCY_GAIN = 1 / 8
+DEVIATION_GAIN = 1 / 4
+DEVIATION_FACTOR = 4
+
+# Shortest learned timeout per phase. The modem answers in milliseconds when idle, but can stall for a
+# second or two while it is busy with the network
+MIN_TIMEOUTS = {TIMEOUT_PHASE.RESPONSE: 2.0, TIMEOUT_PHASE.URC: 5.0}
+
+# A timeout doubles the next one, up to this factor, until a transaction of the verb succeeds again
+MAX_BACKOFF = 64
+
+
+class _LearnedTimeout:
+
+    __slots__ = ("latency", "deviation", "samples", "backoff")
+
+    def __init__(self):
+        self.latency = 0.0
+        self.deviation = 0.0
+        self.samples = 0
+        self.backoff = 1
+
+
+class TimeoutPolicy:
+    # Timeouts per command verb and phase, learned from the latency of the transactions that completed: a
+    # moving average of the latency plus DEVIATION_FACTOR times a moving average of its deviation. The
+    # caller's timeout is the deadline of the whole transaction and bounds every phase. With learn=False
+    # every phase waits until the deadline
+
+    def __init__(self, learn: bool = True,
+                 local_verbs: FrozenSet[str] = LOCAL_VERBS,
+                 local_timeout: float = LOCAL_TIMEOUT,
+                 min_samples: int = MIN_SAMPLES,
+                 bulk_verbs: FrozenSet[str] = BULK_VERBS):
+        self.learn = learn
+        self.local_verbs = local_verbs
+        self.bulk_verbs = bulk_verbs
+        self.local_timeout = local_timeout
+        self.min_samples = min_samples
+        self._learned: Dict[Tuple[str, TIMEOUT_PHASE], _LearnedTimeout] = {}
+
+    def timeout(self, verb: str, phase: TIMEOUT_PHASE, limit: float) -> float:
+        # Seconds to wait for the phase, limit being what is left of the transaction deadline
+        if not self.learn or verb in self.bulk_verbs:
+            return limit
+        learned = self._learned.get((verb, phase))
+        timeout = self.learned(verb, phase)
+        if timeout is None:
+            if phase != TIMEOUT_PHASE.RESPONSE or verb not in self.local_verbs:
+                return limit
+            timeout = self.local_timeout
+        if learned is not None:
+            timeout *= learned.backoff
+        return min(timeout, limit)
+
+    def learned(self, verb: str, phase: TIMEOUT_PHASE) -> Optional[float]:
+        learned = self._learned.get((verb, phase))
+        if learned is None or learned.samples < self.min_samples:
+            return None
+        return max(MIN_TIMEOUTS[phase], learned.latency + DEVIATION_FACTOR * learned.deviation)
+
+    def observe(self, verb: str, phase: TIMEOUT_PHASE, seconds: float):
+        if verb in self.bulk_verbs:
+            return
+        learned = self._learned.get((verb, phase))
+        if learned is None:
+            learned = self._learned[(verb, phase)] = _LearnedTimeout()
+            learned.latency = seconds
+            learned.deviation = seconds / 2
+        else:
+            learned.deviation += DEVIATION_GAIN * (abs(seconds - learned.latency) - learned.deviation)
+            learned.latency += LATENCY_GAIN * (seconds - learned.latency)
+        learned.samples += 1
+        learned.backoff = 1
+
+    def expired(self, verb: str, phase: TIMEOUT_PHASE):
+        if verb in self.bulk_verbs:
+            return
+        learned = self._learned.get((verb, phase))
+        if learned is None:
+            learned = self._learned[(verb, phase)] = _LearnedTimeout()
+        learned.backoff = min(learned.backoff * 2, MAX_BACKOFF)
+
+    def reset(self):
+        self._learned.clear()
+
+    def to_dict(self) -> dict:
+        return {f"{verb} {phase.name.lower()}": {"latency": learned.latency,
+                                                   "deviation": learned.deviation,
+                                                   "samples": learned.samples,
+                                                   "backoff": learned.backoff,
+                                                   "timeout": self.learned(verb, phase)}
+                for (verb, phase), learned in sorted(self._learned.items())}
@@ -0,0 +1,256 @@
+import argparse
+import collections
+from enum import Enum, IntEnum
+import os
+import struct
+import sys
+import threading
+import time
+from typing import BinaryIO, Deque, Iterator, List, Optional, Sequence, TextIO, Tuple
+
+from .framer import FRAME_TYPE, Frame
+
+
+class TRACE_LEVEL(IntEnum):
+    # nothing is recorded
+    NONE = 0
+    # commands sent and lines received, binary blocks as their size
+    LINES = 1
+    # everything, including the raw bytes written to and read from the UART
+    RAW = 2
+
+
+class TRACE_DIRECTION(IntEnum):
+    TX = 0
+    RX = 1
+
+
+class TRACE_KIND(IntEnum):
+    # Received frames use their FRAME_TYPE value (0-5)
+    COMMAND = 16
+    PAYLOAD = 17
+    RAW = 18
+
+
+class TRACE_SINK(str, Enum):
+    CONSOLE = "console"
+    FILE = "file"
+    NONE = "none"
+
+
+# Events kept in memory until the drain thread hands them to the sinks. When producers outrun the sinks
+# the oldest events are dropped, never the serial data
+TRACE_BUFFER_SIZE = 16 * 1024
+
+# How often the drain thread empties the ring
+TRACE_DRAIN_INTERVAL = 0.05
+
+# Rotating binary log defaults
+TRACE_FILE_SIZE = 4 * 1024 * 1024
+TRACE_FILE_BACKUPS = 3
+
+# Binary log record: wall clock time, direction, kind, length of the data that follows
+TRACE_RECORD = struct.Struct("<dBBI")
+
+# (time.time(), TRACE_DIRECTION, kind, data or length)
+TraceEvent = Tuple[float, int, int, object]
+
+
+class ConsoleSink:
+    # Prints the events the way the scripts always have: "--> Tx: AT" and "<-- Rx: OK"
+
+    def __init__(self, stream: Optional[TextIO] = None):
+        self._stream = stream
+
+    def write(self, events: Sequence[TraceEvent]):
+        lines = [format_event(event) for event in events]
+        stream = self._stream or sys.stdout
+        # One write per batch, on the drain thread, so a slow terminal only delays the trace
+        stream.write("\n".join(lines) + "\n")
+        stream.flush()
+
+    def close(self):
+        pass
+
+
+class BinaryLogSink:
+    # Appends the events to a compact binary log (TRACE_RECORD header + data). When the file reaches
+    # max_size it is renamed to <path>.1, older ones shift up to <path>.<backups>. read_trace() decodes it
+
+    def __init__(self, path: str, max_size: int = TRACE_FILE_SIZE, backups: int = TRACE_FILE_BACKUPS):
+        self.path = path
+        self.max_size = max_size
+        self.backups = backups
+        self._file: BinaryIO = open(path, "ab")
+
+    def write(self, events: Sequence[TraceEvent]):
+        records = []
+        for timestamp, direction, kind, data in events:
+            if isinstance(data, int):
+                # Only the size was recorded
+                data = b""
+            data = data if isinstance(data, bytes) else str(data).encode()
+            records.append(TRACE_RECORD.pack(timestamp, direction, kind, len(data)) + data)
+        self._file.write(b"".join(records))
+        self._file.flush()
+        if self._file.tell() >= self.max_size:
+            self._rotate()
+
+    def close(self):
+        self._file.close()
+
+    def _rotate(self):
+        self._file.close()
+        for index in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{index}"):
+                os.replace(f"{self.path}.{index}", f"{self.path}.{index + 1}")
+        if self.backups:
+            os.replace(self.path, f"{self.path}.1")
+        self._file = open(self.path, "wb")
+
+
+def read_trace(path: str) -> Iterator[Tuple[float, TRACE_DIRECTION, int, bytes]]:
+    with open(path, "rb") as f:
+        while True:
+            header = f.read(TRACE_RECORD.size)
+            if len(header) < TRACE_RECORD.size:
+                return
+            timestamp, direction, kind, length = TRACE_RECORD.unpack(header)
+            yield timestamp, TRACE_DIRECTION(direction), kind, f.read(length)
+
+
+def format_event(event: TraceEvent) -> str:
+    timestamp, direction, kind, data = event
+    arrow = "\t--> Tx:" if direction == TRACE_DIRECTION.TX else "\t<-- Rx:"
+    if isinstance(data, int):
+        return f"{arrow} <{data} bytes>"
+    if kind in (TRACE_KIND.COMMAND, FRAME_TYPE.LINE, FRAME_TYPE.RESULT, FRAME_TYPE.URC, FRAME_TYPE.PROMPT):
+        return f"{arrow} {data.decode(errors='replace')}"
+    return f"{arrow} {data!r}"
+
+
+class Tracer:
+    # Records UART traffic without slowing down the reader and writer threads. Recording an event is an
+    # append to a bounded deque, which is atomic in CPython; a separate thread drains the deque into the
+    # sinks. No sink, or TRACE_LEVEL.NONE, records nothing
+
+    def __init__(self, sinks: Sequence = (), level: TRACE_LEVEL = TRACE_LEVEL.LINES,
+                 capacity: int = TRACE_BUFFER_SIZE, interval: float = TRACE_DRAIN_INTERVAL):
+        self.sinks = list(sinks)
+        self.level = level if self.sinks else TRACE_LEVEL.NONE
+        self.interval = interval
+        self.dropped = 0
+        self._events: Deque[TraceEvent] = collections.deque(maxlen=capacity)
+        self._thread: Optional[threading.Thread] = None
+        self._running = threading.Event()
+
+    @classmethod
+    def console(cls, level: TRACE_LEVEL = TRACE_LEVEL.LINES) -> "Tracer":
+        return cls([ConsoleSink()], level)
+
+    @classmethod
+    def from_args(cls, args: argparse.Namespace) -> "Tracer":
+        # See add_trace_arguments()
+        sinks: List = []
+        if TRACE_SINK.CONSOLE in args.trace_sink:
+            sinks.append(ConsoleSink())
+        if TRACE_SINK.FILE in args.trace_sink:
+            sinks.append(BinaryLogSink(args.trace_file))
+        return cls(sinks, args.trace)
+
+    @property
+    def enabled(self) -> bool:
+        return self.level > TRACE_LEVEL.NONE
+
+    def start(self):
+        if not self.enabled or self._thread is not None:
+            return
+        self._running.set()
+        self._thread = threading.Thread(target=self._drain_loop, name="at-trace", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._running.clear()
+        self._thread.join()
+        self._thread = None
+        self._drain()
+        for sink in self.sinks:
+            sink.close()
+
+    def tx_commands(self, commands: Sequence[str], data: bytes):
+        if self.level >= TRACE_LEVEL.RAW:
+            self._record(TRACE_DIRECTION.TX, TRACE_KIND.RAW, data)
+        elif self.level:
+            for command in commands:
+                self._record(TRACE_DIRECTION.TX, TRACE_KIND.COMMAND, command.encode())
+
+    def tx_payload(self, data: bytes):
+        if self.level >= TRACE_LEVEL.RAW:
+            self._record(TRACE_DIRECTION.TX, TRACE_KIND.PAYLOAD, bytes(data))
+
+    def rx_frames(self, frames: Sequence[Frame]):
+        # Called on the reader thread. Binary frames may live in a buffer that is reused, so their
+        # content is copied at RAW level and only their size is kept otherwise
+        if not self.level:
+            return
+        raw = self.level >= TRACE_LEVEL.RAW
+        for frame in frames:
+            if frame.type in (FRAME_TYPE.DATA, FRAME_TYPE.STREAM):
+                self._record(TRACE_DIRECTION.RX, frame.type, bytes(frame.data) if raw else len(frame.data))
+            else:
+                self._record(TRACE_DIRECTION.RX, frame.type, bytes(frame.data))
+
+    def rx_line(self, line: bytes):
+        # For readers that split the input into lines themselves
+        if self.level >= TRACE_LEVEL.RAW:
+            self._record(TRACE_DIRECTION.RX, TRACE_KIND.RAW, line)
+        elif self.level and line.strip(b"\r\n"):
+            self._record(TRACE_DIRECTION.RX, FRAME_TYPE.LINE, line.strip(b"\r\n"))
+
+    def _record(self, direction: TRACE_DIRECTION, kind: int, data: object):
+        events = self._events
+        if len(events) == events.maxlen:
+            self.dropped += 1
+        events.append((time.time(), direction, kind, data))
+
+    def _drain_loop(self):
+        while self._running.is_set():
+            self._drain()
+            time.sleep(self.interval)
+
+    def _drain(self):
+        events = []
+        try:
+            while True:
+                events.append(self._events.popleft())
+        except IndexError:
+            pass
+        if not events:
+            return
+        for sink in self.sinks:
+            try:
+                sink.write(events)
+            except (OSError, ValueError):
+                # A sink that fails must not take down the session
+                pass
+
+
+def trace_level(name: str) -> TRACE_LEVEL:
+    # --trace converter. argparse turns ArgumentTypeError into a usage error, but not the KeyError of a lookup
+    try:
+        return TRACE_LEVEL[name.upper()]
+    except KeyError:
+        raise argparse.ArgumentTypeError(f"invalid choice: {name!r} (choose from none, lines, raw)")
+
+
+def add_trace_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--trace", type=trace_level, default=TRACE_LEVEL.LINES,
+                        choices=list(TRACE_LEVEL), metavar="{none,lines,raw}",
+                        help='UART trace verbosity: none, lines (default) or raw')
+    parser.add_argument("--trace_sink", type=TRACE_SINK, nargs="+", default=[TRACE_SINK.CONSOLE],
+                        choices=list(TRACE_SINK), metavar="{console,file,none}",
+                        help='Where the trace goes: console (default), file or none')
+    parser.add_argument("--trace_file", type=str, default="uart_trace.bin",
+                        help='Rotating binary trace log used by --trace_sink file')
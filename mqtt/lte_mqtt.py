@@ -1,43 +1,32 @@
 import argparse
-from enum import Enum, IntEnum
-import queue
-import serial
-import threading
-import time
-from typing import Tuple
+import asyncio
+from enum import IntEnum
+import pathlib
+import sys
+from typing import Optional, Sequence
 from prompt_toolkit import PromptSession
 from prompt_toolkit.completion import WordCompleter
 from prompt_toolkit.patch_stdout import patch_stdout
 
+# make the shared lte_ryz package importable when running the script from its own directory
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[1]))
+from lte_ryz import (ATEngine, Journal, MQTTClient, MQTTConfig, MQTTMessage, MQTTPublisher, MQTTSubscriber,  # noqa: E402
+                     CircuitBreaker, NetworkMonitor, QOS, RESPONSE_ERROR, RetryPolicy, StoreAndForward,
+                     open_serial_port)
+from lte_ryz.trace import Tracer, add_trace_arguments  # noqa: E402
 
-serial_port = serial.Serial()
-serial_rx_q = queue.Queue()
 
+# Broker the client stays connected to. The connection is opened on the first MQTT command and kept open
+# until EXIT, and re-established automatically if the modem reports it lost
+MQTT_SERVER = "test.mosquitto.org"
+MQTT_PORT = 1883
+MQTT_CONFIG = MQTTConfig(host=MQTT_SERVER, port=MQTT_PORT, client_id="ryz_client")
 
-# This command configures the MQTT stack with the client id, user name, and password (if required) for the
-# remote broker, and the CA cert name to use for server authentication
-MQTT_CFG_CMD_HEADER = "AT+SQNSMQTTCFG=0,"
-MQTT_CLIENT_ID = "\"ryz_client\""
+MQTT_TOPIC = "renesas/lte_mqtt"
 
-# This command is used to create new client connection to an external bridge or a broker
-MQTT_CONNECT_CMD_HEADER = "AT+SQNSMQTTCONNECT=0,"
-MQTT_SERVER = "\"test.mosquitto.org\""
-MQTT_PORT = "1883"
-
-# This command subscribes to a topic on a broker host previously contacted with AT+SQNSMQTTCONNECT. This
-# command performs the subscription
-MQTT_SUBSCRIBE_CMD_HEADER = "AT+SQNSMQTTSUBSCRIBE=0,"
-MQTT_TOPIC = "\"renesas/lte_mqtt\""
-
-# This command is used to publish a payload into a topic on to a broker host. It starts the publishing operation
-MQTT_PUBLISH_CMD_HEADER = "AT+SQNSMQTTPUBLISH=0,"
-
-# This command disconnects from a broker. Connection must have been previously initiated with the +SQNSMQTTCONNECT command
-MQTT_DISCONNECT_CMD = "AT+SQNSMQTTDISCONNECT=0"
-
-# This command delivers a message selected by its id or the last received message if <qos>=0. The device
-# must have been connected using the AT+SQNSMQTTCONNECT command
-MQTT_RCV_MESSAGE_CMD_HEADER = "AT+SQNSMQTTRCVMESSAGE=0,"
+# Messages that fail to publish are kept here and published once the modem is registered to the network
+# again, including by a later run of the script
+JOURNAL_DIR = pathlib.Path(__file__).resolve().parent / "journal"
 
 
 class MQTT_ERROR(IntEnum):
@@ -45,33 +34,11 @@ class MQTT_ERROR(IntEnum):
     ERROR = 1
 
 
-class QOS(str, Enum):
-    AT_MOST_ONCE = "0"
-    AT_LEAST_ONCE = "1"
-    EXACTLY_ONCE = "2"
-
-
-class RESPONSE_ERROR(IntEnum):
-    OK = 0
-    ERROR = 1
-    TIMEOUT = 2
-
-
-def get_lte_response():
-    while True:
-        received = serial_port.readline()
-        # uncomment below to see raw data received
-        # print(f"\t<-- Rx: {received}")
-        received = received.strip(b'\r\n')
-        if not received:
-            continue
-        print(f"\t<-- Rx: {received.decode()}")
-        serial_rx_q.put_nowait(received.decode())
-
-
-def handle_command():
-    commands = ['MQTT_PUB',
+async def handle_command(client: MQTTClient, forwarder: Optional[StoreAndForward] = None):
+    commands = ['MQTT_BURST',
+                'MQTT_PUB',
                 'MQTT_SUB',
+                'STATS',
                 'EXIT'
                 ]
     commands.sort()
@@ -82,211 +49,189 @@ def handle_command():
 
     while True:
         try: 
-            input_str: str = session.prompt('>>> ')
+            input_str: str = await session.prompt_async('>>> ')
             if input_str:
                 args = input_str.split(' ', maxsplit=1)
                 match args[0]:
+                    case 'MQTT_BURST':
+                        if len(args) == 1:
+                            count = 100
+                        else:
+                            count = int(args[1])
+                        error = await mqtt_burst(client, count)
+
                     case 'MQTT_PUB':
-                        error = mqtt_pub()
+                        error = await mqtt_pub(client, forwarder)
 
                     case 'MQTT_SUB':
-                        if len(args) == 1:
+                        # MQTT_SUB [timeout] [topic filter ...]
+                        sub_args = input_str.split()[1:]
+                        if len(sub_args) == 0:
                             timeout = 30
                         else:
-                            timeout = int(args[1])
-                        error = mqtt_sub(timeout)
+                            timeout = int(sub_args[0])
+                        topics = sub_args[1:] or [MQTT_TOPIC]
+                        error = await mqtt_sub(client, timeout, topics)
+
+                    case 'STATS':
+                        # STATS prints the AT command latencies, STATS <path> writes them as JSON, or in the
+                        # Prometheus text format for a .prom path
+                        print_stats(client.engine, args[1] if len(args) > 1 else None)
+                        error = MQTT_ERROR.OK
 
                     case 'EXIT':
                         return
 
+                    case _:
+                        print("Invalid command")
+                        continue
+
                 if error == MQTT_ERROR.ERROR:
-                    return
+                    # The client stays usable: a lost connection is set up again by the next command
+                    print(f"{args[0]} failed, enter another command or EXIT")
 
         except KeyboardInterrupt:
             return
 
 
-def main(com_port: str, flow_cntrl: bool):
+async def main(com_port: str, flow_cntrl: bool, tracer: Tracer, capture: Optional[str] = None):
 
-    global serial_port
-    serial_port = open_serial_port(com_port, flow_cntrl)
+    engine = ATEngine(open_serial_port(com_port, flow_cntrl, capture), tracer=tracer)
+    await engine.start()
 
-    lte_rx_task = threading.Thread(target=get_lte_response)
-    lte_rx_task.daemon = True
-    lte_rx_task.start()
+    client = MQTTClient(engine, MQTT_CONFIG)
+    monitor = NetworkMonitor(engine)
+    error = await monitor.start()
+    if error != RESPONSE_ERROR.OK:
+        print(f"Error: {error.name}. Failed to read the network registration status")
+    # Failed commands are retried while the modem is registered, and fail at once while it is not
+    engine.retry = RetryPolicy(CircuitBreaker(monitor))
+    forwarder = StoreAndForward(monitor, Journal(JOURNAL_DIR), mqtt_client=client)
+    await forwarder.start()
 
-    command_handle_task = threading.Thread(target=handle_command)
-    command_handle_task.daemon = True
-    command_handle_task.start()
+    await handle_command(client, forwarder)
+    await forwarder.stop()
+    await client.disconnect()
 
-    while True:
-        # If one of the tasks exits, exit the application
-        if lte_rx_task.is_alive() and command_handle_task.is_alive():
-            time.sleep(1)
-        else:
-            return
+    await engine.stop()
 
 
-def mqtt_disconnect():
-    cmd = MQTT_DISCONNECT_CMD
-    send_command(cmd)
-    response, error = wait_for_response('+SQNSMQTTONDISCONNECT')
+async def mqtt_connect(client: MQTTClient) -> RESPONSE_ERROR:
+    # Only the first command pays for the connection setup
+    if client.connected:
+        return RESPONSE_ERROR.OK
+
+    print(f"Connecting to MQTT broker {MQTT_SERVER}...")
+    error = await client.connect()
     if error != RESPONSE_ERROR.OK:
-        # print(f"Error: {error.name}. Failed at {cmd}")
-        return
+        print(f"Error: {error.name}. Failed to connect to {MQTT_SERVER}")
+    return error
 
 
-def mqtt_pub() -> MQTT_ERROR:
+async def mqtt_pub(client: MQTTClient, forwarder: Optional[StoreAndForward] = None) -> MQTT_ERROR:
 
     print(f"Publishing MQTT data to topic: {MQTT_TOPIC} on server: {MQTT_SERVER}")
 
-    mqtt_disconnect()
-
-    cmd = MQTT_CFG_CMD_HEADER + MQTT_CLIENT_ID
-    send_command(cmd)
-    response, error = wait_for_response('OK')
+    error = await mqtt_connect(client)
     if error != RESPONSE_ERROR.OK:
-        print(f"Error: {error.name}. Failed at {cmd}")
-        return MQTT_ERROR.ERROR
-
-    cmd = MQTT_CONNECT_CMD_HEADER + MQTT_SERVER + "," + MQTT_PORT
-    send_command(cmd)
-    response, error = wait_for_response('+SQNSMQTTONCONNECT')
-    if error != RESPONSE_ERROR.OK:
-        print(f"Error: {error.name}. Failed at {cmd}")
-        return MQTT_ERROR.ERROR
-
-    response_code = response.split(",")[1]
-    if response_code != "0":
-        print(f"MQTT connect failed with error code: {response_code}")
         return MQTT_ERROR.ERROR
 
     while True:
 
         with patch_stdout():
             try:
-                message = session.prompt('Enter a message to publish, or exit to quit: ')
+                message = await session.prompt_async('Enter a message to publish, or exit to quit: ')
                 if message is None or message == "exit":
                     break
             except KeyboardInterrupt:
                 return MQTT_ERROR.ERROR
 
-        cmd = MQTT_PUBLISH_CMD_HEADER + MQTT_TOPIC + ",," + str(len(message))
-        send_command(cmd)
-        response, error = wait_for_response('>')
-        if error != RESPONSE_ERROR.OK:
-            print(f"Error: {error.name}. Failed at {cmd}")
-            return MQTT_ERROR.ERROR
-
-        send_command(message)
-        response, error = wait_for_response('+SQNSMQTTONPUBLISH')
+        mid, error = await client.publish(MQTT_TOPIC, message.encode())
         if error != RESPONSE_ERROR.OK:
-            print(f"Error: {error.name}. Failed at {cmd}. response {response}")
-            return MQTT_ERROR.ERROR
+            print(f"Error: {error.name}. Failed to publish to {MQTT_TOPIC}")
+            if forwarder is None:
+                return MQTT_ERROR.ERROR
+            # Keep prompting, the message is published once the network is back
+            if forwarder.queue_mqtt(MQTT_TOPIC, message.encode(), QOS.AT_MOST_ONCE) is None:
+                print("Journal full, message dropped")
+            else:
+                print(f"Message queued, {forwarder.pending} waiting for the network")
+            continue
 
         print(f"Published \"{message}\" to topic {MQTT_TOPIC} at {MQTT_SERVER} ")
 
-    mqtt_disconnect()
-
     return MQTT_ERROR.OK
 
 
-def mqtt_sub(timeout: int) -> MQTT_ERROR:
+async def mqtt_burst(client: MQTTClient, count: int) -> MQTT_ERROR:
 
-    print(f"Subscribing to MQTT data for topic: {MQTT_TOPIC} on server: {MQTT_SERVER} ")
+    print(f"Publishing {count} messages to topic: {MQTT_TOPIC} on server: {MQTT_SERVER}")
 
-    mqtt_disconnect()
-
-    cmd = MQTT_CFG_CMD_HEADER + MQTT_CLIENT_ID
-    send_command(cmd)
-    response, error = wait_for_response('OK')
+    error = await mqtt_connect(client)
     if error != RESPONSE_ERROR.OK:
-        print(f"Error: {error.name}. Failed at {cmd}")
         return MQTT_ERROR.ERROR
 
-    cmd = MQTT_CONNECT_CMD_HEADER + MQTT_SERVER + "," + MQTT_PORT
-    send_command(cmd)
-    response, error = wait_for_response('+SQNSMQTTONCONNECT')
-    if error != RESPONSE_ERROR.OK:
-        print(f"Error: {error.name}. Failed at {cmd}")
-        return MQTT_ERROR.ERROR
+    # Several publishes are kept outstanding at once. publish() only waits when the queue is full
+    publisher = MQTTPublisher(client)
+    await publisher.start()
+    acks = []
+    for i in range(count):
+        acks.append(await publisher.publish(MQTT_TOPIC, f"message {i}".encode(), QOS.AT_LEAST_ONCE))
+    await publisher.stop()
 
-    response_code = response.split(",")[1]
-    if response_code != "0":
-        print(f"MQTT connect failed with error code: {response_code}")
+    for mid, error in (ack.result() for ack in acks):
+        if error != RESPONSE_ERROR.OK:
+            print(f"Error: {error.name}. Failed to publish to {MQTT_TOPIC}")
 
-    cmd = MQTT_SUBSCRIBE_CMD_HEADER + MQTT_TOPIC + "," + QOS.AT_LEAST_ONCE
-    send_command(cmd)
-    response, error = wait_for_response('+SQNSMQTTONSUBSCRIBE')
-    if error != RESPONSE_ERROR.OK:
-        print(f"Error: {error.name}. Failed at {cmd}")
-        return MQTT_ERROR.ERROR
+    print(f"Published {publisher.published} of {count} messages in {publisher.elapsed:.2f} s "
+          f"({publisher.messages_per_second:.1f} messages/s), maximum queue depth {publisher.max_queue_depth}, "
+          f"ack latency p50 {publisher.ack_latency(50) * 1000:.0f} ms, p95 {publisher.ack_latency(95) * 1000:.0f} ms")
 
-    print(f"Subscribed to {MQTT_TOPIC} at {MQTT_SERVER}. Listening for {timeout} seconds...")
+    return MQTT_ERROR.OK
 
-    start_time = time.time()
-    while True:
-        if time.time() - start_time > timeout:
-            print(f"{timeout} timeout expired. Disconnecting from MQTT broker")
-            mqtt_disconnect()
-            return MQTT_ERROR.OK
-
-        response, error = wait_for_response('+SQNSMQTTONMESSAGE')
-        if error == RESPONSE_ERROR.TIMEOUT:
-            print(f"{timeout} timeout expired. Disconnecting from broker")
-            mqtt_disconnect()
-            return
 
-        elif error == RESPONSE_ERROR.OK:
-            cmd = MQTT_RCV_MESSAGE_CMD_HEADER + MQTT_TOPIC
-            send_command(cmd)
-            response, error = wait_for_response('OK')
-            if error != RESPONSE_ERROR.OK:
-                print(f"Error: {error.name}. Failed at {cmd}")
-                return MQTT_ERROR.ERROR
+def print_stats(engine: ATEngine, path: Optional[str]):
 
-            response = response.strip("OK")
-            print(f"Received message: {response}")
+    if path is None:
+        engine.stats.print()
+        return
+    try:
+        engine.stats.write(path)
+    except OSError as e:
+        print(f"Error: cannot write {path}: {e}")
+        return
+    print(f"Statistics written to {path}")
 
 
-def open_serial_port(com_port: str, flow_cntrl: bool) -> serial.Serial:
-    ser = serial.Serial()
-    ser.port = com_port
-    ser.baudrate = 115200
-    ser.rtscts = flow_cntrl
-    ser.timeout = 1
-    ser.open()
-    return ser
+def print_message(message: MQTTMessage):
+    print(f"Received message on {message.topic}: {str(message.payload, 'utf-8', errors='replace')}")
 
 
-def send_command(command: str, add_terminator: bool = True):
-    print(f"\t--> Tx: {command}")
-    if add_terminator:
-        command += "\r"
-    # uncomment below to see raw data transmitted
-    # print(f"\t--> Tx:{command.encode()}")
-    serial_port.write(command.encode())
+async def mqtt_sub(client: MQTTClient, timeout: int, topics: Sequence[str] = (MQTT_TOPIC,)) -> MQTT_ERROR:
 
+    print(f"Subscribing to MQTT data for topics: {', '.join(topics)} on server: {MQTT_SERVER} ")
 
-def wait_for_response(expected: str) -> Tuple[str, RESPONSE_ERROR]:
-    response = str()
-    response_buffer = str()
-    while True:
-        try:
-            response_buffer = serial_rx_q.get(timeout=30)
-        except queue.Empty:
-            return str(), RESPONSE_ERROR.TIMEOUT
-
-        if expected in response_buffer:
-            response += response_buffer
-            return response, RESPONSE_ERROR.OK
-        elif "ERROR" in response_buffer:
-            return response, RESPONSE_ERROR.ERROR
-        elif "+CEREG" in response_buffer:
-            # ignore CEREG updates
-            continue
+    error = await mqtt_connect(client)
+    if error != RESPONSE_ERROR.OK:
+        return MQTT_ERROR.ERROR
 
-        response += response_buffer
+    # Messages are fetched as they are announced and handed to print_message on a worker
+    subscriber = MQTTSubscriber(client)
+    await subscriber.start()
+    try:
+        for topic in topics:
+            error = await subscriber.subscribe(topic, print_message, QOS.AT_LEAST_ONCE)
+            if error != RESPONSE_ERROR.OK:
+                print(f"Error: {error.name}. Failed to subscribe to {topic}")
+                return MQTT_ERROR.ERROR
+
+        print(f"Subscribed to {', '.join(topics)} at {MQTT_SERVER}. Listening for {timeout} seconds...")
+        await asyncio.sleep(timeout)
+        print(f"{timeout} timeout expired. Unsubscribing from {', '.join(topics)}")
+    finally:
+        await subscriber.stop()
+
+    return MQTT_ERROR.OK
 
 
 if __name__ == "__main__":
@@ -295,11 +240,14 @@ if __name__ == "__main__":
 
     parser.add_argument("com_port", type=str, help='COM port for your development kit')
     parser.add_argument("--flow_cntrl", action="store_true", help='Enable serial flow control')
+    add_trace_arguments(parser)
+    parser.add_argument("--capture", type=str, default=None,
+                        help='Record the UART traffic to this file, played back with replay://<file> as the COM port')
 
     args = parser.parse_args()
 
     try:
-        main(args.com_port, args.flow_cntrl)
+        asyncio.run(main(args.com_port, args.flow_cntrl, Tracer.from_args(args), args.capture))
     except KeyboardInterrupt:
         pass
 
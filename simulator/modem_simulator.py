@@ -0,0 +1,76 @@
+import argparse
+import os
+import pathlib
+import sys
+import threading
+import tty
+
+# make the shared lte_ryz package importable when running the script from its own directory
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[1]))
+from lte_ryz import ModemSimulator, SimulatorConfig  # noqa: E402
+
+
+def modem_to_host(modem: ModemSimulator, master: int):
+    while True:
+        data = modem.read(4096)
+        if not data:
+            return
+        os.write(master, data)
+
+
+def main(config: SimulatorConfig):
+
+    # The scripts open the slave side of the pseudo-terminal as if it was the USB to UART converter
+    master, slave = os.openpty()
+    tty.setraw(slave)
+    print(f"Simulated modem listening on {os.ttyname(slave)}")
+
+    modem = ModemSimulator(config)
+    modem.start()
+
+    tx_task = threading.Thread(target=modem_to_host, args=[modem, master])
+    tx_task.daemon = True
+    tx_task.start()
+
+    try:
+        while True:
+            data = os.read(master, 4096)
+            if not data:
+                break
+            modem.write(data)
+    finally:
+        modem.stop()
+        os.close(slave)
+        os.close(master)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='Modem simulator',
+                                     description='Simulates an RYZ014A/RYZ024A modem on a pseudo-terminal')
+
+    parser.add_argument("--latency", type=float, default=0.0, help='Seconds before a command is answered')
+    parser.add_argument("--network_latency", type=float, default=0.05,
+                        help='Seconds before network results (+SQNHTTPRING, +SQNSRING, ...) are reported')
+    parser.add_argument("--baudrate", type=int, default=115200, help='Simulated UART speed, 0 to disable throttling')
+    parser.add_argument("--error_rate", type=float, default=0.0, help='Probability that a command fails')
+    parser.add_argument("--seed", type=int, default=None, help='Seed for the error injection')
+    parser.add_argument("--echo", action="store_true", help='Echo commands back until ATE0')
+    parser.add_argument("--guard_time", type=float, default=1.0,
+                        help='Silence required around the +++ escape sequence in online mode')
+    parser.add_argument("--packet_loss", type=float, default=0.0, help='Probability that a UDP datagram is lost')
+
+    args = parser.parse_args()
+
+    try:
+        main(SimulatorConfig(latency=args.latency,
+                             network_latency=args.network_latency,
+                             baudrate=args.baudrate,
+                             error_rate=args.error_rate,
+                             seed=args.seed,
+                             echo=args.echo,
+                             guard_time=args.guard_time,
+                             packet_loss=args.packet_loss))
+    except KeyboardInterrupt:
+        pass
+
+    print("Exiting...")
@@ -1,46 +1,257 @@
 import argparse
-import socket
+import asyncio
+from enum import Enum
+import itertools
+import time
+from typing import Dict, List, Optional
 
 
-def main(server_ip: str, server_port: int):
+# Bytes read from a client at once
+READ_SIZE = 64 * 1024
 
-    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+# Turnaround histogram buckets, upper bounds in milliseconds. The last bucket takes everything above
+HISTOGRAM_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+HISTOGRAM_WIDTH = 40
 
-    server.bind((server_ip, server_port))
-    server.settimeout(30)
-    server.listen(0)
-    print(f"Listening on {server_ip}:{server_port}")
 
-    client_socket, client_address = server.accept()
-    client_socket.settimeout(30)
-    print(f"Accepted connection from {client_address[0]}:{client_address[1]}")
+class SERVER_MODE(str, Enum):
+    # send back every byte as received
+    ECHO = "echo"
+    # send back the bytes upper cased
+    UPPER = "upper"
+    # read and discard
+    SINK = "sink"
+    # send at a fixed rate, discard what is received
+    SOURCE = "source"
+    # echo after a fixed delay
+    DELAYED = "delayed"
 
-    while True:
-        request = client_socket.recv(1024)
-        if not request:
-            break
 
-        request = request.decode()
-        print(f"Received: {request}")
-        print(f"Sending: {request.upper()}")
-        client_socket.send(request.upper().encode())
+class Histogram:
 
-    client_socket.close()
-    server.close()
-    print("Connection to client closed")
-    print("Exiting...")
+    def __init__(self, buckets_ms=HISTOGRAM_BUCKETS_MS):
+        self.buckets_ms = buckets_ms
+        self.counts = [0] * (len(buckets_ms) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds: float):
+        ms = seconds * 1000
+        index = next((i for i, bound in enumerate(self.buckets_ms) if ms < bound), len(self.buckets_ms))
+        self.counts[index] += 1
+        self.count += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+
+    def merge(self, other: "Histogram"):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, percent: float) -> float:
+        # upper bound of the bucket holding the percentile, in milliseconds
+        rank = max(1, round(percent / 100 * self.count))
+        for count, bound in zip(itertools.accumulate(self.counts), self.buckets_ms + (self.max,)):
+            if count >= rank:
+                return bound
+        return self.max
+
+    def print(self, indent: str = "  "):
+        if not self.count:
+            print(f"{indent}no samples")
+            return
+        print(f"{indent}{self.count} samples, mean {self.total / self.count:.1f} ms, p50 < {self.percentile(50):.0f} ms, "
+              f"p99 < {self.percentile(99):.0f} ms, max {self.max:.1f} ms")
+        peak = max(self.counts)
+        lower = 0
+        for count, bound in zip(self.counts, self.buckets_ms + (None,)):
+            label = f"{lower:>5}-{bound:<5} ms" if bound is not None else f"{lower:>5}+      ms"
+            lower = bound
+            if count:
+                print(f"{indent}{label} {'#' * max(1, count * HISTOGRAM_WIDTH // peak):<{HISTOGRAM_WIDTH}} {count}")
+
+
+class Connection:
+
+    def __init__(self, peer: str):
+        self.peer = peer
+        self.start = time.monotonic()
+        self.end: Optional[float] = None
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        # Time from a write to the client until the next data from it: the round trip through the modem
+        # plus the client's own processing
+        self.turnaround = Histogram()
+        self.last_sent: Optional[float] = None
+
+    @property
+    def elapsed(self) -> float:
+        return (self.end or time.monotonic()) - self.start
+
+    def received(self, size: int):
+        now = time.monotonic()
+        self.bytes_received += size
+        if self.last_sent is not None:
+            self.turnaround.add(now - self.last_sent)
+            self.last_sent = None
+
+    def sent(self, size: int):
+        self.bytes_sent += size
+        if self.last_sent is None:
+            self.last_sent = time.monotonic()
+
+    def print(self):
+        elapsed = self.elapsed
+        print(f"{self.peer}: received {self.bytes_received} bytes ({self.bytes_received / elapsed:.0f} bytes/s), "
+              f"sent {self.bytes_sent} bytes ({self.bytes_sent / elapsed:.0f} bytes/s) in {elapsed:.2f} s")
+        self.turnaround.print()
+
+
+class LoadServer:
+
+    def __init__(self, mode: SERVER_MODE, delay: float, rate: int, chunk_size: int, verbose: bool):
+        self.mode = mode
+        self.delay = delay
+        self.rate = rate
+        self.chunk_size = chunk_size
+        self.verbose = verbose
+        self.active: Dict[asyncio.StreamWriter, Connection] = {}
+        self.closed: List[Connection] = []
+
+    async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        address = writer.get_extra_info("peername")
+        connection = Connection(f"{address[0]}:{address[1]}")
+        self.active[writer] = connection
+        print(f"Accepted connection from {connection.peer} ({len(self.active)} active)")
+
+        try:
+            match self.mode:
+                case SERVER_MODE.ECHO | SERVER_MODE.UPPER | SERVER_MODE.SINK:
+                    await self.echo(reader, writer, connection)
+                case SERVER_MODE.SOURCE:
+                    await self.source(reader, writer, connection)
+                case SERVER_MODE.DELAYED:
+                    await self.delayed_echo(reader, writer, connection)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+            connection.end = time.monotonic()
+            del self.active[writer]
+            self.closed.append(connection)
+            print(f"Connection to {connection.peer} closed ({len(self.active)} active)")
+            connection.print()
+
+    async def echo(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, connection: Connection):
+        while True:
+            data = await reader.read(READ_SIZE)
+            if not data:
+                return
+            connection.received(len(data))
+            if self.verbose:
+                print(f"Received from {connection.peer}: {data!r}")
+            if self.mode == SERVER_MODE.SINK:
+                continue
+            if self.mode == SERVER_MODE.UPPER:
+                data = data.upper()
+            writer.write(data)
+            connection.sent(len(data))
+            await writer.drain()
+
+    async def delayed_echo(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, connection: Connection):
+        # Reading goes on while replies wait for their time, so the delay does not slow the client down
+        replies: asyncio.Queue = asyncio.Queue()
+
+        async def reply():
+            while True:
+                due, data = await replies.get()
+                await asyncio.sleep(max(0.0, due - time.monotonic()))
+                writer.write(data)
+                connection.sent(len(data))
+                await writer.drain()
+
+        replier = asyncio.create_task(reply())
+        try:
+            while True:
+                data = await reader.read(READ_SIZE)
+                if not data:
+                    return
+                connection.received(len(data))
+                replies.put_nowait((time.monotonic() + self.delay, data))
+        finally:
+            replier.cancel()
+
+    async def source(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, connection: Connection):
+        async def discard():
+            while True:
+                data = await reader.read(READ_SIZE)
+                if not data:
+                    return
+                connection.received(len(data))
+
+        receiver = asyncio.create_task(discard())
+        chunk = bytes(i % 256 for i in range(self.chunk_size))
+        interval = self.chunk_size / self.rate
+        next_send = time.monotonic()
+        try:
+            while not receiver.done():
+                writer.write(chunk)
+                connection.sent(len(chunk))
+                await writer.drain()
+                next_send += interval
+                await asyncio.sleep(max(0.0, next_send - time.monotonic()))
+        finally:
+            receiver.cancel()
+
+    def print_summary(self):
+        connections = self.closed + list(self.active.values())
+        if not connections:
+            return
+        total = Histogram()
+        for connection in connections:
+            total.merge(connection.turnaround)
+        received = sum(connection.bytes_received for connection in connections)
+        sent = sum(connection.bytes_sent for connection in connections)
+        print(f"{len(connections)} connections, received {received} bytes, sent {sent} bytes")
+        total.print()
+
+
+async def main(server_ip: str, server_port: int, mode: SERVER_MODE, delay: float, rate: int, chunk_size: int,
+               backlog: int, verbose: bool):
+
+    load_server = LoadServer(mode, delay, rate, chunk_size, verbose)
+    server = await asyncio.start_server(load_server.handle_client, server_ip, server_port, backlog=backlog)
+    print(f"Listening on {server_ip}:{server_port} in {mode.value} mode")
+
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        load_server.print_summary()
 
 
 if __name__ == "__main__":
 
-    parser = argparse.ArgumentParser(prog='LTE CLI',
-                                     description='')
+    parser = argparse.ArgumentParser(prog='TCP echo server',
+                                     description='Echo and load test server for the LTE socket examples')
 
-    parser.add_argument("server_ip", type=str, help='COM port for your development kit')
-    parser.add_argument("server_port", type=int, help='COM port for your development kit')
+    parser.add_argument("server_ip", type=str, help='IP address to listen on')
+    parser.add_argument("server_port", type=int, help='Port to listen on')
+    parser.add_argument("--mode", type=SERVER_MODE, default=SERVER_MODE.ECHO, choices=list(SERVER_MODE),
+                        help='echo, upper, sink, source or delayed (default: echo)')
+    parser.add_argument("--delay", type=float, default=1.0, help='Seconds before a reply in delayed mode')
+    parser.add_argument("--rate", type=int, default=1024, help='Bytes per second sent in source mode')
+    parser.add_argument("--chunk_size", type=int, default=256, help='Bytes per write in source mode')
+    parser.add_argument("--backlog", type=int, default=100, help='Connections waiting to be accepted')
+    parser.add_argument("--verbose", action="store_true", help='Print the data received')
     args = parser.parse_args()
 
     try:
-        main(args.server_ip, args.server_port)
+        asyncio.run(main(args.server_ip, args.server_port, args.mode, args.delay, args.rate, args.chunk_size,
+                         args.backlog, args.verbose))
     except KeyboardInterrupt:
         pass
+
+    print("Exiting...")
@@ -0,0 +1,123 @@
+import argparse
+import asyncio
+import pathlib
+import sys
+from typing import Optional
+import time
+
+# make the shared lte_ryz package importable when running the script from its own directory
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[2]))
+from lte_ryz import ATEngine, OnlineSocket, RESPONSE_ERROR, SocketManager, TRANSMISSION_PROTOCOL, open_serial_port  # noqa: E402
+from lte_ryz.sockets import SOCKET_STATUS_CMD  # noqa: E402
+from lte_ryz.trace import Tracer, add_trace_arguments  # noqa: E402
+
+
+# Local applications connect here. Their connection is carried to the server by a modem socket in online
+# mode, so the UART only carries payload instead of AT+SQNSSENDEXT/AT+SQNSRECV transactions
+LOCAL_HOST = "127.0.0.1"
+LOCAL_PORT = 9000
+
+# Bytes read from the local connection at once
+BRIDGE_CHUNK_SIZE = 4096
+
+
+async def local_to_modem(reader: asyncio.StreamReader, sock: OnlineSocket):
+    while True:
+        data = await reader.read(BRIDGE_CHUNK_SIZE)
+        if not data:
+            return
+        if await sock.write(data) != RESPONSE_ERROR.OK:
+            return
+
+
+async def modem_to_local(sock: OnlineSocket, writer: asyncio.StreamWriter):
+    while True:
+        data = await sock.read(BRIDGE_CHUNK_SIZE)
+        if not data:
+            return
+        writer.write(data)
+        await writer.drain()
+
+
+async def bridge(manager: SocketManager, server_ip: str, server_port: int, guard_time: float,
+                 reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+
+    peer = writer.get_extra_info("peername")
+    print(f"Accepted connection from {peer[0]}:{peer[1]}")
+
+    # The modem carries one online socket at a time
+    print(f"Connecting to {server_ip}:{server_port} in online mode...")
+    sock, error = await manager.open_online(TRANSMISSION_PROTOCOL.TCP, server_ip, server_port, wait=True)
+    if error != RESPONSE_ERROR.OK:
+        print(f"Error: {error.name}. Failed to connect to {server_ip}:{server_port}")
+        writer.close()
+        return
+
+    print(f"Bridging {peer[0]}:{peer[1]} to {server_ip}:{server_port} on connection id {sock.connection_id}")
+    start = time.monotonic()
+    tasks = (asyncio.create_task(local_to_modem(reader, sock)), asyncio.create_task(modem_to_local(sock, writer)))
+    # Whichever side closes first ends the bridge
+    done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    for task in pending:
+        task.cancel()
+
+    # Escapes back to command mode with +++ and closes the socket
+    error = await sock.close(guard_time)
+    if error != RESPONSE_ERROR.OK:
+        print(f"Error: {error.name}. Failed to close socket {sock.connection_id}")
+    writer.close()
+
+    elapsed = time.monotonic() - start
+    print(f"Connection from {peer[0]}:{peer[1]} closed: sent {sock.bytes_sent} bytes, received {sock.bytes_received} "
+          f"bytes in {elapsed:.2f} s ({(sock.bytes_sent + sock.bytes_received) / elapsed:.0f} bytes/s)")
+
+
+async def main(com_port: str, flow_cntrl: bool, server_ip: str, server_port: int, local_port: int, guard_time: float,
+               tracer: Tracer, capture: Optional[str] = None):
+
+    engine = ATEngine(open_serial_port(com_port, flow_cntrl, capture), tracer=tracer)
+    await engine.start()
+
+    print("Checking socket state...")
+    manager = SocketManager(engine)
+    error = await manager.start()
+    if error != RESPONSE_ERROR.OK:
+        print(f"Error: {error.name}. Failed at {SOCKET_STATUS_CMD}")
+        await engine.stop()
+        return
+
+    server = await asyncio.start_server(lambda reader, writer: bridge(manager, server_ip, server_port, guard_time,
+                                                                      reader, writer),
+                                        LOCAL_HOST, local_port)
+    print(f"Listening on {LOCAL_HOST}:{local_port}")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await manager.stop()
+        await engine.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='LTE online bridge',
+                                     description='Bridges a local TCP port to a server through a modem socket in online mode')
+
+    parser.add_argument("com_port", type=str, help='COM port for your development kit')
+    parser.add_argument("--flow_cntrl", action="store_true", help='Enable serial flow control')
+    add_trace_arguments(parser)
+    parser.add_argument("--capture", type=str, default=None,
+                        help='Record the UART traffic to this file, played back with replay://<file> as the COM port')
+    parser.add_argument("server_ip", type=str, help='IP address of the server')
+    parser.add_argument("server_port", type=int, help='Port of the server')
+    parser.add_argument("--local_port", type=int, default=LOCAL_PORT, help='Local port to accept connections on')
+    parser.add_argument("--guard_time", type=float, default=1.0,
+                        help='Silence required around the +++ escape sequence (S12 setting of the modem)')
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(main(args.com_port, args.flow_cntrl, args.server_ip, args.server_port, args.local_port,
+                         args.guard_time, Tracer.from_args(args), args.capture))
+    except KeyboardInterrupt:
+        pass
+
+    print("Exiting...")
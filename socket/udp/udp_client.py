@@ -0,0 +1,132 @@
+import argparse
+import asyncio
+import pathlib
+import struct
+import sys
+import time
+from typing import Optional, Set
+
+# make the shared lte_ryz package importable when running the script from its own directory
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[2]))
+from lte_ryz import (ATEngine, RESPONSE_ERROR, SocketManager, UDPBatcher, UDPSocket, open_serial_port,  # noqa: E402
+                     unpack_messages)
+from lte_ryz.sockets import SOCKET_STATUS_CMD, UDP_BATCH_MAX_SIZE, UDP_BATCH_WINDOW  # noqa: E402
+from lte_ryz.trace import Tracer, add_trace_arguments  # noqa: E402
+
+
+# Every message starts with its sequence number and send time, so the echoes tell which messages were
+# lost and how long the round trip took
+MESSAGE_HEADER = struct.Struct(">Id")
+
+# How long to wait for the last echoes once everything has been sent
+DRAIN_TIME = 5.0
+
+
+async def receive_echoes(sock: UDPSocket, received: Set[int], round_trips: list):
+    while True:
+        datagram, address, error = await sock.recvfrom(timeout=3600)
+        if not datagram:
+            return
+        for message in unpack_messages(datagram):
+            if len(message) < MESSAGE_HEADER.size:
+                continue
+            sequence, sent = MESSAGE_HEADER.unpack_from(message)
+            received.add(sequence)
+            round_trips.append(time.monotonic() - sent)
+
+
+async def run_udp_client(engine: ATEngine, server_ip: str, server_port: int, count: int, size: int, rate: float,
+                         window: float, max_size: int):
+
+    print("Checking socket state...")
+    manager = SocketManager(engine)
+    error = await manager.start()
+    if error != RESPONSE_ERROR.OK:
+        print(f"Error: {error.name}. Failed at {SOCKET_STATUS_CMD}")
+        return
+
+    print(f"Opening UDP socket to {server_ip}:{server_port}...")
+    sock, error = await manager.open_udp(server_ip, server_port)
+    if error != RESPONSE_ERROR.OK:
+        print(f"Error: {error.name}. Failed to open UDP socket to {server_ip}:{server_port}")
+        return
+
+    received: Set[int] = set()
+    round_trips: list = []
+    receiver = asyncio.create_task(receive_echoes(sock, received, round_trips))
+
+    # Messages queued within the batching window share one AT+SQNSSENDEXT and one datagram
+    batcher = UDPBatcher(sock, window=window, max_size=max_size)
+    padding = bytes(max(0, size - MESSAGE_HEADER.size))
+    print(f"Sending {count} messages of {MESSAGE_HEADER.size + len(padding)} bytes at {rate:.0f} messages/s...")
+    start = time.monotonic()
+    for sequence in range(count):
+        await asyncio.sleep(max(0.0, start + sequence / rate - time.monotonic()))
+        error = await batcher.send(MESSAGE_HEADER.pack(sequence, time.monotonic()) + padding)
+        if error != RESPONSE_ERROR.OK:
+            print(f"Error: {error.name}. Failed to send on socket {sock.connection_id}")
+    await batcher.flush()
+    elapsed = time.monotonic() - start
+
+    # Echoes still in flight are given some time to arrive
+    deadline = time.monotonic() + DRAIN_TIME
+    while len(received) < batcher.messages_sent and time.monotonic() < deadline:
+        await asyncio.sleep(0.1)
+    receiver.cancel()
+
+    lost = batcher.messages_sent - len(received)
+    print(f"Sent {batcher.messages_sent} messages in {batcher.datagrams_sent} datagrams, {batcher.bytes_sent} bytes "
+          f"in {elapsed:.2f} s ({batcher.messages_sent / elapsed:.1f} messages/s, "
+          f"{batcher.datagrams_sent / elapsed:.1f} datagrams/s, {batcher.bytes_sent / elapsed:.0f} bytes/s)")
+    if batcher.messages_failed:
+        print(f"Failed to send {batcher.messages_failed} messages")
+    print(f"Received {sock.datagrams_received} datagrams, {sock.bytes_received} bytes, "
+          f"{len(received)} messages echoed")
+    print(f"Lost {lost} messages ({100 * lost / max(1, batcher.messages_sent):.1f}%)")
+    if round_trips:
+        round_trips.sort()
+        print(f"Round trip: min {1000 * round_trips[0]:.0f} ms, median {1000 * round_trips[len(round_trips) // 2]:.0f} ms, "
+              f"max {1000 * round_trips[-1]:.0f} ms")
+    print("AT command latencies:")
+    engine.stats.print()
+
+    await manager.stop()
+
+
+async def main(com_port: str, flow_cntrl: bool, server_ip: str, server_port: int, count: int, size: int,
+               rate: float, window: float, max_size: int, tracer: Tracer, capture: Optional[str] = None):
+
+    engine = ATEngine(open_serial_port(com_port, flow_cntrl, capture), tracer=tracer)
+    await engine.start()
+
+    await run_udp_client(engine, server_ip, server_port, count, size, rate, window, max_size)
+
+    await engine.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='LTE UDP client',
+                                     description='Sends batched telemetry to a UDP echo server and reports loss')
+
+    parser.add_argument("com_port", type=str, help='COM port for your development kit')
+    parser.add_argument("--flow_cntrl", action="store_true", help='Enable serial flow control')
+    add_trace_arguments(parser)
+    parser.add_argument("--capture", type=str, default=None,
+                        help='Record the UART traffic to this file, played back with replay://<file> as the COM port')
+    parser.add_argument("server_ip", type=str, help='IP address of the server')
+    parser.add_argument("server_port", type=int, help='Port of the server')
+    parser.add_argument("--count", type=int, default=100, help='Messages to send')
+    parser.add_argument("--size", type=int, default=32, help='Bytes per message')
+    parser.add_argument("--rate", type=float, default=50.0, help='Messages queued per second')
+    parser.add_argument("--window", type=float, default=UDP_BATCH_WINDOW,
+                        help='Seconds a message waits for others to share its datagram, 0 sends every message alone')
+    parser.add_argument("--max_size", type=int, default=UDP_BATCH_MAX_SIZE, help='Largest datagram in bytes')
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(main(args.com_port, args.flow_cntrl, args.server_ip, args.server_port, args.count, args.size,
+                         args.rate, args.window, args.max_size, Tracer.from_args(args), args.capture))
+    except KeyboardInterrupt:
+        pass
+
+    print("Exiting...")
@@ -0,0 +1,64 @@
+import argparse
+import asyncio
+import time
+from typing import Dict, Tuple
+
+
+class EchoProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self, verbose: bool):
+        self.verbose = verbose
+        self.transport = None
+        self.start = time.monotonic()
+        # datagrams and bytes received per peer
+        self.peers: Dict[Tuple[str, int], Tuple[int, int]] = {}
+
+    def connection_made(self, transport: asyncio.DatagramTransport):
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, address: Tuple[str, int]):
+        if address not in self.peers:
+            print(f"First datagram from {address[0]}:{address[1]}")
+        datagrams, size = self.peers.get(address, (0, 0))
+        self.peers[address] = (datagrams + 1, size + len(data))
+        if self.verbose:
+            print(f"Received from {address[0]}:{address[1]}: {data!r}")
+        # Datagrams are sent back unchanged, so batched messages keep their framing
+        self.transport.sendto(data, address)
+
+    def print_summary(self):
+        elapsed = time.monotonic() - self.start
+        for address, (datagrams, size) in self.peers.items():
+            print(f"{address[0]}:{address[1]}: echoed {datagrams} datagrams, {size} bytes "
+                  f"({datagrams / elapsed:.1f} datagrams/s, {size / elapsed:.0f} bytes/s)")
+
+
+async def main(server_ip: str, server_port: int, verbose: bool):
+
+    loop = asyncio.get_running_loop()
+    transport, protocol = await loop.create_datagram_endpoint(lambda: EchoProtocol(verbose),
+                                                              local_addr=(server_ip, server_port))
+    print(f"Listening on {server_ip}:{server_port}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        transport.close()
+        protocol.print_summary()
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(prog='UDP echo server',
+                                     description='Echoes every datagram back to its sender')
+
+    parser.add_argument("server_ip", type=str, help='IP address to listen on')
+    parser.add_argument("server_port", type=int, help='Port to listen on')
+    parser.add_argument("--verbose", action="store_true", help='Print the datagrams received')
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(main(args.server_ip, args.server_port, args.verbose))
+    except KeyboardInterrupt:
+        pass
+
+    print("Exiting...")